@@ -1,6 +1,8 @@
 import asyncio
 import logging
 import sys
+import time
+from typing import Optional
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -13,12 +15,13 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 import config
 from database import db
-from marzban_api import marzban_api
+from marzban_api import marzban_api, close_http_client
 from handlers.sudo_handlers import sudo_router
 from handlers.admin_handlers import admin_router
 from handlers.public_handlers import public_router
 from scheduler import init_scheduler
 from utils.bold_fix_bot import BoldFixBot
+from utils.forced_join import forced_join
 
 
 # Configure logging
@@ -42,27 +45,43 @@ class MarzbanAdminBot:
         )
         self.dp = Dispatcher()
         self.scheduler = None
+        self.started_at = time.monotonic()
+        self.api_warmup: Optional[asyncio.Task] = None
+
+    async def warm_up_api(self):
+        """Log in to Marzban and test the connection (runs in the background during startup)."""
+        started = time.monotonic()
+        try:
+            if await marzban_api.test_connection():
+                logger.info(f"Marzban API connection successful ({time.monotonic() - started:.2f}s)")
+            else:
+                logger.warning("Marzban API connection failed - bot will continue but some features may not work")
+        except Exception as e:
+            logger.warning(f"Error testing Marzban API: {e}")
 
     async def setup(self):
         """Setup bot components."""
         logger.info("Setting up Marzban Admin Bot...")
-        
+        self.started_at = time.monotonic()
+
+        # Marzban login runs alongside DB init and is not awaited: polling
+        # shouldn't wait on a slow or unreachable panel
+        self.api_warmup = asyncio.create_task(self.warm_up_api())
+
         # Initialize database
+        phase = time.monotonic()
         try:
             await db.init_db()
-            logger.info("Database initialized successfully")
+            logger.info(f"Database initialized successfully ({time.monotonic() - phase:.2f}s)")
         except Exception as e:
             logger.error(f"Failed to initialize database: {e}")
             raise
-        
-        # Test Marzban API connection
-        try:
-            if await marzban_api.test_connection():
-                logger.info("Marzban API connection successful")
-            else:
-                logger.warning("Marzban API connection failed - bot will continue but some features may not work")
-        except Exception as e:
-            logger.warning(f"Error testing Marzban API: {e}")
+
+        # Opt-in one-time file rewrite; done here, before polling, rather than in the compaction job
+        if config.USAGE_VACUUM_CONVERT:
+            phase = time.monotonic()
+            if await db.convert_to_incremental_vacuum():
+                logger.info(f"Database converted to incremental auto-vacuum ({time.monotonic() - phase:.2f}s)")
         
         # Register forced-join middleware BEFORE routers so it gates everything
         self.dp.message.outer_middleware(ForcedJoinMiddleware(self.bot))
@@ -101,7 +120,7 @@ class MarzbanAdminBot:
         except Exception as _e:
             logger.warning(f"Could not restore backup schedule: {_e}")
         
-        logger.info("Bot setup completed")
+        logger.info(f"Bot setup completed ({time.monotonic() - self.started_at:.2f}s since startup)")
 
     async def help_handler(self, message: Message, state: FSMContext = None):
         """Handler for unrecognized commands and help."""
@@ -152,31 +171,21 @@ class MarzbanAdminBot:
             logger.warning(f"Unauthorized handler called for user {user_id} in state {current_state} with message: {message.text} - this should not happen")
             return
         if user_id not in config.SUDO_ADMINS:
-            chans = await db.get_forced_channels()
-            if chans:
-                not_joined = []
-                for ch in chans:
-                    try:
-                        member = await self.bot.get_chat_member(chat_id=ch.get('chat_id'), user_id=user_id)
-                        status = getattr(member, 'status', None)
-                        if str(status).lower() not in ['member', 'administrator', 'creator']:
-                            not_joined.append(ch)
-                    except Exception:
-                        not_joined.append(ch)
-                if not_joined:
-                    lines = ["برای استفاده از ربات، ابتدا در کانال‌های زیر عضو شوید:", ""]
-                    kb_rows = []
-                    for ch in not_joined:
-                        title = ch.get('title') or ch.get('chat_id')
-                        link = ch.get('invite_link') or (f"https://t.me/{title.lstrip('@')}" if str(ch.get('chat_id')).startswith('@') else None)
-                        if link:
-                            lines.append(f"• {title}")
-                            kb_rows.append([InlineKeyboardButton(text=title, url=link)])
-                        else:
-                            lines.append(f"• {title}")
-                    kb_rows.append([InlineKeyboardButton(text="✅ بررسی مجدد", callback_data="forced_join_refresh")])
-                    await message.answer("\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
-                    return
+            not_joined = await forced_join.get_missing_channels(self.bot, user_id)
+            if not_joined:
+                lines = ["برای استفاده از ربات، ابتدا در کانال‌های زیر عضو شوید:", ""]
+                kb_rows = []
+                for ch in not_joined:
+                    title = ch.get('title') or ch.get('chat_id')
+                    link = ch.get('invite_link') or (f"https://t.me/{title.lstrip('@')}" if str(ch.get('chat_id')).startswith('@') else None)
+                    if link:
+                        lines.append(f"• {title}")
+                        kb_rows.append([InlineKeyboardButton(text=title, url=link)])
+                    else:
+                        lines.append(f"• {title}")
+                kb_rows.append([InlineKeyboardButton(text="✅ بررسی مجدد", callback_data="forced_join_refresh")])
+                await message.answer("\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
+                return
         if user_id not in config.SUDO_ADMINS and not await db.is_admin_authorized(user_id):
             from handlers.public_handlers import get_public_main_keyboard
             await message.answer(
@@ -229,7 +238,9 @@ class MarzbanAdminBot:
         """Start bot polling."""
         logger.info("Starting bot polling...")
         try:
+            # Returns immediately; the first monitoring sweep runs in the background
             await self.scheduler.start()
+            logger.info(f"Startup: polling starts {time.monotonic() - self.started_at:.2f}s after launch")
             await self.dp.start_polling(self.bot)
         except Exception as e:
             logger.error(f"Error during polling: {e}")
@@ -241,9 +252,12 @@ class MarzbanAdminBot:
         """Cleanup resources."""
         logger.info("Cleaning up bot resources...")
         try:
+            if self.api_warmup is not None and not self.api_warmup.done():
+                self.api_warmup.cancel()
             if self.scheduler:
                 await self.scheduler.stop()
             await db.close()
+            await close_http_client()
             await self.bot.session.close()
         except Exception as e:
             logger.error(f"Error during cleanup: {e}")
@@ -279,30 +293,8 @@ class ForcedJoinMiddleware(BaseMiddleware):
             # Allow refresh callback to pass through
             if hasattr(event, 'data') and getattr(event, 'data', '') == 'forced_join_refresh':
                 return await handler(event, data)
-            chans = await db.get_forced_channels()
-            if not chans:
-                return await handler(event, data)
-            not_joined = []
-            for ch in chans:
-                try:
-                    raw_chat_id = ch.get('chat_id')
-                    chat_id = raw_chat_id
-                    if isinstance(raw_chat_id, str) and raw_chat_id.isdigit() and not raw_chat_id.startswith('-100'):
-                        chat_id = f"-100{raw_chat_id}"
-                    # Convert numeric to int
-                    chat_id_to_use = int(chat_id) if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit() else chat_id
-                    member = await self.bot.get_chat_member(chat_id=chat_id_to_use, user_id=user_id)
-                    status = getattr(member, 'status', None)
-                    if hasattr(status, 'value'):
-                        s = status.value.lower()
-                    elif hasattr(status, 'name'):
-                        s = status.name.lower()
-                    else:
-                        s = str(status).lower()
-                    if s not in ['member', 'administrator', 'creator']:
-                        not_joined.append(ch)
-                except Exception:
-                    not_joined.append(ch)
+            # Cached channel list and memberships; only cache misses hit the Bot API (concurrently)
+            not_joined = await forced_join.get_missing_channels(self.bot, user_id)
             if not not_joined:
                 return await handler(event, data)
             lines = ["برای استفاده از ربات، ابتدا در کانال‌های زیر عضو شوید:", ""]
@@ -381,58 +373,6 @@ class ForcedJoinMiddleware(BaseMiddleware):
         
         logger.info(f"Help message sent to user {user_id}")
 
-    async def unauthorized_handler(self, message: Message, state: FSMContext = None):
-        """Handler for unauthorized users."""
-        user_id = message.from_user.id
-        
-        # Log handler activation with state information
-        current_state = await state.get_state() if state else None
-        logger.info(f"Unauthorized handler activated for user {user_id}, current state: {current_state}, message: {message.text}")
-        
-        # This should not happen with proper StateFilter, but keep as safety check
-        if current_state:
-            logger.warning(f"Unauthorized handler called for user {user_id} in state {current_state} with message: {message.text} - this should not happen")
-            return  # Don't interfere with FSM flow
-        
-        # Forced join gate for any non-sudo
-        if user_id not in config.SUDO_ADMINS:
-            chans = await db.get_forced_channels()
-            if chans:
-                # Check membership in all active channels
-                not_joined = []
-                for ch in chans:
-                    try:
-                        member = await self.bot.get_chat_member(chat_id=ch.get('chat_id'), user_id=user_id)
-                        status = getattr(member, 'status', None)
-                        if str(status).lower() not in ['member', 'administrator', 'creator']:
-                            not_joined.append(ch)
-                    except Exception:
-                        # If check fails, require join via invite link if exists
-                        not_joined.append(ch)
-                if not_joined:
-                    lines = ["برای استفاده از ربات، ابتدا در کانال‌های زیر عضو شوید:", ""]
-                    kb_rows = []
-                    for ch in not_joined:
-                        title = ch.get('title') or ch.get('chat_id')
-                        link = ch.get('invite_link') or (f"https://t.me/{title.lstrip('@')}" if str(ch.get('chat_id')).startswith('@') else None)
-                        if link:
-                            lines.append(f"• {title}")
-                            kb_rows.append([InlineKeyboardButton(text=title, url=link)])
-                        else:
-                            lines.append(f"• {title}")
-                    kb_rows.append([InlineKeyboardButton(text="✅ بررسی مجدد", callback_data="forced_join_refresh")])
-                    await message.answer("\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
-                    return
-
-        # If not sudo and not admin, show public menu
-        if user_id not in config.SUDO_ADMINS and not await db.is_admin_authorized(user_id):
-            from handlers.public_handlers import get_public_main_keyboard
-            await message.answer(
-                "به ربات خوش آمدید!",
-                reply_markup=get_public_main_keyboard()
-            )
-            logger.info(f"Public user {user_id} opened the bot")
-
     async def general_message_handler(self, message: Message, state: FSMContext = None):
         """General handler for unhandled messages."""
         user_id = message.from_user.id
@@ -20,15 +20,78 @@ SUDO_ADMINS: List[int] = [
 
 # Database Configuration
 DATABASE_PATH = os.getenv("DATABASE_PATH", "bot_database.db")
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))  # prepared statements kept per connection
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# Write-behind buffer for logs/usage reports: flushed in one transaction when full or after the interval
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "200"))
+DB_WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "2"))  # seconds
+DB_WRITE_MAX_PENDING = int(os.getenv("DB_WRITE_MAX_PENDING", "10000"))  # per buffer; rows kept for retry after a failed flush
 
 # Monitoring Configuration
 MONITORING_INTERVAL = int(os.getenv("MONITORING_INTERVAL", "600"))  # 10 minutes in seconds
 WARNING_THRESHOLD = float(os.getenv("WARNING_THRESHOLD", "0.8"))  # 80% threshold
 AUTO_DELETE_EXPIRED_USERS = os.getenv("AUTO_DELETE_EXPIRED_USERS", "false").lower() in ["1", "true", "yes"]
+MONITORING_CONCURRENCY = int(os.getenv("MONITORING_CONCURRENCY", "8"))  # panels checked in parallel
+# Snapshot mode: one full /api/users sweep per cycle, grouped by admin, instead of one scan per panel
+MONITORING_SNAPSHOT_MODE = os.getenv("MONITORING_SNAPSHOT_MODE", "false").lower() in ["1", "true", "yes"]
+# Incremental mode: keep last-seen per-user usage and update admin totals from deltas,
+# rebuilding everything from a full reconciliation every USAGE_RECONCILE_EVERY cycles
+MONITORING_INCREMENTAL_MODE = os.getenv("MONITORING_INCREMENTAL_MODE", "false").lower() in ["1", "true", "yes"]
+USAGE_RECONCILE_EVERY = int(os.getenv("USAGE_RECONCILE_EVERY", "6"))
+# Adaptive mode: each panel gets its own next-check time from its headroom and growth rate
+MONITORING_ADAPTIVE_MODE = os.getenv("MONITORING_ADAPTIVE_MODE", "false").lower() in ["1", "true", "yes"]
+MONITORING_MIN_INTERVAL = int(os.getenv("MONITORING_MIN_INTERVAL", "60"))  # panels close to a limit
+MONITORING_MAX_INTERVAL = int(os.getenv("MONITORING_MAX_INTERVAL", "3600"))  # idle panels far from limits
+MONITORING_SAFETY_FACTOR = float(os.getenv("MONITORING_SAFETY_FACTOR", "0.5"))  # check again within this share of the projected time to a limit
+MONITORING_TICK = int(os.getenv("MONITORING_TICK", "15"))  # seconds between due-panel checks in adaptive mode
+
+# Exhaustion forecast: linear fit of each panel's traffic/user growth over a sliding window
+FORECAST_WINDOW = int(os.getenv("FORECAST_WINDOW", "21600"))  # 6 hours of history in seconds
+FORECAST_MIN_SAMPLES = int(os.getenv("FORECAST_MIN_SAMPLES", "3"))
+FORECAST_MIN_SPAN = int(os.getenv("FORECAST_MIN_SPAN", "1800"))  # window must cover at least 30 minutes
+FORECAST_HORIZON = int(os.getenv("FORECAST_HORIZON", "168"))  # hours; later projections are not shown
+
+# usage_reports retention: raw rows -> hourly rollups -> daily rollups (0 = keep forever)
+USAGE_RAW_RETENTION_DAYS = int(os.getenv("USAGE_RAW_RETENTION_DAYS", "7"))
+USAGE_HOURLY_RETENTION_DAYS = int(os.getenv("USAGE_HOURLY_RETENTION_DAYS", "90"))
+USAGE_DAILY_RETENTION_DAYS = int(os.getenv("USAGE_DAILY_RETENTION_DAYS", "0"))
+USAGE_COMPACTION_INTERVAL = int(os.getenv("USAGE_COMPACTION_INTERVAL", "3600"))  # seconds between compaction runs
+USAGE_VACUUM_PAGES = int(os.getenv("USAGE_VACUUM_PAGES", "1000"))  # pages returned per run via incremental vacuum (0 = off)
+# Databases created before incremental auto-vacuum need one full VACUUM to convert; runs at startup only when enabled
+USAGE_VACUUM_CONVERT = os.getenv("USAGE_VACUUM_CONVERT", "false").lower() in ["1", "true", "yes"]
 
 # API Configuration
 API_TIMEOUT = int(os.getenv("API_TIMEOUT", "30"))
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "60"))  # re-login this many seconds before the JWT expires
+TOKEN_FALLBACK_TTL = int(os.getenv("TOKEN_FALLBACK_TTL", "3600"))  # assumed lifetime for tokens without an 'exp' claim
+# Adaptive concurrency (AIMD) and circuit breaker for Marzban calls
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "32"))  # upper bound for requests in flight
+API_MIN_CONCURRENCY = int(os.getenv("API_MIN_CONCURRENCY", "2"))  # floor the limit is halved down to
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", "50"))  # max Marzban requests started per second, all callers (0 = unlimited)
+API_LATENCY_TARGET = float(os.getenv("API_LATENCY_TARGET", "5"))  # seconds; slower responses shrink the limit
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # consecutive failures that open the circuit
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))  # seconds open before a half-open probe
+
+# HTTP connection pool (shared by all Marzban API calls)
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() in ["1", "true", "yes"]  # requires the 'h2' package
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+# User listing pagination (/api/users)
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "200"))
+USERS_FETCH_CONCURRENCY = int(os.getenv("USERS_FETCH_CONCURRENCY", "4"))  # parallel page requests
+
+# Bulk user operations (disable/enable/delete/reset many users)
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "10"))  # requests in flight at once
+BULK_RATE_LIMIT = float(os.getenv("BULK_RATE_LIMIT", "25"))  # max requests started per second (0 = unlimited)
+BULK_RETRY_BACKOFF = float(os.getenv("BULK_RETRY_BACKOFF", "0.5"))  # base delay in seconds, doubled per retry (429/5xx)
+
+# Forced-join membership cache (per user and channel)
+FORCED_JOIN_CACHE_TTL = int(os.getenv("FORCED_JOIN_CACHE_TTL", "300"))  # seconds a confirmed membership is trusted
+FORCED_JOIN_NEGATIVE_TTL = int(os.getenv("FORCED_JOIN_NEGATIVE_TTL", "30"))  # seconds a "not joined"/failed check is reused
+FORCED_JOIN_CACHE_MAX_ENTRIES = int(os.getenv("FORCED_JOIN_CACHE_MAX_ENTRIES", "10000"))  # expired entries pruned above this
 
 # Messages in Persian
 MESSAGES = {
@@ -91,6 +154,8 @@ BUTTONS = {
     "edit_panel": "✏️ ویرایش پنل",
     "list_admins": "📋 لیست ادمین‌ها",
     "admin_status": "📊 وضعیت ادمین‌ها",
+    "api_health": "🩺 سلامت اتصال مرزبان",
+    "admin_audit": "🧾 تاریخچه تغییرات پنل‌ها",
     "activate_admin": "🔄 فعالسازی پنل",
     "import_admin": "⬇️ افزودن ادمین قبلی",
     "my_info": "👤 اطلاعات من",
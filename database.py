@@ -1,274 +1,594 @@
 import aiosqlite
+import asyncio
+import calendar
 import os
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
 import json
 from datetime import datetime
-from typing import List, Optional, Dict, Any
-from models.schemas import AdminModel, UsageReportModel, LogModel
+from typing import List, Optional, Dict, Any, Tuple
+from models.schemas import AdminModel, UsageReportModel, LogModel, AdminAuditModel
 import config
 from models.schemas import PlanModel
 
 
+# Current schema version (PRAGMA user_version); bump together with Database._migrations
+SCHEMA_VERSION = 5
+
+# Configuration tables served from Database's in-memory cache
+CONFIG_CACHE_TABLES = ("settings", "plans", "cards", "forced_channels")
+
+# admins columns whose changes are recorded in admin_audit by triggers
+ADMIN_AUDIT_FIELDS = ("max_total_time", "created_at")
+
+# Secondary indexes for the hot lookups; created by init_db
+INDEXES = {
+    # Admin reads are served by AdminRegistry; this one backs its per-user refresh and remove_admin
+    "idx_admins_user_created": "CREATE INDEX IF NOT EXISTS idx_admins_user_created ON admins(user_id, created_at)",
+    "idx_usage_reports_admin_time": "CREATE INDEX IF NOT EXISTS idx_usage_reports_admin_time ON usage_reports(admin_user_id, check_time)",
+    "idx_usage_reports_time": "CREATE INDEX IF NOT EXISTS idx_usage_reports_time ON usage_reports(check_time)",
+    "idx_logs_admin_time": "CREATE INDEX IF NOT EXISTS idx_logs_admin_time ON logs(admin_user_id, timestamp)",
+    "idx_logs_time": "CREATE INDEX IF NOT EXISTS idx_logs_time ON logs(timestamp)",
+    "idx_orders_status_created": "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)",
+    "idx_orders_created": "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)",
+    "idx_forced_channels_active_created": "CREATE INDEX IF NOT EXISTS idx_forced_channels_active_created ON forced_channels(is_active, created_at)",
+}
+
+# Downsampled usage tables: one row per admin per hour/day, timestamps as unix seconds (UTC)
+USAGE_ROLLUP_TABLES = {"hourly": ("usage_rollup_hourly", 3600), "daily": ("usage_rollup_daily", 86400)}
+# Seconds an hour stays open after it ends, for reports whose check started before the hour
+# ended but that are buffered after compaction ran
+USAGE_ROLLUP_GRACE = 300
+
+
+def _utc_text(ts: int) -> str:
+    """Unix seconds -> the text form check_time is stored in (naive UTC)."""
+    return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _utc_ts(value) -> Optional[int]:
+    """check_time as buffered (datetime, naive = UTC, or its text form) -> unix seconds."""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    return calendar.timegm(value.utctimetuple())
+
+
+def _merge_sample(buckets: Dict, key, ts: int, users: int, traffic: int, samples: int = 1,
+                  users_min: Optional[int] = None, users_max: Optional[int] = None,
+                  traffic_min: Optional[int] = None, traffic_max: Optional[int] = None):
+    """Fold one sample (or an already aggregated bucket) into buckets[key]."""
+    users_min = users if users_min is None else users_min
+    users_max = users if users_max is None else users_max
+    traffic_min = traffic if traffic_min is None else traffic_min
+    traffic_max = traffic if traffic_max is None else traffic_max
+    acc = buckets.get(key)
+    if acc is None:
+        buckets[key] = [samples, users_min, users_max, users, traffic_min, traffic_max, traffic, ts]
+        return
+    acc[0] += samples
+    acc[1] = min(acc[1], users_min)
+    acc[2] = max(acc[2], users_max)
+    acc[4] = min(acc[4], traffic_min)
+    acc[5] = max(acc[5], traffic_max)
+    if ts >= acc[7]:
+        acc[3], acc[6], acc[7] = users, traffic, ts
+
+
+# Hot queries and the index (or any of the indexes) each one must use (verified by Database.check_query_plans)
+HOT_QUERIES = [
+    ("get_latest_usage_report", "SELECT * FROM usage_reports WHERE admin_user_id = ? ORDER BY check_time DESC LIMIT 1", (1,), "idx_usage_reports_admin_time"),
+    ("get_usage_series", "SELECT check_time FROM usage_reports WHERE admin_user_id = ? AND check_time >= ?", (1, "2000-01-01 00:00:00"), "idx_usage_reports_admin_time"),
+    ("get_logs(admin)", "SELECT * FROM logs WHERE admin_user_id = ? ORDER BY timestamp DESC LIMIT ?", (1, 100), "idx_logs_admin_time"),
+    ("get_logs", "SELECT * FROM logs ORDER BY timestamp DESC LIMIT ?", (100,), "idx_logs_time"),
+    ("get_admin_audit(admin)", "SELECT * FROM admin_audit WHERE admin_id = ? ORDER BY id DESC LIMIT ?", (1, 100), "idx_admin_audit_admin"),
+    ("get_orders(status)", "SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC", ("pending",), "idx_orders_status_created"),
+    ("get_orders", "SELECT * FROM orders ORDER BY created_at DESC", (), "idx_orders_created"),
+    ("get_forced_channels", "SELECT * FROM forced_channels WHERE is_active = 1 ORDER BY created_at DESC", (), "idx_forced_channels_active_created"),
+]
+
+
+def _created_key(admin: AdminModel):
+    return (admin.created_at or datetime.min, admin.id or 0)
+
+
+class AdminRegistry:
+    """In-memory copy of the admins table indexed by id, user_id and marzban_username.
+
+    Database loads it on the first admin read and refreshes the affected rows
+    after every admin mutation, so admin reads never touch SQLite. Models are
+    copied on the way out so callers can't change the registry by accident.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        # Bumped on every admins write; a load that raced with a write is not kept
+        self.version = 0
+        self.by_id: Dict[int, AdminModel] = {}
+        self.by_user_id: Dict[int, Dict[int, AdminModel]] = {}
+        self.by_marzban_username: Dict[str, AdminModel] = {}
+
+    def clear(self):
+        self.loaded = False
+        self.version += 1
+        self.by_id.clear()
+        self.by_user_id.clear()
+        self.by_marzban_username.clear()
+
+    def put(self, admin: AdminModel):
+        self.discard(admin.id)
+        self.by_id[admin.id] = admin
+        self.by_user_id.setdefault(admin.user_id, {})[admin.id] = admin
+        if admin.marzban_username:
+            self.by_marzban_username[admin.marzban_username] = admin
+
+    def discard(self, admin_id: int):
+        admin = self.by_id.pop(admin_id, None)
+        if admin is None:
+            return
+        panels = self.by_user_id.get(admin.user_id)
+        if panels is not None:
+            panels.pop(admin_id, None)
+            if not panels:
+                del self.by_user_id[admin.user_id]
+        if admin.marzban_username and self.by_marzban_username.get(admin.marzban_username) is admin:
+            del self.by_marzban_username[admin.marzban_username]
+
+    def replace_user(self, user_id: int, admins: List[AdminModel]):
+        for admin_id in list(self.by_user_id.get(user_id, {})):
+            self.discard(admin_id)
+        for admin in admins:
+            self.put(admin)
+
+
 class Database:
     def __init__(self, db_path: str = config.DATABASE_PATH):
         self.db_path = db_path
-
-    async def init_db(self):
-        """Initialize database and create tables if they don't exist."""
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._conn_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._vacuum_hint_shown = False
+        # Write-behind buffers for append-only rows (logs, usage reports)
+        self._pending_logs: List[tuple] = []
+        self._pending_reports: List[tuple] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_timer: Optional[asyncio.Task] = None
+        # Read-through caches for rarely-changing configuration tables (None = not loaded);
+        # every write to these tables goes through this class and invalidates them
+        self._settings_cache: Optional[Dict[str, Optional[str]]] = None
+        self._plans_cache: Optional[List[PlanModel]] = None
+        self._cards_cache: Optional[List[Dict[str, Any]]] = None
+        self._forced_channels_cache: Optional[List[Dict[str, Any]]] = None
+        # Bumped on every invalidation, like AdminRegistry.version; a load that raced with a write is not kept
+        self._cache_versions: Dict[str, int] = {name: 0 for name in CONFIG_CACHE_TABLES}
+        self._admins = AdminRegistry()
+        self._cache_stats: Dict[str, Dict[str, int]] = {
+            name: {"hits": 0, "misses": 0} for name in CONFIG_CACHE_TABLES
+        }
+
+    async def _get_conn(self) -> aiosqlite.Connection:
+        """Return the long-lived connection, opening it on first use.
+
+        The connection runs in WAL mode with synchronous=NORMAL, and keeps a
+        statement cache so repeated queries reuse their prepared statements.
+        """
+        if self._conn is None:
+            async with self._conn_lock:
+                if self._conn is None:
+                    self._conn = await self._open_conn()
+        return self._conn
+
+    async def _open_conn(self) -> aiosqlite.Connection:
+        """Open and configure a new connection to db_path (callers hold _conn_lock)."""
         # Ensure parent directory exists (if a directory is specified)
         try:
-            db_path_str = str(self.db_path)
-            parent = Path(db_path_str).parent
+            parent = Path(str(self.db_path)).parent
             if str(parent) not in ("", "."):
                 parent.mkdir(parents=True, exist_ok=True)
         except Exception as _e:
             print(f"Warning: could not ensure database directory exists for {self.db_path}: {_e}")
+        conn = await aiosqlite.connect(self.db_path, cached_statements=config.DB_STATEMENT_CACHE_SIZE)
+        conn.row_factory = aiosqlite.Row
+        # Only takes effect on a new file; existing files are converted by convert_to_incremental_vacuum
+        await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute(f"PRAGMA busy_timeout={int(config.DB_BUSY_TIMEOUT_MS)}")
+        return conn
+
+    @asynccontextmanager
+    async def _tx(self):
+        """Run one write transaction on the shared connection.
+
+        Writers are serialized by a lock, so a commit only ever covers the
+        statements of the transaction that issued it; an exception rolls the
+        transaction back instead of leaving its partial writes pending. The
+        connection is fetched under the lock so a transaction never starts on
+        a connection that restore_from is about to close.
+        """
+        async with self._write_lock:
+            async with self._transaction(await self._get_conn()) as db:
+                yield db
 
-        async with aiosqlite.connect(self.db_path) as db:
-            # Check if we need to migrate the old schema
-            try:
-                # Check if the old UNIQUE constraint exists
-                async with db.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='admins'") as cursor:
-                    row = await cursor.fetchone()
-                    if row and "user_id INTEGER UNIQUE NOT NULL" in row[0]:
-                        print("Migrating database schema to support multiple admin panels per user...")
-                        await self._migrate_admin_table(db)
-                        await db.commit()
-                        print("Database migration completed successfully!")
-            except Exception as e:
-                print(f"Error checking schema: {e}")
+    @asynccontextmanager
+    async def _transaction(self, db: aiosqlite.Connection):
+        """Commit on success, roll back on error (callers hold _write_lock)."""
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+    async def init_db(self):
+        """Initialize the database by applying any pending schema migrations.
+
+        The schema version is kept in PRAGMA user_version. On a warm start
+        (version already SCHEMA_VERSION) this is a single pragma read and no DDL
+        runs. Otherwise each pending step runs in order and the version is
+        bumped after it; steps are idempotent, so an interrupted upgrade can
+        simply be retried.
+        """
+        async with self._write_lock:
+            await self._apply_migrations(await self._get_conn())
+
+    async def _apply_migrations(self, db: aiosqlite.Connection):
+        """Run the pending migration steps on `db` (callers hold _write_lock)."""
+        async with db.execute("PRAGMA user_version") as cursor:
+            current = (await cursor.fetchone())[0]
+        if current >= SCHEMA_VERSION:
+            return
+        for version, description, migrate in self._migrations():
+            if version <= current:
+                continue
+            print(f"Applying database migration {version}: {description}")
+            async with self._transaction(db):
+                await migrate(db)
+                await db.execute(f"PRAGMA user_version = {int(version)}")
+
+    def _migrations(self):
+        """Ordered (version, description, step) list; bump SCHEMA_VERSION when appending."""
+        return [
+            (1, "base schema", self._migrate_base_schema),
+            (2, "hot-query indexes", self._migrate_indexes),
+            (3, "usage rollup tables", self._migrate_usage_rollups),
+            (4, "admin audit triggers", self._migrate_admin_audit),
+            (5, "usage report measurement flags", self._migrate_usage_measured),
+        ]
+
+    async def _migrate_base_schema(self, db):
+        """Tables and columns as of the pre-versioning schema (safe to run on any older database)."""
+        # Check if we need to migrate the old schema
+        try:
+            # Check if the old UNIQUE constraint exists
+            async with db.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='admins'") as cursor:
+                row = await cursor.fetchone()
+                if row and "user_id INTEGER UNIQUE NOT NULL" in row[0]:
+                    print("Migrating database schema to support multiple admin panels per user...")
+                    await self._migrate_admin_table(db)
+                    print("Database migration completed successfully!")
+        except Exception as e:
+            print(f"Error checking schema: {e}")
+        
+        # Create admins table - removed UNIQUE constraint on user_id to allow multiple panels per user
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS admins (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                admin_name TEXT,
+                marzban_username TEXT UNIQUE,
+                marzban_password TEXT,
+                login_url TEXT,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                max_users INTEGER DEFAULT 10,
+                max_total_time INTEGER DEFAULT 2592000,
+                max_total_traffic INTEGER DEFAULT 107374182400,
+                validity_days INTEGER DEFAULT 30,
+                is_active BOOLEAN DEFAULT 1,
+                original_password TEXT,
+                deactivated_at TIMESTAMP,
+                deactivated_reason TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                users_historical_peak INTEGER DEFAULT 0,
+                origin_plan_id INTEGER
+            )
+        """)
+        
+        # Add new columns if they don't exist (for migration)
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN admin_name TEXT")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
             
-            # Create admins table - removed UNIQUE constraint on user_id to allow multiple panels per user
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS admins (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    admin_name TEXT,
-                    marzban_username TEXT UNIQUE,
-                    marzban_password TEXT,
-                    login_url TEXT,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    max_users INTEGER DEFAULT 10,
-                    max_total_time INTEGER DEFAULT 2592000,
-                    max_total_traffic INTEGER DEFAULT 107374182400,
-                    validity_days INTEGER DEFAULT 30,
-                    is_active BOOLEAN DEFAULT 1,
-                    original_password TEXT,
-                    deactivated_at TIMESTAMP,
-                    deactivated_reason TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    users_historical_peak INTEGER DEFAULT 0,
-                    origin_plan_id INTEGER
-                )
-            """)
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN marzban_username TEXT")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
             
-            # Add new columns if they don't exist (for migration)
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN admin_name TEXT")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
-                
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN marzban_username TEXT")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
-                
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN marzban_password TEXT")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN marzban_password TEXT")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
 
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN login_url TEXT")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
-                
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN validity_days INTEGER DEFAULT 30")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN login_url TEXT")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
             
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN original_password TEXT")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN validity_days INTEGER DEFAULT 30")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
+        
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN original_password TEXT")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
+        
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN deactivated_at TIMESTAMP")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
             
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN deactivated_at TIMESTAMP")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
-                
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN deactivated_reason TEXT")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN deactivated_reason TEXT")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
 
-            # Add historical users peak column if missing
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN users_historical_peak INTEGER DEFAULT 0")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists
-            # Add origin plan id if missing
-            try:
-                await db.execute("ALTER TABLE admins ADD COLUMN origin_plan_id INTEGER")
-            except aiosqlite.OperationalError:
-                pass
+        # Add historical users peak column if missing
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN users_historical_peak INTEGER DEFAULT 0")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
+        # Add origin plan id if missing
+        try:
+            await db.execute("ALTER TABLE admins ADD COLUMN origin_plan_id INTEGER")
+        except aiosqlite.OperationalError:
+            pass
 
-            # Create usage_reports table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS usage_reports (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    admin_user_id INTEGER NOT NULL,
-                    check_time TIMESTAMP NOT NULL,
-                    current_users INTEGER DEFAULT 0,
-                    current_total_time INTEGER DEFAULT 0,
-                    current_total_traffic INTEGER DEFAULT 0,
-                    users_data TEXT,
-                    FOREIGN KEY (admin_user_id) REFERENCES admins(user_id)
-                )
-            """)
+        # Create usage_reports table
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS usage_reports (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_user_id INTEGER NOT NULL,
+                check_time TIMESTAMP NOT NULL,
+                current_users INTEGER DEFAULT 0,
+                current_total_time INTEGER DEFAULT 0,
+                current_total_traffic INTEGER DEFAULT 0,
+                users_data TEXT,
+                FOREIGN KEY (admin_user_id) REFERENCES admins(user_id)
+            )
+        """)
 
-            # Create logs table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    admin_user_id INTEGER,
-                    action TEXT NOT NULL,
-                    details TEXT,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (admin_user_id) REFERENCES admins(user_id)
-                )
-            """)
+        # Create logs table
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_user_id INTEGER,
+                action TEXT NOT NULL,
+                details TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (admin_user_id) REFERENCES admins(user_id)
+            )
+        """)
 
-            # Create plans table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS plans (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    plan_type TEXT DEFAULT 'both',
-                    traffic_limit_bytes INTEGER,
-                    time_limit_seconds INTEGER,
-                    max_users INTEGER,
-                    price INTEGER DEFAULT 0,
-                    is_active BOOLEAN DEFAULT 1,
-                    allow_incremental_renewal BOOLEAN DEFAULT 1
-                )
-            """)
+        # Create plans table
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS plans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                plan_type TEXT DEFAULT 'both',
+                traffic_limit_bytes INTEGER,
+                time_limit_seconds INTEGER,
+                max_users INTEGER,
+                price INTEGER DEFAULT 0,
+                is_active BOOLEAN DEFAULT 1,
+                allow_incremental_renewal BOOLEAN DEFAULT 1
+            )
+        """)
 
-            # Create settings table (key-value store)
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+        # Create settings table (key-value store)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
 
-            # Create forced join channels table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS forced_channels (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id TEXT NOT NULL,
-                    title TEXT,
-                    invite_link TEXT,
-                    is_active BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
+        # Create forced join channels table
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS forced_channels (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                title TEXT,
+                invite_link TEXT,
+                is_active BOOLEAN DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Migrate existing plans table to add missing columns
+        try:
+            await db.execute("ALTER TABLE plans ADD COLUMN max_users INTEGER")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists or table was just created
+        try:
+            await db.execute("ALTER TABLE plans ADD COLUMN plan_type TEXT DEFAULT 'both'")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE plans ADD COLUMN allow_incremental_renewal BOOLEAN DEFAULT 1")
+        except aiosqlite.OperationalError:
+            pass
+
+        # Create orders table (for reseller purchases)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                plan_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                order_type TEXT,
+                target_admin_id INTEGER,
+                delta_traffic_bytes INTEGER,
+                delta_time_seconds INTEGER,
+                delta_users INTEGER,
+                price_snapshot INTEGER,
+                plan_name_snapshot TEXT,
+                payment_note TEXT,
+                receipt_file_id TEXT,
+                approved_by INTEGER,
+                issued_admin_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Add missing order columns if table exists
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN payment_note TEXT")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN approved_by INTEGER")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN issued_admin_id INTEGER")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN receipt_file_id TEXT")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN order_type TEXT")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN target_admin_id INTEGER")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN delta_traffic_bytes INTEGER")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN delta_time_seconds INTEGER")
+        except aiosqlite.OperationalError:
+            pass
+        try:
+            await db.execute("ALTER TABLE orders ADD COLUMN delta_users INTEGER")
+        except aiosqlite.OperationalError:
+            pass
+
+        # Create cards table (manual payment destinations)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS cards (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bank_name TEXT,
+                card_number TEXT,
+                holder_name TEXT,
+                is_active BOOLEAN DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    async def _migrate_indexes(self, db):
+        """Secondary indexes for the hot lookups (admins by user, latest reports, logs, orders)."""
+        for index_sql in INDEXES.values():
+            await db.execute(index_sql)
+
+    async def _migrate_usage_rollups(self, db):
+        """Hourly/daily rollups of usage_reports (min/max/last users and traffic per bucket)."""
+        for table, _ in USAGE_ROLLUP_TABLES.values():
+            await db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    admin_user_id INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    samples INTEGER NOT NULL DEFAULT 0,
+                    users_min INTEGER,
+                    users_max INTEGER,
+                    users_last INTEGER,
+                    traffic_min INTEGER,
+                    traffic_max INTEGER,
+                    traffic_last INTEGER,
+                    last_time INTEGER NOT NULL,
+                    PRIMARY KEY (admin_user_id, bucket)
+                ) WITHOUT ROWID
             """)
 
-            # Migrate existing plans table to add missing columns
-            try:
-                await db.execute("ALTER TABLE plans ADD COLUMN max_users INTEGER")
-            except aiosqlite.OperationalError:
-                pass  # Column already exists or table was just created
-            try:
-                await db.execute("ALTER TABLE plans ADD COLUMN plan_type TEXT DEFAULT 'both'")
-            except aiosqlite.OperationalError:
-                pass
-            try:
-                await db.execute("ALTER TABLE plans ADD COLUMN allow_incremental_renewal BOOLEAN DEFAULT 1")
-            except aiosqlite.OperationalError:
-                pass
-
-            # Create orders table (for reseller purchases)
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    plan_id INTEGER NOT NULL,
-                    status TEXT NOT NULL DEFAULT 'pending',
-                    order_type TEXT,
-                    target_admin_id INTEGER,
-                    delta_traffic_bytes INTEGER,
-                    delta_time_seconds INTEGER,
-                    delta_users INTEGER,
-                    price_snapshot INTEGER,
-                    plan_name_snapshot TEXT,
-                    payment_note TEXT,
-                    receipt_file_id TEXT,
-                    approved_by INTEGER,
-                    issued_admin_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
+    async def _migrate_admin_audit(self, db):
+        """Audit max_total_time/created_at changes with triggers instead of read-before-write in update_admin."""
+        try:
+            # Optional caller tag written by update_admin in the same statement; read by the triggers
+            await db.execute("ALTER TABLE admins ADD COLUMN audit_caller TEXT")
+        except aiosqlite.OperationalError:
+            pass  # Column already exists
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS admin_audit (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                admin_user_id INTEGER,
+                field TEXT NOT NULL,
+                old_value TEXT,
+                new_value TEXT,
+                caller TEXT,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_admin_audit_admin ON admin_audit(admin_id, id)")
+        for field in ADMIN_AUDIT_FIELDS:
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_admins_audit_{field}
+                AFTER UPDATE OF {field} ON admins
+                WHEN OLD.{field} IS NOT NEW.{field}
+                BEGIN
+                    INSERT INTO admin_audit (admin_id, admin_user_id, field, old_value, new_value, caller)
+                    VALUES (NEW.id, NEW.user_id, '{field}', OLD.{field}, NEW.{field}, NEW.audit_caller);
+                END
             """)
 
-            # Add missing order columns if table exists
-            try:
-                await db.execute("ALTER TABLE orders ADD COLUMN payment_note TEXT")
-            except aiosqlite.OperationalError:
-                pass
-            try:
-                await db.execute("ALTER TABLE orders ADD COLUMN approved_by INTEGER")
-            except aiosqlite.OperationalError:
-                pass
-            try:
-                await db.execute("ALTER TABLE orders ADD COLUMN issued_admin_id INTEGER")
-            except aiosqlite.OperationalError:
-                pass
-            try:
-                await db.execute("ALTER TABLE orders ADD COLUMN receipt_file_id TEXT")
-            except aiosqlite.OperationalError:
-                pass
-            try:
-                await db.execute("ALTER TABLE orders ADD COLUMN order_type TEXT")
-            except aiosqlite.OperationalError:
-                pass
-            try:
-                await db.execute("ALTER TABLE orders ADD COLUMN target_admin_id INTEGER")
-            except aiosqlite.OperationalError:
-                pass
-            try:
-                await db.execute("ALTER TABLE orders ADD COLUMN delta_traffic_bytes INTEGER")
-            except aiosqlite.OperationalError:
-                pass
-            try:
-                await db.execute("ALTER TABLE orders ADD COLUMN delta_time_seconds INTEGER")
-            except aiosqlite.OperationalError:
-                pass
+    async def _migrate_usage_measured(self, db):
+        """Flag usage_reports values carried forward from an earlier check (0) apart from measured ones (1)."""
+        for column in ("users_measured", "traffic_measured"):
             try:
-                await db.execute("ALTER TABLE orders ADD COLUMN delta_users INTEGER")
+                await db.execute(f"ALTER TABLE usage_reports ADD COLUMN {column} INTEGER NOT NULL DEFAULT 1")
             except aiosqlite.OperationalError:
-                pass
-
-            # Create cards table (manual payment destinations)
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS cards (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bank_name TEXT,
-                    card_number TEXT,
-                    holder_name TEXT,
-                    is_active BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+                pass  # Column already exists
 
-            await db.commit()
+    async def check_query_plans(self) -> Dict[str, str]:
+        """Run EXPLAIN QUERY PLAN for every hot query and return the problems found.
+
+        A query is reported if its plan does not use the expected index or
+        needs a temporary B-tree for ORDER BY. An empty dict means all plans
+        are as expected.
+        """
+        db = await self._get_conn()
+        problems: Dict[str, str] = {}
+        for name, query, params, expected in HOT_QUERIES:
+            index_names = (expected,) if isinstance(expected, str) else expected
+            try:
+                async with db.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+                    plan = " | ".join(row[3] for row in await cursor.fetchall())
+                if not any(index_name in plan for index_name in index_names):
+                    problems[name] = f"expected {' or '.join(index_names)}: {plan}"
+                elif "TEMP B-TREE" in plan:
+                    problems[name] = f"sorts with a temp B-tree: {plan}"
+            except Exception as e:
+                problems[name] = f"error: {e}"
+        return problems
 
     async def _migrate_admin_table(self, db):
         """Migrate the admins table to remove UNIQUE constraint on user_id."""
@@ -318,8 +638,8 @@ class Database:
     async def add_admin(self, admin: AdminModel) -> bool:
         """Add a new admin to the database."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
+            async with self._tx() as db:
+                cursor = await db.execute("""
                     INSERT INTO admins (user_id, admin_name, marzban_username, marzban_password,
                                       login_url, username, first_name, last_name, 
                                       max_users, max_total_time, max_total_traffic, validity_days,
@@ -331,8 +651,10 @@ class Database:
                       admin.max_users, admin.max_total_time, admin.max_total_traffic, admin.validity_days,
                       admin.is_active, admin.original_password, admin.deactivated_at, admin.deactivated_reason,
                       getattr(admin, 'users_historical_peak', 0), getattr(admin, 'origin_plan_id', None)))
-                await db.commit()
-                return True
+                admin_id = cursor.lastrowid
+                await cursor.close()
+            await self._refresh_admin(admin_id)
+            return True
         except aiosqlite.IntegrityError as e:
             print(f"Admin already exists (marzban_username must be unique): {e}")
             return False
@@ -340,16 +662,65 @@ class Database:
             print(f"Error adding admin: {e}")
             return False
 
+    async def _admin_registry(self) -> AdminRegistry:
+        """Registry of all admins, loaded from SQLite on first use."""
+        registry = self._admins
+        if not registry.loaded:
+            version = registry.version
+            db = await self._get_conn()
+            async with db.execute("SELECT * FROM admins") as cursor:
+                rows = await cursor.fetchall()
+            admins = [AdminModel(**dict(row)) for row in rows]
+            if registry.version == version and not registry.loaded:
+                for admin in admins:
+                    registry.put(admin)
+                registry.loaded = True
+            elif not registry.loaded:
+                # An admins write landed while loading; serve this read without caching it
+                loaded = AdminRegistry()
+                for admin in admins:
+                    loaded.put(admin)
+                return loaded
+        return registry
+
+    async def _refresh_admin(self, admin_id: Optional[int]):
+        """Reload one admin row into the registry after a write (removes it if deleted)."""
+        self._admins.version += 1
+        if not self._admins.loaded or admin_id is None:
+            return
+        try:
+            db = await self._get_conn()
+            async with db.execute("SELECT * FROM admins WHERE id = ?", (admin_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                self._admins.put(AdminModel(**dict(row)))
+            else:
+                self._admins.discard(admin_id)
+        except Exception as e:
+            print(f"Error refreshing admin registry: {e}")
+            self._admins.clear()
+
+    async def _refresh_admins_for_user(self, user_id: int):
+        """Reload every panel of a user into the registry after a user_id-scoped write."""
+        self._admins.version += 1
+        if not self._admins.loaded:
+            return
+        try:
+            db = await self._get_conn()
+            async with db.execute("SELECT * FROM admins WHERE user_id = ?", (user_id,)) as cursor:
+                rows = await cursor.fetchall()
+            self._admins.replace_user(user_id, [AdminModel(**dict(row)) for row in rows])
+        except Exception as e:
+            print(f"Error refreshing admin registry: {e}")
+            self._admins.clear()
+
     async def get_admin(self, user_id: int) -> Optional[AdminModel]:
         """Get first admin by user_id for backward compatibility."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM admins WHERE user_id = ? ORDER BY created_at ASC LIMIT 1", (user_id,)) as cursor:
-                    row = await cursor.fetchone()
-                    if row:
-                        return AdminModel(**dict(row))
-                    return None
+            panels = (await self._admin_registry()).by_user_id.get(user_id)
+            if panels:
+                return min(panels.values(), key=_created_key).model_copy()
+            return None
         except Exception as e:
             print(f"Error getting admin: {e}")
             return None
@@ -357,11 +728,8 @@ class Database:
     async def get_admins_for_user(self, user_id: int) -> List[AdminModel]:
         """Get all admins for a specific user_id."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM admins WHERE user_id = ? ORDER BY created_at DESC", (user_id,)) as cursor:
-                    rows = await cursor.fetchall()
-                    return [AdminModel(**dict(row)) for row in rows]
+            panels = (await self._admin_registry()).by_user_id.get(user_id, {})
+            return [admin.model_copy() for admin in sorted(panels.values(), key=_created_key, reverse=True)]
         except Exception as e:
             print(f"Error getting admins for user: {e}")
             return []
@@ -369,13 +737,8 @@ class Database:
     async def get_admin_by_marzban_username(self, marzban_username: str) -> Optional[AdminModel]:
         """Get admin by marzban username."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM admins WHERE marzban_username = ?", (marzban_username,)) as cursor:
-                    row = await cursor.fetchone()
-                    if row:
-                        return AdminModel(**dict(row))
-                    return None
+            admin = (await self._admin_registry()).by_marzban_username.get(marzban_username)
+            return admin.model_copy() if admin else None
         except Exception as e:
             print(f"Error getting admin by marzban username: {e}")
             return None
@@ -383,13 +746,8 @@ class Database:
     async def get_admin_by_id(self, admin_id: int) -> Optional[AdminModel]:
         """Get admin by admin ID."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM admins WHERE id = ?", (admin_id,)) as cursor:
-                    row = await cursor.fetchone()
-                    if row:
-                        return AdminModel(**dict(row))
-                    return None
+            admin = (await self._admin_registry()).by_id.get(admin_id)
+            return admin.model_copy() if admin else None
         except Exception as e:
             print(f"Error getting admin by ID: {e}")
             return None
@@ -397,129 +755,82 @@ class Database:
     async def get_all_admins(self) -> List[AdminModel]:
         """Get all admins."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM admins ORDER BY created_at DESC") as cursor:
-                    rows = await cursor.fetchall()
-                    return [AdminModel(**dict(row)) for row in rows]
+            admins = (await self._admin_registry()).by_id.values()
+            return [admin.model_copy() for admin in sorted(admins, key=_created_key, reverse=True)]
         except Exception as e:
             print(f"Error getting all admins: {e}")
             return []
 
-    async def update_admin(self, admin_id: int, **kwargs) -> bool:
+    async def update_admin(self, admin_id: int, caller: Optional[str] = None, **kwargs) -> bool:
         """Update admin data by admin ID.
 
-        Additionally, audit potentially sensitive changes (time limit and created_at)
-        by writing a log entry to the `logs` table. This helps trace any unexpected
-        monthly increments or timestamp resets.
+        Changes to the time limit and created_at are audited by triggers into
+        `admin_audit` (see get_admin_audit), tagged with `caller` when given,
+        so a plain update is a single statement.
         """
         try:
             if not kwargs:
                 return False
 
-            # Read current values for auditing before update
-            old_admin = await self.get_admin_by_id(admin_id)
-
             set_clause = ", ".join([f"{key} = ?" for key in kwargs.keys()])
-            values = list(kwargs.values()) + [admin_id]
+            values = list(kwargs.values()) + [caller, admin_id]
 
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(f"""
-                    UPDATE admins SET {set_clause}, updated_at = CURRENT_TIMESTAMP 
+                    UPDATE admins SET {set_clause}, audit_caller = ?, updated_at = CURRENT_TIMESTAMP 
                     WHERE id = ?
                 """, values)
-                await db.commit()
-
-            # Post-update audit logs for key fields
-            try:
-                from models.schemas import LogModel
-                import inspect
-                # Capture simple caller info (best-effort)
-                caller = None
-                try:
-                    stack = inspect.stack()
-                    # Find first external frame after this function
-                    if len(stack) >= 3:
-                        frame = stack[2]
-                        caller = f"{frame.function}@{frame.filename}:{frame.lineno}"
-                except Exception:
-                    caller = None
-
-                # Audit max_total_time increment
-                if "max_total_time" in kwargs and old_admin is not None:
-                    old_val = int(old_admin.max_total_time or 0)
-                    new_val = int(kwargs.get("max_total_time") or 0)
-                    delta = new_val - old_val
-                    if delta != 0:
-                        details = (
-                            f"admin_id={admin_id} old={old_val}s new={new_val}s delta={delta}s"
-                            + (f" caller={caller}" if caller else "")
-                        )
-                        log = LogModel(
-                            admin_user_id=old_admin.user_id,
-                            action=("admin_time_limit_increased" if delta > 0 else "admin_time_limit_decreased"),
-                            details=details
-                        )
-                        await self.add_log(log)
-
-                # Audit created_at change
-                if "created_at" in kwargs and old_admin is not None:
-                    try:
-                        old_ts = old_admin.created_at.isoformat() if old_admin.created_at else "None"
-                    except Exception:
-                        old_ts = str(old_admin.created_at)
-                    new_ca = kwargs.get("created_at")
-                    try:
-                        new_ts = new_ca.isoformat() if new_ca else "None"
-                    except Exception:
-                        new_ts = str(new_ca)
-                    details = (
-                        f"admin_id={admin_id} old_created_at={old_ts} new_created_at={new_ts}"
-                        + (f" caller={caller}" if caller else "")
-                    )
-                    log = LogModel(
-                        admin_user_id=old_admin.user_id,
-                        action="admin_created_at_changed",
-                        details=details
-                    )
-                    await self.add_log(log)
-            except Exception as _audit_err:
-                # Non-fatal; auditing should never break main flow
-                print(f"Audit log failure in update_admin: {_audit_err}")
-
+            await self._refresh_admin(admin_id)
             return True
         except Exception as e:
             print(f"Error updating admin: {e}")
             return False
 
-    async def update_admin_by_user_id(self, user_id: int, **kwargs) -> bool:
+    async def update_admin_by_user_id(self, user_id: int, caller: Optional[str] = None, **kwargs) -> bool:
         """Update admin data by user_id (for backward compatibility)."""
         try:
             if not kwargs:
                 return False
             
             set_clause = ", ".join([f"{key} = ?" for key in kwargs.keys()])
-            values = list(kwargs.values()) + [user_id]
+            values = list(kwargs.values()) + [caller, user_id]
             
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(f"""
-                    UPDATE admins SET {set_clause}, updated_at = CURRENT_TIMESTAMP 
+                    UPDATE admins SET {set_clause}, audit_caller = ?, updated_at = CURRENT_TIMESTAMP 
                     WHERE user_id = ? 
                     ORDER BY created_at ASC LIMIT 1
                 """, values)
-                await db.commit()
-                return True
+            await self._refresh_admins_for_user(user_id)
+            return True
         except Exception as e:
             print(f"Error updating admin by user_id: {e}")
             return False
 
+    async def get_admin_audit(self, admin_id: Optional[int] = None, limit: int = 100) -> List[AdminAuditModel]:
+        """Get audited time-limit/created_at changes, newest first, optionally for one admin."""
+        try:
+            db = await self._get_conn()
+            if admin_id:
+                query = "SELECT * FROM admin_audit WHERE admin_id = ? ORDER BY id DESC LIMIT ?"
+                params = (admin_id, limit)
+            else:
+                query = "SELECT * FROM admin_audit ORDER BY id DESC LIMIT ?"
+                params = (limit,)
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+                return [AdminAuditModel(**dict(row)) for row in rows]
+        except Exception as e:
+            print(f"Error getting admin audit: {e}")
+            return []
+
     async def remove_admin(self, user_id: int) -> bool:
         """Remove first admin from database by user_id (for backward compatibility)."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("DELETE FROM admins WHERE user_id = ? ORDER BY created_at ASC LIMIT 1", (user_id,))
-                await db.commit()
-                return True
+            await self._refresh_admins_for_user(user_id)
+            return True
         except Exception as e:
             print(f"Error removing admin: {e}")
             return False
@@ -527,26 +838,78 @@ class Database:
     async def remove_admin_by_id(self, admin_id: int) -> bool:
         """Remove admin from database by admin ID."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("DELETE FROM admins WHERE id = ?", (admin_id,))
-                await db.commit()
-                return True
+            await self._refresh_admin(admin_id)
+            return True
         except Exception as e:
             print(f"Error removing admin by ID: {e}")
             return False
 
+    async def _buffer_write(self, buffer: List[tuple], row: tuple):
+        """Queue an append-only row; flush when the batch is full, otherwise within DB_WRITE_FLUSH_INTERVAL."""
+        buffer.append(row)
+        if len(self._pending_logs) + len(self._pending_reports) >= config.DB_WRITE_BATCH_SIZE:
+            await self.flush_writes()
+        elif self._flush_timer is None or self._flush_timer.done():
+            self._flush_timer = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(config.DB_WRITE_FLUSH_INTERVAL)
+        except asyncio.CancelledError:
+            return
+        await self.flush_writes()
+
+    async def flush_writes(self) -> int:
+        """Write all buffered logs and usage reports in one transaction; returns the number of rows written."""
+        async with self._flush_lock:
+            logs, self._pending_logs = self._pending_logs, []
+            reports, self._pending_reports = self._pending_reports, []
+            if not logs and not reports:
+                return 0
+            try:
+                async with self._tx() as db:
+                    if logs:
+                        await db.executemany("""
+                            INSERT INTO logs (admin_user_id, action, details, timestamp)
+                            VALUES (?, ?, ?, ?)
+                        """, logs)
+                    if reports:
+                        await db.executemany("""
+                            INSERT INTO usage_reports (admin_user_id, check_time, current_users, 
+                                                     current_total_time, current_total_traffic, users_data,
+                                                     users_measured, traffic_measured)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        """, reports)
+                return len(logs) + len(reports)
+            except Exception as e:
+                # Rolled back: put the rows back in front of anything queued meanwhile and retry later.
+                # Capped so a persistent failure cannot grow memory without limit (oldest rows go first).
+                print(f"Error flushing {len(logs)} logs and {len(reports)} usage reports (will retry): {e}")
+                self._pending_logs = self._requeue(logs, self._pending_logs, "logs")
+                self._pending_reports = self._requeue(reports, self._pending_reports, "usage reports")
+                if self._flush_timer is None or self._flush_timer.done() or self._flush_timer is asyncio.current_task():
+                    self._flush_timer = asyncio.get_running_loop().create_task(self._flush_later())
+                return 0
+
+    def _requeue(self, failed: List[tuple], queued: List[tuple], label: str) -> List[tuple]:
+        rows = failed + queued
+        overflow = len(rows) - config.DB_WRITE_MAX_PENDING
+        if overflow > 0:
+            print(f"Write buffer full; dropping {overflow} oldest {label}")
+            rows = rows[overflow:]
+        return rows
+
     async def add_usage_report(self, report: UsageReportModel) -> bool:
-        """Add usage report."""
+        """Add usage report (buffered; see flush_writes)."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
-                    INSERT INTO usage_reports (admin_user_id, check_time, current_users, 
-                                             current_total_time, current_total_traffic, users_data)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (report.admin_user_id, report.check_time, report.current_users,
-                      report.current_total_time, report.current_total_traffic, report.users_data))
-                await db.commit()
-                return True
+            await self._buffer_write(self._pending_reports, (
+                report.admin_user_id, report.check_time, report.current_users,
+                report.current_total_time, report.current_total_traffic, report.users_data,
+                int(report.users_measured), int(report.traffic_measured)
+            ))
+            return True
         except Exception as e:
             print(f"Error adding usage report: {e}")
             return False
@@ -554,30 +917,238 @@ class Database:
     async def get_latest_usage_report(self, admin_user_id: int) -> Optional[UsageReportModel]:
         """Get latest usage report for admin."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("""
-                    SELECT * FROM usage_reports WHERE admin_user_id = ? 
-                    ORDER BY check_time DESC LIMIT 1
-                """, (admin_user_id,)) as cursor:
-                    row = await cursor.fetchone()
-                    if row:
-                        return UsageReportModel(**dict(row))
-                    return None
+            await self.flush_writes()
+            db = await self._get_conn()
+            async with db.execute("""
+                SELECT * FROM usage_reports WHERE admin_user_id = ? 
+                ORDER BY check_time DESC LIMIT 1
+            """, (admin_user_id,)) as cursor:
+                row = await cursor.fetchone()
+                if row:
+                    return UsageReportModel(**dict(row))
+                return None
         except Exception as e:
             print(f"Error getting latest usage report: {e}")
             return None
 
+    async def _write_rollups(self, db, table: str, buckets: Dict):
+        await db.executemany(f"""
+            INSERT INTO {table} (admin_user_id, bucket, samples, users_min, users_max, users_last,
+                                 traffic_min, traffic_max, traffic_last, last_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(admin_user_id, bucket) DO UPDATE SET
+                samples = samples + excluded.samples,
+                users_min = MIN(users_min, excluded.users_min),
+                users_max = MAX(users_max, excluded.users_max),
+                users_last = CASE WHEN excluded.last_time >= last_time THEN excluded.users_last ELSE users_last END,
+                traffic_min = MIN(traffic_min, excluded.traffic_min),
+                traffic_max = MAX(traffic_max, excluded.traffic_max),
+                traffic_last = CASE WHEN excluded.last_time >= last_time THEN excluded.traffic_last ELSE traffic_last END,
+                last_time = MAX(last_time, excluded.last_time)
+        """, [(admin_user_id, bucket, *acc) for (admin_user_id, bucket), acc in buckets.items()])
+
+    async def _delete_in_chunks(self, sql: str, params: tuple, chunk: int = 5000) -> int:
+        """Run a `... WHERE rowid IN (SELECT ... LIMIT ?)` delete repeatedly, committing between chunks."""
+        deleted = 0
+        while True:
+            async with self._tx() as db:
+                cursor = await db.execute(sql, (*params, chunk))
+            deleted += max(cursor.rowcount, 0)
+            if cursor.rowcount < chunk:
+                return deleted
+
+    async def compact_usage_reports(self) -> Dict[str, int]:
+        """Roll raw usage_reports up into hourly/daily tables and apply retention.
+
+        - Complete hours of raw rows not yet rolled up go into usage_rollup_hourly
+          (an hour closes USAGE_ROLLUP_GRACE seconds after it ends, and never
+          while a buffered report for it is still waiting to be written),
+          and complete days of hourly rows into usage_rollup_daily (progress is
+          kept in settings, so each row is folded in exactly once).
+        - Raw rows older than USAGE_RAW_RETENTION_DAYS and hourly rows older than
+          USAGE_HOURLY_RETENTION_DAYS are deleted once rolled up; daily rows are
+          kept for USAGE_DAILY_RETENTION_DAYS (0 = forever).
+        - Freed pages are returned to the OS with incremental vacuum.
+        """
+        result = {"hourly_buckets": 0, "daily_buckets": 0, "raw_deleted": 0, "hourly_deleted": 0, "daily_deleted": 0}
+        try:
+            db = await self._get_conn()
+            now_ts = int(time.time())
+            await self.flush_writes()
+
+            # 1) raw -> hourly
+            hourly_table, hour = USAGE_ROLLUP_TABLES["hourly"]
+            hourly_from = int(await self.get_setting("usage_rollup_hourly_until") or 0)
+            hourly_until = (now_ts - USAGE_ROLLUP_GRACE) // hour * hour
+            # Reports still buffered (e.g. after a failed flush) must land ahead of the watermark,
+            # or they would never be rolled up and retention would delete them
+            pending = [ts for ts in (_utc_ts(row[1]) for row in self._pending_reports) if ts is not None]
+            if pending:
+                hourly_until = min(hourly_until, min(pending) // hour * hour)
+            if hourly_until > hourly_from:
+                buckets: Dict = {}
+                async with db.execute("""
+                    SELECT admin_user_id, CAST(strftime('%s', check_time) AS INTEGER) AS ts,
+                           current_users, current_total_traffic
+                    FROM usage_reports WHERE check_time >= ? AND check_time < ?
+                """, (_utc_text(hourly_from), _utc_text(hourly_until))) as cursor:
+                    async for row in cursor:
+                        ts = row["ts"]
+                        if ts is None:
+                            continue
+                        _merge_sample(buckets, (row["admin_user_id"], ts // hour * hour), ts,
+                                      row["current_users"] or 0, row["current_total_traffic"] or 0)
+                # Rollups and their watermark commit together, so no hour is ever folded in twice
+                async with self._tx() as db:
+                    await self._write_rollups(db, hourly_table, buckets)
+                    await db.execute(
+                        "INSERT INTO settings (key, value) VALUES ('usage_rollup_hourly_until', ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=CURRENT_TIMESTAMP",
+                        (str(hourly_until),)
+                    )
+                self.invalidate_config_cache("settings")
+                result["hourly_buckets"] = len(buckets)
+            else:
+                hourly_until = hourly_from
+
+            # 2) hourly -> daily
+            daily_table, day = USAGE_ROLLUP_TABLES["daily"]
+            daily_from = int(await self.get_setting("usage_rollup_daily_until") or 0)
+            daily_until = min(now_ts // day * day, hourly_until // day * day)
+            if daily_until > daily_from:
+                buckets = {}
+                async with db.execute(f"""
+                    SELECT * FROM {hourly_table} WHERE bucket >= ? AND bucket < ?
+                """, (daily_from, daily_until)) as cursor:
+                    async for row in cursor:
+                        _merge_sample(buckets, (row["admin_user_id"], row["bucket"] // day * day), row["last_time"],
+                                      row["users_last"], row["traffic_last"], row["samples"],
+                                      row["users_min"], row["users_max"], row["traffic_min"], row["traffic_max"])
+                async with self._tx() as db:
+                    await self._write_rollups(db, daily_table, buckets)
+                    await db.execute(
+                        "INSERT INTO settings (key, value) VALUES ('usage_rollup_daily_until', ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=CURRENT_TIMESTAMP",
+                        (str(daily_until),)
+                    )
+                self.invalidate_config_cache("settings")
+                result["daily_buckets"] = len(buckets)
+            else:
+                daily_until = daily_from
+
+            # 3) retention (never drop rows that have not been rolled up yet)
+            if config.USAGE_RAW_RETENTION_DAYS > 0:
+                raw_cutoff = min(now_ts - config.USAGE_RAW_RETENTION_DAYS * 86400, hourly_until)
+                result["raw_deleted"] = await self._delete_in_chunks(
+                    "DELETE FROM usage_reports WHERE id IN (SELECT id FROM usage_reports WHERE check_time < ? LIMIT ?)",
+                    (_utc_text(raw_cutoff),)
+                )
+            if config.USAGE_HOURLY_RETENTION_DAYS > 0:
+                hourly_cutoff = min(now_ts - config.USAGE_HOURLY_RETENTION_DAYS * 86400, daily_until)
+                result["hourly_deleted"] = await self._delete_in_chunks(
+                    f"DELETE FROM {hourly_table} WHERE (admin_user_id, bucket) IN "
+                    f"(SELECT admin_user_id, bucket FROM {hourly_table} WHERE bucket < ? LIMIT ?)",
+                    (hourly_cutoff,)
+                )
+            if config.USAGE_DAILY_RETENTION_DAYS > 0:
+                daily_cutoff = now_ts - config.USAGE_DAILY_RETENTION_DAYS * 86400
+                result["daily_deleted"] = await self._delete_in_chunks(
+                    f"DELETE FROM {daily_table} WHERE (admin_user_id, bucket) IN "
+                    f"(SELECT admin_user_id, bucket FROM {daily_table} WHERE bucket < ? LIMIT ?)",
+                    (daily_cutoff,)
+                )
+
+            # 4) reclaim space a few pages at a time; never a full VACUUM here
+            if config.USAGE_VACUUM_PAGES > 0:
+                async with self._tx() as db:
+                    async with db.execute("PRAGMA auto_vacuum") as cursor:
+                        mode = (await cursor.fetchone())[0]
+                    if mode == 2:
+                        async with db.execute(f"PRAGMA incremental_vacuum({int(config.USAGE_VACUUM_PAGES)})") as cursor:
+                            await cursor.fetchall()
+                if mode != 2 and not self._vacuum_hint_shown:
+                    self._vacuum_hint_shown = True
+                    print("Database predates incremental auto-vacuum; set USAGE_VACUUM_CONVERT=true to convert it once at startup")
+            return result
+        except Exception as e:
+            print(f"Error compacting usage reports: {e}")
+            return result
+
+    async def convert_to_incremental_vacuum(self) -> bool:
+        """One-time full VACUUM switching an older file to incremental auto-vacuum.
+
+        Rewrites the whole file, so it is only run at startup before polling
+        (USAGE_VACUUM_CONVERT), never from the periodic compaction job.
+        Returns True if a conversion ran.
+        """
+        try:
+            await self.flush_writes()
+            async with self._tx() as db:
+                async with db.execute("PRAGMA auto_vacuum") as cursor:
+                    if (await cursor.fetchone())[0] == 2:
+                        return False
+                print("Converting database to incremental auto-vacuum (one-time VACUUM)...")
+                await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                await db.execute("VACUUM")
+            return True
+        except Exception as e:
+            print(f"Error converting database to incremental auto-vacuum: {e}")
+            return False
+
+    async def get_usage_rollups(self, admin_user_id: int, granularity: str = "hourly", since_ts: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Return hourly or daily usage rollups for an admin, oldest first."""
+        try:
+            table, _ = USAGE_ROLLUP_TABLES[granularity]
+            db = await self._get_conn()
+            async with db.execute(
+                f"SELECT * FROM {table} WHERE admin_user_id = ? AND bucket >= ? ORDER BY bucket ASC",
+                (admin_user_id, since_ts or 0)
+            ) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+        except Exception as e:
+            print(f"Error getting usage rollups: {e}")
+            return []
+
+    async def get_usage_series(self, admin_user_id: int, since_ts: int) -> List[Tuple[int, Optional[int], Optional[int]]]:
+        """(unix time, users, traffic) samples since `since_ts`, oldest first.
+
+        Raw usage_reports are used where they are still kept; older points come
+        from the hourly rollups (last sample of each hour). A raw value that was
+        carried forward rather than measured is returned as None.
+        """
+        try:
+            await self.flush_writes()
+            db = await self._get_conn()
+            points: Dict[int, Tuple[int, int]] = {}
+            hourly_table, _ = USAGE_ROLLUP_TABLES["hourly"]
+            async with db.execute(
+                f"SELECT last_time, users_last, traffic_last FROM {hourly_table} WHERE admin_user_id = ? AND bucket >= ? AND last_time >= ?",
+                (admin_user_id, since_ts - USAGE_ROLLUP_TABLES["hourly"][1], since_ts)
+            ) as cursor:
+                async for row in cursor:
+                    points[row["last_time"]] = (row["users_last"] or 0, row["traffic_last"] or 0)
+            async with db.execute("""
+                SELECT CAST(strftime('%s', check_time) AS INTEGER) AS ts, current_users, current_total_traffic,
+                       users_measured, traffic_measured
+                FROM usage_reports WHERE admin_user_id = ? AND check_time >= ?
+            """, (admin_user_id, _utc_text(since_ts))) as cursor:
+                async for row in cursor:
+                    if row["ts"] is not None:
+                        points[row["ts"]] = (
+                            (row["current_users"] or 0) if row["users_measured"] else None,
+                            (row["current_total_traffic"] or 0) if row["traffic_measured"] else None,
+                        )
+            return [(ts, users, traffic) for ts, (users, traffic) in sorted(points.items())]
+        except Exception as e:
+            print(f"Error getting usage series: {e}")
+            return []
+
     async def add_log(self, log: LogModel) -> bool:
-        """Add log entry."""
+        """Add log entry (buffered; see flush_writes)."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
-                    INSERT INTO logs (admin_user_id, action, details, timestamp)
-                    VALUES (?, ?, ?, ?)
-                """, (log.admin_user_id, log.action, log.details, log.timestamp))
-                await db.commit()
-                return True
+            await self._buffer_write(self._pending_logs, (log.admin_user_id, log.action, log.details, log.timestamp))
+            return True
         except Exception as e:
             print(f"Error adding log: {e}")
             return False
@@ -585,18 +1156,18 @@ class Database:
     async def get_logs(self, admin_user_id: Optional[int] = None, limit: int = 100) -> List[LogModel]:
         """Get logs, optionally filtered by admin."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                if admin_user_id:
-                    query = "SELECT * FROM logs WHERE admin_user_id = ? ORDER BY timestamp DESC LIMIT ?"
-                    params = (admin_user_id, limit)
-                else:
-                    query = "SELECT * FROM logs ORDER BY timestamp DESC LIMIT ?"
-                    params = (limit,)
-                
-                async with db.execute(query, params) as cursor:
-                    rows = await cursor.fetchall()
-                    return [LogModel(**dict(row)) for row in rows]
+            await self.flush_writes()
+            db = await self._get_conn()
+            if admin_user_id:
+                query = "SELECT * FROM logs WHERE admin_user_id = ? ORDER BY timestamp DESC LIMIT ?"
+                params = (admin_user_id, limit)
+            else:
+                query = "SELECT * FROM logs ORDER BY timestamp DESC LIMIT ?"
+                params = (limit,)
+            
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+                return [LogModel(**dict(row)) for row in rows]
         except Exception as e:
             print(f"Error getting logs: {e}")
             return []
@@ -612,7 +1183,7 @@ class Database:
     async def deactivate_admin(self, admin_id: int, reason: str = "Limit exceeded") -> bool:
         """Deactivate admin by admin ID and store original password."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("""
                     UPDATE admins SET 
                         is_active = 0, 
@@ -621,8 +1192,8 @@ class Database:
                         updated_at = CURRENT_TIMESTAMP 
                     WHERE id = ?
                 """, (reason, admin_id))
-                await db.commit()
-                return True
+            await self._refresh_admin(admin_id)
+            return True
         except Exception as e:
             print(f"Error deactivating admin: {e}")
             return False
@@ -630,7 +1201,7 @@ class Database:
     async def deactivate_admin_by_user_id(self, user_id: int, reason: str = "Limit exceeded") -> bool:
         """Deactivate admin by user_id (for backward compatibility)."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("""
                     UPDATE admins SET 
                         is_active = 0, 
@@ -639,8 +1210,8 @@ class Database:
                         updated_at = CURRENT_TIMESTAMP 
                     WHERE user_id = ?
                 """, (reason, user_id))
-                await db.commit()
-                return True
+            await self._refresh_admins_for_user(user_id)
+            return True
         except Exception as e:
             print(f"Error deactivating admin: {e}")
             return False
@@ -648,7 +1219,7 @@ class Database:
     async def reactivate_admin(self, admin_id: int) -> bool:
         """Reactivate admin by admin ID and restore original password."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("""
                     UPDATE admins SET 
                         is_active = 1, 
@@ -657,8 +1228,8 @@ class Database:
                         updated_at = CURRENT_TIMESTAMP 
                     WHERE id = ?
                 """, (admin_id,))
-                await db.commit()
-                return True
+            await self._refresh_admin(admin_id)
+            return True
         except Exception as e:
             print(f"Error reactivating admin: {e}")
             return False
@@ -666,7 +1237,7 @@ class Database:
     async def reactivate_admin_by_user_id(self, user_id: int) -> bool:
         """Reactivate admin by user_id (for backward compatibility)."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("""
                     UPDATE admins SET 
                         is_active = 1, 
@@ -675,8 +1246,8 @@ class Database:
                         updated_at = CURRENT_TIMESTAMP 
                     WHERE user_id = ?
                 """, (user_id,))
-                await db.commit()
-                return True
+            await self._refresh_admins_for_user(user_id)
+            return True
         except Exception as e:
             print(f"Error reactivating admin: {e}")
             return False
@@ -684,64 +1255,191 @@ class Database:
     async def get_deactivated_admins(self) -> List[AdminModel]:
         """Get all deactivated admins."""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM admins WHERE is_active = 0 ORDER BY deactivated_at DESC") as cursor:
-                    rows = await cursor.fetchall()
-                    return [AdminModel(**dict(row)) for row in rows]
+            admins = [admin for admin in (await self._admin_registry()).by_id.values() if not admin.is_active]
+            admins.sort(key=lambda admin: (admin.deactivated_at is not None, admin.deactivated_at or datetime.min), reverse=True)
+            return [admin.model_copy() for admin in admins]
         except Exception as e:
             print(f"Error getting deactivated admins: {e}")
             return []
 
     async def close(self):
-        """Close database connection (placeholder for future connection pooling)."""
-        pass
+        """Flush buffered writes and close the shared database connection."""
+        if self._flush_timer is not None and not self._flush_timer.done():
+            self._flush_timer.cancel()
+        self._flush_timer = None
+        await self.flush_writes()
+        if self._flush_timer is not None:
+            # Flush failed and scheduled a retry; don't let it reopen the connection after close
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        async with self._write_lock:
+            async with self._conn_lock:
+                self.invalidate_config_cache()
+                self._admins.clear()
+                conn, self._conn = self._conn, None
+                if conn is not None:
+                    try:
+                        await conn.close()
+                    except Exception as e:
+                        print(f"Error closing database connection: {e}")
+
+    async def restore_from(self, source_path) -> bool:
+        """Replace the database file with `source_path` (a SQLite file) and reopen it.
+
+        Buffered writes are flushed first; then the write and connection locks
+        are held across checkpoint, close, file swap, reopen and migration, so
+        no query or transaction can reach the old file after it is closed or
+        the new one before it is migrated. The previous file (and any WAL not
+        yet checkpointed) is kept as .bak.
+        Returns False if the file could not be swapped (the old one stays in use).
+        """
+        if self._flush_timer is not None and not self._flush_timer.done():
+            self._flush_timer.cancel()
+        self._flush_timer = None
+        await self.flush_writes()
+        db_path = Path(str(self.db_path)).resolve()
+        backup_old = db_path.with_suffix('.db.bak') if db_path.suffix else Path(str(db_path) + '.bak')
+        async with self._write_lock:
+            async with self._conn_lock:
+                # Detached while both locks are held: new callers of _get_conn
+                # wait for the reopened connection instead of using this one
+                conn, self._conn = self._conn, None
+                if conn is not None:
+                    try:
+                        await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                    except Exception as e:
+                        print(f"Error checkpointing database before restore: {e}")
+                    try:
+                        await conn.close()
+                    except Exception as e:
+                        print(f"Error closing database connection: {e}")
+                self.invalidate_config_cache()
+                self._admins.clear()
+                restored = False
+                try:
+                    if db_path.exists():
+                        db_path.replace(backup_old)
+                    for suffix in ("-wal", "-shm"):
+                        # Keep any un-checkpointed WAL with the .bak file so that copy stays complete
+                        sidecar = Path(str(db_path) + suffix)
+                        if sidecar.exists():
+                            sidecar.replace(Path(str(backup_old) + suffix))
+                    Path(source_path).replace(db_path)
+                    restored = True
+                except Exception as e:
+                    print(f"Error replacing database file: {e}")
+                    if not db_path.exists() and backup_old.exists():
+                        backup_old.replace(db_path)
+                self._conn = await self._open_conn()
+                await self._apply_migrations(self._conn)
+        return restored
+
+    async def checkpoint(self):
+        """Fold the WAL file back into the main database file (e.g. before copying it for a backup)."""
+        try:
+            await self.flush_writes()
+            async with self._tx() as db:
+                await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            print(f"Error checkpointing database: {e}")
+
+    # ===== Configuration cache (settings, plans, cards, forced channels) =====
+    def invalidate_config_cache(self, *names: str):
+        """Drop cached configuration tables (all of them when no names are given)."""
+        for name in names or CONFIG_CACHE_TABLES:
+            setattr(self, f"_{name}_cache", None)
+            self._cache_versions[name] += 1
+
+    def get_cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit/miss counters of the configuration cache, per table."""
+        return {name: dict(counters) for name, counters in self._cache_stats.items()}
+
+    def _cache_hit(self, name: str) -> bool:
+        hit = getattr(self, f"_{name}_cache") is not None
+        self._cache_stats[name]["hits" if hit else "misses"] += 1
+        return hit
+
+    def _store_cache(self, name: str, version: int, value):
+        """Cache a freshly loaded table unless it was invalidated while the SELECT ran."""
+        if self._cache_versions[name] == version:
+            setattr(self, f"_{name}_cache", value)
+        return value
+
+    async def _load_settings(self) -> Dict[str, Optional[str]]:
+        if not self._cache_hit("settings"):
+            version = self._cache_versions["settings"]
+            db = await self._get_conn()
+            async with db.execute("SELECT key, value FROM settings") as cur:
+                rows = await cur.fetchall()
+            return self._store_cache("settings", version, {row["key"]: row["value"] for row in rows})
+        return self._settings_cache
+
+    async def _load_plans(self) -> List[PlanModel]:
+        if not self._cache_hit("plans"):
+            version = self._cache_versions["plans"]
+            db = await self._get_conn()
+            async with db.execute("SELECT * FROM plans") as cursor:
+                rows = await cursor.fetchall()
+            return self._store_cache("plans", version, [PlanModel(**dict(row)) for row in rows])
+        return self._plans_cache
+
+    async def _load_cards(self) -> List[Dict[str, Any]]:
+        if not self._cache_hit("cards"):
+            version = self._cache_versions["cards"]
+            db = await self._get_conn()
+            async with db.execute("SELECT * FROM cards ORDER BY created_at DESC") as cur:
+                rows = await cur.fetchall()
+            return self._store_cache("cards", version, [dict(r) for r in rows])
+        return self._cards_cache
+
+    async def _load_forced_channels(self) -> List[Dict[str, Any]]:
+        if not self._cache_hit("forced_channels"):
+            version = self._cache_versions["forced_channels"]
+            db = await self._get_conn()
+            async with db.execute("SELECT * FROM forced_channels ORDER BY created_at DESC") as cur:
+                rows = await cur.fetchall()
+            return self._store_cache("forced_channels", version, [dict(r) for r in rows])
+        return self._forced_channels_cache
 
     # ===== Plans CRUD =====
     async def add_plan(self, plan: PlanModel) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("""
                     INSERT INTO plans (name, traffic_limit_bytes, time_limit_seconds, max_users, price, is_active, allow_incremental_renewal)
                     VALUES (?, ?, ?, ?, ?, ?, ?)
                 """, (plan.name, plan.traffic_limit_bytes, plan.time_limit_seconds, plan.max_users, plan.price, plan.is_active, 1 if getattr(plan, 'allow_incremental_renewal', True) else 0))
-                await db.commit()
-                return True
+            self.invalidate_config_cache("plans")
+            return True
         except Exception as e:
             print(f"Error adding plan: {e}")
             return False
 
     async def get_plans(self, only_active: bool = False) -> List[PlanModel]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                query = "SELECT * FROM plans"
-                if only_active:
-                    query += " WHERE is_active = 1"
-                async with db.execute(query) as cursor:
-                    rows = await cursor.fetchall()
-                    return [PlanModel(**dict(row)) for row in rows]
+            plans = await self._load_plans()
+            # Copies, so callers can't modify the cached models
+            return [plan.model_copy() for plan in plans if plan.is_active or not only_active]
         except Exception as e:
             print(f"Error getting plans: {e}")
             return []
 
     async def get_plan_by_id(self, plan_id: int) -> Optional[PlanModel]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM plans WHERE id = ?", (plan_id,)) as cursor:
-                    row = await cursor.fetchone()
-                    return PlanModel(**dict(row)) if row else None
+            for plan in await self._load_plans():
+                if plan.id == plan_id:
+                    return plan.model_copy()
+            return None
         except Exception as e:
             print(f"Error getting plan by id: {e}")
             return None
 
     async def delete_plan(self, plan_id: int) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("DELETE FROM plans WHERE id = ?", (plan_id,))
-                await db.commit()
-                return True
+            self.invalidate_config_cache("plans")
+            return True
         except Exception as e:
             print(f"Error deleting plan: {e}")
             return False
@@ -752,10 +1450,10 @@ class Database:
                 return False
             set_clause = ", ".join([f"{k} = ?" for k in kwargs.keys()])
             values = list(kwargs.values()) + [plan_id]
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(f"UPDATE plans SET {set_clause} WHERE id = ?", values)
-                await db.commit()
-                return True
+            self.invalidate_config_cache("plans")
+            return True
         except Exception as e:
             print(f"Error updating plan: {e}")
             return False
@@ -763,44 +1461,43 @@ class Database:
     # ===== Orders CRUD =====
     async def add_order(self, user_id: int, plan_id: int, price_snapshot: int, plan_name_snapshot: str) -> Optional[int]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute(
+            async with self._tx() as db:
+                # Read lastrowid from the INSERT cursor itself: the connection is shared,
+                # so a separate last_insert_rowid() query could see another coroutine's insert
+                cursor = await db.execute(
                     """
                     INSERT INTO orders (user_id, plan_id, status, price_snapshot, plan_name_snapshot)
                     VALUES (?, ?, 'pending', ?, ?)
                     """,
                     (user_id, plan_id, price_snapshot, plan_name_snapshot)
                 )
-                await db.commit()
-                async with db.execute("SELECT last_insert_rowid()") as cur:
-                    row = await cur.fetchone()
-                    return int(row[0]) if row else None
+                order_id = cursor.lastrowid
+                await cursor.close()
+            return int(order_id) if order_id else None
         except Exception as e:
             print(f"Error adding order: {e}")
             return None
 
     async def get_orders(self, status: Optional[str] = None) -> List[Dict[str, Any]]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                if status:
-                    async with db.execute("SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC", (status,)) as cur:
-                        rows = await cur.fetchall()
-                else:
-                    async with db.execute("SELECT * FROM orders ORDER BY created_at DESC") as cur:
-                        rows = await cur.fetchall()
-                return [dict(row) for row in rows]
+            db = await self._get_conn()
+            if status:
+                async with db.execute("SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC", (status,)) as cur:
+                    rows = await cur.fetchall()
+            else:
+                async with db.execute("SELECT * FROM orders ORDER BY created_at DESC") as cur:
+                    rows = await cur.fetchall()
+            return [dict(row) for row in rows]
         except Exception as e:
             print(f"Error getting orders: {e}")
             return []
 
     async def get_order_by_id(self, order_id: int) -> Optional[Dict[str, Any]]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM orders WHERE id = ?", (order_id,)) as cur:
-                    row = await cur.fetchone()
-                    return dict(row) if row else None
+            db = await self._get_conn()
+            async with db.execute("SELECT * FROM orders WHERE id = ?", (order_id,)) as cur:
+                row = await cur.fetchone()
+                return dict(row) if row else None
         except Exception as e:
             print(f"Error getting order: {e}")
             return None
@@ -811,10 +1508,9 @@ class Database:
                 return False
             set_clause = ", ".join([f"{k} = ?" for k in kwargs])
             values = list(kwargs.values()) + [order_id]
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(f"UPDATE orders SET {set_clause}, updated_at = CURRENT_TIMESTAMP WHERE id = ?", values)
-                await db.commit()
-                return True
+            return True
         except Exception as e:
             print(f"Error updating order: {e}")
             return False
@@ -822,7 +1518,7 @@ class Database:
     # ===== Cards CRUD =====
     async def add_card(self, bank_name: str, card_number: str, holder_name: str, is_active: bool = True) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(
                     """
                     INSERT INTO cards (bank_name, card_number, holder_name, is_active)
@@ -830,58 +1526,49 @@ class Database:
                     """,
                     (bank_name, card_number, holder_name, 1 if is_active else 0)
                 )
-                await db.commit()
-                return True
+            self.invalidate_config_cache("cards")
+            return True
         except Exception as e:
             print(f"Error adding card: {e}")
             return False
 
     async def get_cards(self, only_active: bool = False) -> List[Dict[str, Any]]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                query = "SELECT * FROM cards"
-                params: tuple = ()
-                if only_active:
-                    query += " WHERE is_active = 1"
-                query += " ORDER BY created_at DESC"
-                async with db.execute(query, params) as cur:
-                    rows = await cur.fetchall()
-                    return [dict(r) for r in rows]
+            cards = await self._load_cards()
+            return [dict(card) for card in cards if card.get("is_active") or not only_active]
         except Exception as e:
             print(f"Error getting cards: {e}")
             return []
 
     async def get_card_by_id(self, card_id: int) -> Optional[Dict[str, Any]]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT * FROM cards WHERE id = ?", (card_id,)) as cur:
-                    row = await cur.fetchone()
-                    return dict(row) if row else None
+            for card in await self._load_cards():
+                if card.get("id") == card_id:
+                    return dict(card)
+            return None
         except Exception as e:
             print(f"Error getting card by id: {e}")
             return None
 
     async def delete_card(self, card_id: int) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("DELETE FROM cards WHERE id = ?", (card_id,))
-                await db.commit()
-                return True
+            self.invalidate_config_cache("cards")
+            return True
         except Exception as e:
             print(f"Error deleting card: {e}")
             return False
 
     async def set_card_active(self, card_id: int, is_active: bool) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(
                     "UPDATE cards SET is_active = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
                     (1 if is_active else 0, card_id)
                 )
-                await db.commit()
-                return True
+            self.invalidate_config_cache("cards")
+            return True
         except Exception as e:
             print(f"Error updating card status: {e}")
             return False
@@ -889,7 +1576,7 @@ class Database:
     # ===== Settings (key-value) =====
     async def set_setting(self, key: str, value: str) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(
                     """
                     INSERT INTO settings (key, value) VALUES (?, ?)
@@ -897,19 +1584,15 @@ class Database:
                     """,
                     (key, value)
                 )
-                await db.commit()
-                return True
+            self.invalidate_config_cache("settings")
+            return True
         except Exception as e:
             print(f"Error setting setting {key}: {e}")
             return False
 
     async def get_setting(self, key: str) -> Optional[str]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                async with db.execute("SELECT value FROM settings WHERE key = ?", (key,)) as cur:
-                    row = await cur.fetchone()
-                    return row["value"] if row else None
+            return (await self._load_settings()).get(key)
         except Exception as e:
             print(f"Error getting setting {key}: {e}")
             return None
@@ -922,59 +1605,57 @@ class Database:
                 return int(val) if val is not None else default
             except Exception:
                 return default
-        per_gb = _to_int(await self.get_setting("price_per_gb_toman"), 0)
-        per_30d = _to_int(await self.get_setting("price_per_30days_toman"), 0)
-        per_user = _to_int(await self.get_setting("price_per_user_toman"), 0)
+        try:
+            settings = await self._load_settings()
+        except Exception as e:
+            print(f"Error getting billing rates: {e}")
+            settings = {}
+        per_gb = _to_int(settings.get("price_per_gb_toman"), 0)
+        per_30d = _to_int(settings.get("price_per_30days_toman"), 0)
+        per_user = _to_int(settings.get("price_per_user_toman"), 0)
         return {"per_gb_toman": per_gb, "per_30days_toman": per_30d, "per_user_toman": per_user}
 
     # ===== Forced Join Channels CRUD =====
     async def add_forced_channel(self, chat_id: str, title: Optional[str] = None, invite_link: Optional[str] = None, is_active: bool = True) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(
                     "INSERT INTO forced_channels (chat_id, title, invite_link, is_active) VALUES (?, ?, ?, ?)",
                     (chat_id, title, invite_link, 1 if is_active else 0)
                 )
-                await db.commit()
-                return True
+            self.invalidate_config_cache("forced_channels")
+            return True
         except Exception as e:
             print(f"Error adding forced channel: {e}")
             return False
 
     async def get_forced_channels(self, only_active: bool = True) -> List[Dict[str, Any]]:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                query = "SELECT * FROM forced_channels"
-                if only_active:
-                    query += " WHERE is_active = 1"
-                query += " ORDER BY created_at DESC"
-                async with db.execute(query) as cur:
-                    rows = await cur.fetchall()
-                    return [dict(r) for r in rows]
+            channels = await self._load_forced_channels()
+            return [dict(ch) for ch in channels if ch.get("is_active") or not only_active]
         except Exception as e:
             print(f"Error getting forced channels: {e}")
             return []
 
     async def delete_forced_channel(self, channel_id: int) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute("DELETE FROM forced_channels WHERE id = ?", (channel_id,))
-                await db.commit()
-                return True
+            self.invalidate_config_cache("forced_channels")
+            return True
         except Exception as e:
             print(f"Error deleting forced channel: {e}")
             return False
 
     async def set_forced_channel_active(self, channel_id: int, is_active: bool) -> bool:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._tx() as db:
                 await db.execute(
                     "UPDATE forced_channels SET is_active = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
                     (1 if is_active else 0, channel_id)
                 )
-                await db.commit()
-                return True
+            self.invalidate_config_cache("forced_channels")
+            return True
         except Exception as e:
             print(f"Error updating forced channel status: {e}")
             return False
@@ -10,6 +10,7 @@ import config
 from database import db
 from models.schemas import AdminModel, UsageReportModel
 from utils.notify import format_traffic_size, format_time_duration
+from utils.usage_forecast import usage_forecast
 from marzban_api import marzban_api
 from datetime import datetime
 from aiogram.exceptions import TelegramBadRequest
@@ -164,6 +165,12 @@ async def show_admin_info(message_or_callback: Message | CallbackQuery, admin: A
             f"- **ترافیک:** {await format_traffic_size(admin_stats.total_traffic_used)} / {await format_traffic_size(admin.max_total_traffic)} ({traffic_percentage:.1f}%)\n"
             f"- **اعتبار زمانی:** {await format_time_duration(remaining_time_seconds)} مانده ({time_percentage:.1f}%)"
         )
+        await usage_forecast.ensure_loaded(admin)
+        forecast_line = usage_forecast.forecast_text(
+            usage_forecast.forecast(admin, peak_users, admin_stats.total_traffic_used, elapsed_seconds)
+        )
+        if forecast_line:
+            text += f"\n{forecast_line}"
 
     except Exception as e:
         logger.error(f"Error getting info for admin panel {admin.id}: {e}")
@@ -208,7 +215,10 @@ async def show_admin_users(message_or_callback: Message | CallbackQuery, admin:
     """Show user list for a specific admin panel."""
     try:
         admin_api = await marzban_api.create_admin_api(admin.marzban_username, admin.marzban_password)
-        users = await admin_api.get_users()
+        # Only the first 20 users are listed; the rest is just a count from the same request
+        users, total = await admin_api.get_users_page(20)
+        if total is None:
+            total = await admin_api.count_users()
         
         panel_name = admin.admin_name or admin.marzban_username
         
@@ -216,15 +226,15 @@ async def show_admin_users(message_or_callback: Message | CallbackQuery, admin:
             text = f"👥 **لیست کاربران پنل: {panel_name}**\n\n- هیچ کاربری یافت نشد."
         else:
             user_lines = []
-            for user in users[:20]: # Limit to 20 users
+            for user in users:
                 status = "✅" if user.status == 'active' else "❌"
                 used = await format_traffic_size(user.used_traffic)
                 limit = f"/ {await format_traffic_size(user.data_limit)}" if user.data_limit else ""
                 user_lines.append(f"- `{user.username}` {status} ({used}{limit})")
             
             text = f"👥 **لیست کاربران پنل: {panel_name}**\n\n" + "\n".join(user_lines)
-            if len(users) > 20:
-                text += f"\n\n... و {len(users) - 20} کاربر دیگر."
+            if total is not None and total > len(users):
+                text += f"\n\n... و {total - len(users)} کاربر دیگر."
             # Add panel-scoped actions
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text=config.BUTTONS["back"], callback_data="back_to_admin_main")],
@@ -701,13 +711,8 @@ async def perform_cleanup(callback: CallbackQuery, admin: AdminModel):
             )
         except Exception:
             progress_msg = None
-        deleted = 0
-        processed = 0
-        for u in old_expired:
-            ok = await marzban_api.remove_user(u.username)
-            processed += 1
-            if ok:
-                deleted += 1
+
+        async def report_progress(processed: int, deleted: int):
             # Update progress every 25 items or on last
             if progress_msg and (processed % 25 == 0 or processed == candidate_count):
                 try:
@@ -715,10 +720,11 @@ async def perform_cleanup(callback: CallbackQuery, admin: AdminModel):
                         f"⏳ در حال پاکسازی لطفا صبر کنید\nمنقضی‌های ۱۰+ روز...\nکاندید: {candidate_count}\nپردازش‌شده: {processed}\nحذف‌شده: {deleted}"
                     )
                 except TelegramBadRequest as e:
-                    if "message is not modified" in str(e).lower():
-                        pass
-                    else:
+                    if "message is not modified" not in str(e).lower():
                         raise
+
+        results = await marzban_api.remove_users_batch((u.username for u in old_expired), on_progress=report_progress)
+        deleted = sum(1 for ok in results.values() if ok)
         msg = f"✅ {deleted} کاربر قدیمی در همین پنل حذف شد."
     except Exception as e:
         logger.error(f"Error performing cleanup for admin {admin.id}: {e}")
@@ -788,26 +794,20 @@ async def perform_cleanup_small(callback: CallbackQuery, admin: AdminModel):
             )
         except Exception:
             progress_msg = None
-        deleted = 0
-        failed = 0
-        processed = 0
-        for u in to_delete:
-            ok = await marzban_api.remove_user(u.username)
-            processed += 1
-            if ok:
-                deleted += 1
-            else:
-                failed += 1
+
+        async def report_progress(processed: int, deleted: int):
             if progress_msg and (processed % 25 == 0 or processed == candidate_count):
                 try:
                     await progress_msg.edit_text(
-                        f"⏳ در حال پاکسازی لطفا صبر کنید\nساب‌های ≤۱GB...\nکاندید: {candidate_count}\nپردازش‌شده: {processed}\nحذف‌شده: {deleted}\nناموفق: {failed}"
+                        f"⏳ در حال پاکسازی لطفا صبر کنید\nساب‌های ≤۱GB...\nکاندید: {candidate_count}\nپردازش‌شده: {processed}\nحذف‌شده: {deleted}\nناموفق: {processed - deleted}"
                     )
                 except TelegramBadRequest as e:
-                    if "message is not modified" in str(e).lower():
-                        pass
-                    else:
+                    if "message is not modified" not in str(e).lower():
                         raise
+
+        results = await marzban_api.remove_users_batch((u.username for u in to_delete), on_progress=report_progress)
+        deleted = sum(1 for ok in results.values() if ok)
+        failed = len(results) - deleted
         msg = (
             "✅ پاکسازی ساب‌های ≤۱GB تمام‌شده/منقضی در همین پنل انجام شد\n\n"
             f"کاندید: {candidate_count}\n"
@@ -881,14 +881,9 @@ async def perform_reset_traffic(callback: CallbackQuery, admin: AdminModel):
     try:
         admin_api = await marzban_api.create_admin_api(admin.marzban_username, admin.marzban_password)
         users = await admin_api.get_users()
-        reset = 0
-        failed = 0
-        for u in users:
-            ok = await admin_api.reset_user_data_usage(u.username)
-            if ok:
-                reset += 1
-            else:
-                failed += 1
+        results = await marzban_api.reset_users_data_usage_batch(u.username for u in users)
+        reset = sum(1 for ok in results.values() if ok)
+        failed = len(results) - reset
         msg = (
             "✅ ریست ترافیک کاربران پنل انجام شد\n\n"
             f"ریست‌شده: {reset}\n"
@@ -910,7 +905,7 @@ async def perform_reset_time(callback: CallbackQuery, admin: AdminModel):
         # Database-level reset: set created_at = now
         from datetime import datetime as _dt
         now = _dt.utcnow()
-        await db.update_admin(admin.id, created_at=now)
+        await db.update_admin(admin.id, caller="perform_reset_time", created_at=now)
         msg = "✅ زمان مصرف‌شده پنل ریست شد (از الان محاسبه می‌شود)."
     except Exception as e:
         logger.error(f"Error resetting time for admin {admin.id}: {e}")
@@ -1088,14 +1083,9 @@ async def global_cleanup_confirm(callback: CallbackQuery):
     try:
         candidates = await marzban_api.get_users_expired_over_days(None, 10)
         candidate_count = len(candidates)
-        deleted = 0
-        failed = 0
-        for u in candidates:
-            ok = await marzban_api.remove_user(u.username)
-            if ok:
-                deleted += 1
-            else:
-                failed += 1
+        results = await marzban_api.remove_users_batch(u.username for u in candidates)
+        deleted = sum(1 for ok in results.values() if ok)
+        failed = len(results) - deleted
         msg = (
             "✅ پاکسازی منقضی‌های ۱۰+ روز (سراسری) انجام شد\n\n"
             f"کاندید: {candidate_count}\n"
@@ -1126,14 +1116,9 @@ async def global_small_quota_cleanup_confirm(callback: CallbackQuery):
                 time_expired_count += 1
             else:
                 small_quota_finished_count += 1
-        deleted = 0
-        failed = 0
-        for u in to_delete:
-            ok = await marzban_api.remove_user(u.username)
-            if ok:
-                deleted += 1
-            else:
-                failed += 1
+        results = await marzban_api.remove_users_batch(u.username for u in to_delete)
+        deleted = sum(1 for ok in results.values() if ok)
+        failed = len(results) - deleted
         msg = (
             "✅ پاکسازی سراسری ساب‌های ≤۱GB تمام‌شده/منقضی انجام شد\n\n"
             f"کاندید: {candidate_count}\n"
@@ -1,10 +1,11 @@
 from aiogram import Router, F
-from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, Message
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, Message, ChatMemberUpdated
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 import config
 from database import db
 from utils.notify import format_traffic_size, seconds_to_days
+from utils.forced_join import forced_join, status_name
 
 
 public_router = Router()
@@ -122,31 +123,8 @@ async def public_back_main(callback: CallbackQuery):
 
 @public_router.callback_query(F.data == "forced_join_refresh")
 async def forced_join_refresh(callback: CallbackQuery):
-    # Re-run /start-like gate
-    from database import db as _db
-    chans = await _db.get_forced_channels()
-    user_id = callback.from_user.id
-    not_joined = []
-    if chans:
-        for ch in chans:
-            try:
-                raw_chat_id = ch.get('chat_id')
-                chat_id = raw_chat_id
-                if isinstance(raw_chat_id, str) and raw_chat_id.isdigit() and not raw_chat_id.startswith('-100'):
-                    chat_id = f"-100{raw_chat_id}"
-                chat_id_to_use = int(chat_id) if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit() else chat_id
-                member = await callback.bot.get_chat_member(chat_id=chat_id_to_use, user_id=user_id)
-                status = getattr(member, 'status', None)
-                if hasattr(status, 'value'):
-                    s = status.value.lower()
-                elif hasattr(status, 'name'):
-                    s = status.name.lower()
-                else:
-                    s = str(status).lower()
-                if s not in ['member', 'administrator', 'creator']:
-                    not_joined.append(ch)
-            except Exception:
-                not_joined.append(ch)
+    # Re-run /start-like gate; the user asked for a re-check, so bypass cached results
+    not_joined = await forced_join.get_missing_channels(callback.bot, callback.from_user.id, force=True)
     if not not_joined:
         await callback.message.edit_text("✅ عضویت تایید شد. حالا می‌توانید از ربات استفاده کنید.", reply_markup=get_public_main_keyboard())
     else:
@@ -154,6 +132,17 @@ async def forced_join_refresh(callback: CallbackQuery):
     await callback.answer()
 
 
+@public_router.chat_member()
+async def forced_join_member_update(update: ChatMemberUpdated):
+    # Delivered for channels where the bot is admin; keeps the membership cache current
+    forced_join.on_chat_member(
+        update.chat.id,
+        update.chat.username,
+        update.new_chat_member.user.id,
+        status_name(update.new_chat_member),
+    )
+
+
 @public_router.callback_query(F.data.startswith("public_mark_paid_"))
 async def public_mark_paid(callback: CallbackQuery, state: FSMContext):
     order_id = int(callback.data.split("_")[-1])
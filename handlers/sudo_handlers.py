@@ -16,6 +16,7 @@ from utils.notify import (
     gb_to_bytes, days_to_seconds, bytes_to_gb, seconds_to_days,
 )
 from utils.notify import notify_admin_reactivation as notify_admin_reactivation_utils
+from utils.usage_forecast import usage_forecast
 from marzban_api import marzban_api
 from datetime import datetime
 from handlers.admin_handlers import show_cleanup_menu, perform_cleanup
@@ -431,15 +432,20 @@ async def backup_restore_receive(message: Message, state: FSMContext):
             with zf.open(db_member, 'r') as src, open(extract_tmp, 'wb') as dst:
                 dst.write(src.read())
 
-        # Replace existing DB (backup current)
-        db_path = Path(config.DATABASE_PATH).resolve()
-        backup_old = db_path.with_suffix('.db.bak') if db_path.suffix else Path(str(db_path) + '.bak')
+        # Swap the file under the database locks, with monitoring held so no
+        # check runs against the old data or a half-replaced file
+        from scheduler import scheduler
+        if scheduler:
+            scheduler.pause()
         try:
-            if db_path.exists():
-                db_path.replace(backup_old)
-        except Exception:
-            pass
-        extract_tmp.replace(db_path)
+            restored = await db.restore_from(extract_tmp)
+        finally:
+            if scheduler:
+                scheduler.resume()
+        if not restored:
+            await message.answer("❌ خطا در ریستور بکاپ.")
+            await state.clear()
+            return
         await message.answer("✅ ریستور انجام شد. ربات تا چند لحظه دیگر با داده‌های جدید کار می‌کند.")
         await state.clear()
         # Optional: instruct user to restart container/service if needed
@@ -502,10 +508,85 @@ async def sudo_menu_reports(callback: CallbackQuery):
         return
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=config.BUTTONS["list_admins"], callback_data="list_admins"), InlineKeyboardButton(text=config.BUTTONS["admin_status"], callback_data="admin_status")],
+        [InlineKeyboardButton(text=config.BUTTONS["api_health"], callback_data="api_health"), InlineKeyboardButton(text=config.BUTTONS["admin_audit"], callback_data="admin_audit")],
         [InlineKeyboardButton(text=config.BUTTONS["back"], callback_data="back_to_main")]
     ])
     await callback.message.edit_text("📊 گزارشات:", reply_markup=kb)
     await callback.answer()
+
+@sudo_router.callback_query(F.data == "admin_audit")
+async def admin_audit_report(callback: CallbackQuery):
+    """Latest panel time/creation-date changes recorded by the admin_audit triggers."""
+    if callback.from_user.id not in config.SUDO_ADMINS:
+        await callback.answer("غیرمجاز", show_alert=True)
+        return
+    entries = await db.get_admin_audit(limit=20)
+    field_names = {"max_total_time": "مدت اعتبار", "created_at": "تاریخ شروع"}
+    lines = ["🧾 تاریخچه تغییرات پنل‌ها (۲۰ مورد آخر)", ""]
+    if not entries:
+        lines.append("هیچ تغییری ثبت نشده است.")
+    for entry in entries:
+        admin = await db.get_admin_by_id(entry.admin_id)
+        panel = (admin.admin_name or admin.marzban_username) if admin else f"پنل حذف‌شده #{entry.admin_id}"
+        old_value, new_value = entry.old_value or "-", entry.new_value or "-"
+        if entry.field == "max_total_time":
+            try:
+                old_value = await format_time_duration(int(old_value)) if entry.old_value else "-"
+                new_value = await format_time_duration(int(new_value)) if entry.new_value else "-"
+            except ValueError:
+                pass
+        when = entry.changed_at.strftime('%Y-%m-%d %H:%M') if entry.changed_at else "-"
+        caller = f" ({entry.caller})" if entry.caller else ""
+        lines.append(f"• {when} | {panel} (کاربر {entry.admin_user_id}): {field_names.get(entry.field, entry.field)} از {old_value} به {new_value}{caller}")
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 به‌روزرسانی", callback_data="admin_audit")],
+        [InlineKeyboardButton(text=config.BUTTONS["back"], callback_data="sudo_menu_reports")]
+    ])
+    try:
+        await callback.message.edit_text("\n".join(lines), reply_markup=kb)
+    except Exception:
+        pass  # unchanged text on refresh
+    await callback.answer()
+
+@sudo_router.callback_query(F.data == "api_health")
+async def api_health_status(callback: CallbackQuery):
+    if callback.from_user.id not in config.SUDO_ADMINS:
+        await callback.answer("غیرمجاز", show_alert=True)
+        return
+    from utils.api_health import api_health
+    h = api_health.snapshot()
+    state_text = {"closed": "🟢 سالم", "half_open": "🟡 در حال بررسی بازیابی", "open": "🔴 قطع (درخواست‌ها فوراً رد می‌شوند)"}.get(h["state"], h["state"])
+    lines = [
+        "🩺 سلامت اتصال مرزبان",
+        "",
+        f"وضعیت: {state_text}",
+        f"حد درخواست هم‌زمان: {h['limit']}/{h['max_limit']} (در جریان: {h['in_flight']})",
+        f"میانگین زمان پاسخ: {h['latency_ms']} ms",
+        f"خطاهای پشت‌سرهم: {h['consecutive_failures']}",
+        f"کل درخواست‌ها: {h['requests']} | خطا: {h['failures']} | تکرار: {h['retries']} | ردشده: {h['rejected']}",
+    ]
+    if h["state"] == "open":
+        lines.append(f"بررسی مجدد تا {h['retry_in']} ثانیه دیگر")
+    from marzban_api import get_coalescing_stats
+    flights = get_coalescing_stats()
+    saved = sum(f["saved"] for f in flights.values())
+    started = sum(f["calls"] for f in flights.values())
+    lines.append(f"درخواست‌های تکراری ادغام‌شده: {saved} (از {saved + started} فراخوانی)")
+    cache_parts = []
+    for table, counters in db.get_cache_stats().items():
+        reads = counters["hits"] + counters["misses"]
+        rate = f"{counters['hits'] * 100 // reads}%" if reads else "-"
+        cache_parts.append(f"{table}: {rate}")
+    lines.append(f"نرخ برخورد کش تنظیمات: {' | '.join(cache_parts)}")
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 به‌روزرسانی", callback_data="api_health")],
+        [InlineKeyboardButton(text=config.BUTTONS["back"], callback_data="sudo_menu_reports")]
+    ])
+    try:
+        await callback.message.edit_text("\n".join(lines), reply_markup=kb)
+    except Exception:
+        pass  # unchanged text on refresh
+    await callback.answer()
 @sudo_router.callback_query(F.data == "forced_join_manage")
 async def forced_join_manage(callback: CallbackQuery):
     if callback.from_user.id not in config.SUDO_ADMINS:
@@ -827,13 +908,10 @@ async def sudo_non_payer_confirm(callback: CallbackQuery):
                     # اگر احراز هویت پنل شکست خورد، با اکانت اصلی لیست کاربران را بگیر
                     logger.warning(f"Non-payer: falling back to main API for users of {admin.marzban_username}: {e}")
                     users = await marzban_api.get_admin_users(admin.marzban_username)
-                for u in users:
-                    status = (u.status or "").lower()
-                    if status != "disabled":
-                        ok = await marzban_api.modify_user(u.username, {"status": "disabled"})
-                        if ok:
-                            disabled += 1
-                        await asyncio.sleep(0.1)
+                results = await marzban_api.disable_users_batch(
+                    u.username for u in users if (u.status or "").lower() != "disabled"
+                )
+                disabled = sum(1 for ok in results.values() if ok)
         except Exception as e:
             logger.error(f"Non-payer: error disabling users for admin {admin.id}: {e}")
         
@@ -2004,6 +2082,7 @@ async def confirm_edit_panel(callback: CallbackQuery, state: FSMContext):
         # Update in database
         success = await db.update_admin(
             admin_id, 
+            caller="confirm_edit_panel",
             max_total_traffic=max_total_traffic,
             max_total_time=max_total_time
         )
@@ -2152,6 +2231,12 @@ async def get_admin_status_text() -> str:
                         pass
                     text += f"      📊 ترافیک: {await format_traffic_size(admin_stats.total_traffic_used)}/{await format_traffic_size(admin.max_total_traffic)} ({traffic_percentage:.1f}%)\n"
                     text += f"      ⏱️ زمان: {await format_time_duration(int(elapsed_seconds))}/{await format_time_duration(admin.max_total_time)} ({time_percentage:.1f}%)\n"
+                    await usage_forecast.ensure_loaded(admin)
+                    forecast_line = usage_forecast.forecast_text(
+                        usage_forecast.forecast(admin, peak_users, admin_stats.total_traffic_used, elapsed_seconds)
+                    )
+                    if forecast_line:
+                        text += f"      {forecast_line}\n"
                     
                     # Show warning if approaching limits
                     if any(p >= 80 for p in [user_percentage, traffic_percentage, time_percentage]):
@@ -2526,14 +2611,11 @@ async def reactivate_admin_users(admin_user_id: int) -> bool:
         admin_api = await marzban_api.create_admin_api(admin.marzban_username, admin.marzban_password)
         users = await admin_api.get_users()
         
-        reactivated_count = 0
-        for user in users:
-            # Reactivate any user that is not already active (e.g., disabled/limited)
-            status_value = (user.status or "").lower()
-            if status_value != "active":
-                success = await marzban_api.modify_user(user.username, {"status": "active"})
-                if success:
-                    reactivated_count += 1
+        # Reactivate any user that is not already active (e.g., disabled/limited)
+        results = await marzban_api.enable_users_batch(
+            user.username for user in users if (user.status or "").lower() != "active"
+        )
+        reactivated_count = sum(1 for ok in results.values() if ok)
         
         logger.info(f"Reactivated {reactivated_count} users for admin {admin_user_id}")
         return True
@@ -2565,17 +2647,10 @@ async def reactivate_admin_panel_users(admin_id: int) -> int:
                 logger.error(f"reactivate_admin_panel_users: main API fallback failed for {admin.marzban_username}: {e2}")
                 users = []
         
-        reactivated_count = 0
-        for user in users:
-            status_value = (user.status or "").lower()
-            if status_value != "active":
-                try:
-                    success = await marzban_api.modify_user(user.username, {"status": "active"})
-                    if success:
-                        reactivated_count += 1
-                    await asyncio.sleep(0.1)  # Rate limiting
-                except Exception as e:
-                    logger.warning(f"Failed to reactivate user {user.username}: {e}")
+        results = await marzban_api.enable_users_batch(
+            user.username for user in users if (user.status or "").lower() != "active"
+        )
+        reactivated_count = sum(1 for ok in results.values() if ok)
         
         logger.info(f"Reactivated {reactivated_count} users for admin panel {admin_id}")
         return reactivated_count
@@ -2618,25 +2693,19 @@ async def deactivate_admin_and_users(admin_user_id: int, reason: str = "Limit ex
                 # Create admin API with current credentials
                 admin_api = await marzban_api.create_admin_api(admin.marzban_username, admin.marzban_password)
                 users = await admin_api.get_users()
-                
-                for user in users:
-                    if user.status == "active":
-                        # Use modifyUser API to disable user
-                        success = await marzban_api.modify_user(user.username, {"status": "disabled"})
-                        if success:
-                            disabled_count += 1
-                        await asyncio.sleep(0.1)  # Rate limiting
+                results = await marzban_api.disable_users_batch(
+                    user.username for user in users if user.status == "active"
+                )
+                disabled_count = sum(1 for ok in results.values() if ok)
                         
             except Exception as e:
                 print(f"Error disabling users for admin {admin.marzban_username}: {e}")
                 # Fallback: try using main admin credentials
                 users = await marzban_api.get_admin_users(admin.marzban_username)
-                for user in users:
-                    if user.status == "active":
-                        success = await marzban_api.disable_user(user.username)
-                        if success:
-                            disabled_count += 1
-                        await asyncio.sleep(0.1)
+                results = await marzban_api.disable_users_batch(
+                    user.username for user in users if user.status == "active"
+                )
+                disabled_count = sum(1 for ok in results.values() if ok)
             
             logger.info(f"Disabled {disabled_count} users for deactivated admin {admin.id} ({admin.marzban_username})")
         
@@ -2664,7 +2733,7 @@ async def delete_admin_panel_completely(admin_id: int, reason: str = "غیرفع
         
         # Store details for logging
         admin_username = admin.marzban_username
-        user_count = 0
+        user_count = None
         
         # Step 1: Completely delete admin and all users from Marzban panel
         if admin.marzban_username:
@@ -2672,14 +2741,13 @@ async def delete_admin_panel_completely(admin_id: int, reason: str = "غیرفع
                 # Get user count before deletion for logging
                 if admin.marzban_password:
                     admin_api = await marzban_api.create_admin_api(admin.marzban_username, admin.marzban_password)
-                    users = await admin_api.get_users()
-                    user_count = len(users)
+                    user_count = await admin_api.count_users()
                 
                 # Completely delete admin and all users from Marzban
                 marzban_success = await marzban_api.delete_admin_completely(admin.marzban_username)
                 
                 if marzban_success:
-                    logger.info(f"Admin {admin.marzban_username} and {user_count} users deleted from Marzban")
+                    logger.info(f"Admin {admin.marzban_username} and {user_count if user_count is not None else 'unknown number of'} users deleted from Marzban")
                 else:
                     logger.warning(f"Failed to delete admin {admin.marzban_username} from Marzban")
                     
@@ -2698,7 +2766,7 @@ async def delete_admin_panel_completely(admin_id: int, reason: str = "غیرفع
             log = LogModel(
                 admin_user_id=admin.user_id,
                 action="admin_panel_completely_deleted",
-                details=f"Admin panel {admin_id} ({admin_username}) and {user_count} users completely deleted. Reason: {reason}. Deleted from both Marzban and database."
+                details=f"Admin panel {admin_id} ({admin_username}) and {user_count if user_count is not None else 'unknown number of'} users completely deleted. Reason: {reason}. Deleted from both Marzban and database."
             )
             await db.add_log(log)
             
@@ -2752,25 +2820,19 @@ async def deactivate_admin_panel_by_id(admin_id: int, reason: str = "Limit excee
                 # Create admin API with current credentials
                 admin_api = await marzban_api.create_admin_api(admin.marzban_username, admin_password_to_use)
                 users = await admin_api.get_users()
-                
-                for user in users:
-                    if user.status == "active":
-                        # Use modifyUser API to disable user
-                        success = await marzban_api.modify_user(user.username, {"status": "disabled"})
-                        if success:
-                            disabled_count += 1
-                        await asyncio.sleep(0.1)  # Rate limiting
+                results = await marzban_api.disable_users_batch(
+                    user.username for user in users if user.status == "active"
+                )
+                disabled_count = sum(1 for ok in results.values() if ok)
                         
             except Exception as e:
                 print(f"Error disabling users for admin {admin.marzban_username}: {e}")
                 # Fallback: try using main admin credentials
                 users = await marzban_api.get_admin_users(admin.marzban_username)
-                for user in users:
-                    if user.status == "active":
-                        success = await marzban_api.disable_user(user.username)
-                        if success:
-                            disabled_count += 1
-                        await asyncio.sleep(0.1)
+                results = await marzban_api.disable_users_batch(
+                    user.username for user in users if user.status == "active"
+                )
+                disabled_count = sum(1 for ok in results.values() if ok)
             
             logger.info(f"Disabled {disabled_count} users for deactivated admin panel {admin.id} ({admin.marzban_username})")
         
@@ -3086,7 +3148,7 @@ async def manage_action_reset_time(callback: CallbackQuery):
     admin = await db.get_admin_by_id(admin_id)
     from datetime import datetime as _dt
     try:
-        await db.update_admin(admin.id, created_at=_dt.utcnow())
+        await db.update_admin(admin.id, caller="manage_action_reset_time", created_at=_dt.utcnow())
         text = "✅ زمان مصرف‌شده پنل ریست شد."
     except Exception as e:
         text = f"❌ خطا در ریست زمان: {e}"
@@ -3107,12 +3169,9 @@ async def manage_action_reset_traffic(callback: CallbackQuery):
         if admin.marzban_username and admin.marzban_password:
             admin_api = await marzban_api.create_admin_api(admin.marzban_username, admin.marzban_password)
             users = await admin_api.get_users()
-            for u in users:
-                ok = await admin_api.reset_user_data_usage(u.username)
-                if ok:
-                    reset += 1
-                else:
-                    failed += 1
+            results = await marzban_api.reset_users_data_usage_batch(u.username for u in users)
+            reset = sum(1 for ok in results.values() if ok)
+            failed = len(results) - reset
         text = (
             "✅ ریست ترافیک انجام شد\n\n"
             f"ریست‌شده: {reset}\n"
@@ -3136,10 +3195,12 @@ async def manage_action_users(callback: CallbackQuery):
         active = 0
         if admin.marzban_username and admin.marzban_password:
             admin_api = await marzban_api.create_admin_api(admin.marzban_username, admin.marzban_password)
-            users = await admin_api.get_users()
-            total = len(users)
-            active = len([u for u in users if (u.status or '').lower() == 'active'])
-        text = f"👥 تعداد کاربران: {total} (فعال: {active})"
+            total, active = await asyncio.gather(admin_api.count_users(), admin_api.count_users(status="active"))
+        if total is None or active is None:
+            # The panel did not answer; a count of 0 here would be misleading
+            text = "❌ خطا در دریافت تعداد کاربران از مرزبان"
+        else:
+            text = f"👥 تعداد کاربران: {total} (فعال: {active})"
     except Exception as e:
         text = f"❌ خطا در دریافت کاربران: {e}"
     await callback.message.edit_text(text, reply_markup=_manage_back_keyboard(admin_id))
@@ -3409,7 +3470,7 @@ async def order_approve(callback: CallbackQuery):
         if not new_fields:
             await callback.answer("مقادیر تمدید نامعتبر است.", show_alert=True)
             return
-        ok_update = await db.update_admin(admin.id, **new_fields)
+        ok_update = await db.update_admin(admin.id, caller="order_approve", **new_fields)
         if not ok_update:
             await callback.answer("خطا در اعمال تمدید.", show_alert=True)
             return
@@ -221,6 +221,12 @@ async def main():
         print_error_with_solution("api_connection_error", "api_connection_solution", str(e))
         results.append(("Marzban API", False))
     
+    try:
+        from database import db
+        await db.close()
+    except Exception:
+        pass
+
     # Summary
     print_header(HEALTH_MESSAGES["summary"])
     
@@ -1,9 +1,23 @@
 import httpx
 import asyncio
-from typing import List, Optional, Dict, Any, Union, Tuple
+import base64
+import hashlib
+import json
+import random
+import time
+from typing import List, Optional, Dict, Any, Union, Tuple, Iterable, Callable, Awaitable, Sequence
 from datetime import datetime
 import config
-from models.schemas import MarzbanUserModel, AdminStatsModel
+from models.schemas import MarzbanUserModel, AdminStatsModel, UserRecord
+from utils.user_batch import (
+    UserBatch,
+    compute_admin_stats,
+    compute_admin_stats_by_admin,
+    select_expired_before,
+    select_small_quota_finished,
+)
+from utils.api_health import api_health, CircuitOpenError, GuardedTransport, TokenBucket
+from utils.singleflight import SingleFlight, freeze
 
 
 def safe_extract_username(value: Union[str, Dict[str, Any], None]) -> Optional[str]:
@@ -30,6 +44,443 @@ def safe_extract_username(value: Union[str, Dict[str, Any], None]) -> Optional[s
         return str(value) if value else None
 
 
+def _as_int(value: Any, default: Optional[int] = None) -> Optional[int]:
+    if value is None:
+        return default
+    if type(value) is int:
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_user_records(rows: Iterable[Dict[str, Any]]) -> List[UserRecord]:
+    """Build UserRecord objects straight from /api/users JSON rows (no pydantic validation).
+
+    Rows without a usable username are skipped; numeric fields that can't be
+    read fall back to 0 (traffic) or None (limit/expire).
+    """
+    records: List[UserRecord] = []
+    append = records.append
+    for row in rows:
+        if not isinstance(row, dict):
+            continue
+        username = row.get("username")
+        if not isinstance(username, str):
+            username = safe_extract_username(username)
+        if not username:
+            continue
+        admin = row.get("admin")
+        if admin is not None and not isinstance(admin, str):
+            admin = safe_extract_username(admin)
+        append(UserRecord(
+            username,
+            row.get("status") or "",
+            _as_int(row.get("used_traffic"), 0),
+            _as_int(row.get("lifetime_used_traffic"), 0),
+            _as_int(row.get("data_limit")),
+            _as_int(row.get("expire")),
+            admin,
+        ))
+    return records
+
+
+def records_to_models(records: Iterable[UserRecord]) -> List[MarzbanUserModel]:
+    """Validate records into MarzbanUserModel objects, skipping rows that fail validation."""
+    users: List[MarzbanUserModel] = []
+    for record in records:
+        try:
+            users.append(record.to_model())
+        except Exception as e:
+            print(f"Error parsing user data: {e}")
+    return users
+
+
+# Shared HTTP client (one connection pool for the main API and every admin API)
+_http_client: Optional[httpx.AsyncClient] = None
+
+# Concurrent identical reads (same URL, params and admin identity) share one in-flight call
+_get_flight = SingleFlight("GET requests")
+_listing_flight = SingleFlight("user listings")
+
+
+def get_coalescing_stats() -> Dict[str, Dict[str, int]]:
+    """How many Marzban calls were started vs. served from an identical in-flight call."""
+    return {flight.name: flight.stats() for flight in (_get_flight, _listing_flight)}
+
+
+def _http2_available() -> bool:
+    """Return True if HTTP/2 is requested and the optional `h2` package is installed."""
+    if not config.HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        print("HTTP2_ENABLED is set but the 'h2' package is not installed; falling back to HTTP/1.1")
+        return False
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the process-wide pooled HTTP client, creating it on first use.
+
+    Connections are kept alive between calls so repeated requests to the same
+    Marzban panel reuse the TCP/TLS session instead of handshaking every time.
+    Every request goes through `api_health` (global request rate budget,
+    adaptive concurrency limit and circuit breaker), so an unhealthy panel
+    makes callers fail fast.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        transport = httpx.AsyncHTTPTransport(
+            http2=_http2_available(),
+            limits=httpx.Limits(
+                max_connections=config.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _http_client = httpx.AsyncClient(
+            timeout=config.API_TIMEOUT,
+            transport=GuardedTransport(transport, api_health),
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """Close the shared HTTP client and release pooled connections."""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+
+
+class UserListingError(Exception):
+    """A paginated user listing could not be fetched completely."""
+
+
+async def fetch_user_pages(
+    request,
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    *,
+    page_size: Optional[int] = None,
+    max_concurrency: Optional[int] = None,
+    label: str = "users",
+) -> List[Dict[str, Any]]:
+    """Fetch every row of a paginated `/api/users` listing and return the raw dicts.
+
+    The first page is fetched on its own; if the server reports a `total`, the
+    remaining offsets are requested concurrently (at most `max_concurrency` at
+    a time) and stitched back together in offset order. Servers that do not
+    report a total are walked page by page until a short page is returned.
+
+    Args:
+        request: Bound `_request` coroutine of an API object (handles auth/401 retry)
+        url: Listing endpoint URL
+        params: Extra query parameters (admin, status, expired, ...)
+        page_size: Rows per page (defaults to config.USERS_PAGE_SIZE)
+        max_concurrency: Max in-flight page requests (defaults to config.USERS_FETCH_CONCURRENCY)
+        label: Name used in log messages
+
+    Raises UserListingError if any page fails, so callers take their error
+    path instead of working with an incomplete list.
+    """
+    limit = max(1, int(page_size or config.USERS_PAGE_SIZE))
+    concurrency = max(1, int(max_concurrency or config.USERS_FETCH_CONCURRENCY))
+    base_params: Dict[str, Any] = dict(params or {})
+
+    async def fetch_page(offset: int) -> Tuple[Optional[List[Dict[str, Any]]], Optional[int]]:
+        response = await request("GET", url, params={**base_params, "limit": limit, "offset": offset})
+        if response.status_code != 200:
+            print(f"Failed to get {label} (offset {offset}): {response.status_code} - {response.text}")
+            return None, None
+        data = response.json()
+        batch = data.get("users", []) if isinstance(data, dict) else (data if isinstance(data, list) else [])
+        total = data.get("total") if isinstance(data, dict) else None
+        return batch, (total if isinstance(total, int) else None)
+
+    first_batch, total = await fetch_page(0)
+    if first_batch is None:
+        raise UserListingError(f"{label}: first page failed")
+    rows: List[Dict[str, Any]] = list(first_batch)
+    if len(first_batch) < limit:
+        return rows
+
+    if total is None:
+        # Fallback for servers that don't report a total: walk pages in series
+        offset = limit
+        while True:
+            batch, _ = await fetch_page(offset)
+            if batch is None:
+                raise UserListingError(f"{label}: page at offset {offset} failed")
+            if not batch:
+                break
+            rows.extend(batch)
+            if len(batch) < limit:
+                break
+            offset += limit
+        return rows
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_bounded(offset: int) -> List[Dict[str, Any]]:
+        async with semaphore:
+            batch, _ = await fetch_page(offset)
+            if batch is None:
+                raise UserListingError(f"{label}: page at offset {offset} failed")
+            return batch
+
+    # Any failed page fails the whole listing: a partial list would undercount users and traffic
+    pages = await asyncio.gather(*(fetch_bounded(offset) for offset in range(limit, total, limit)))
+    for batch in pages:
+        rows.extend(batch)
+    return rows
+
+
+async def fetch_first_page(
+    request,
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    limit: int = 1,
+    label: str = "users",
+) -> Tuple[Optional[List[Dict[str, Any]]], Optional[int]]:
+    """Fetch only the first `limit` rows of a `/api/users` listing plus the server's `total`.
+
+    Returns (None, None) if the request failed, so callers can tell a failure
+    (rows is None) from a successful page without a `total` (rows is a list,
+    total is None).
+    """
+    try:
+        response = await request("GET", url, params={**(params or {}), "limit": limit, "offset": 0})
+        if response.status_code != 200:
+            print(f"Failed to get {label}: {response.status_code} - {response.text}")
+            return None, None
+        data = response.json()
+    except Exception as e:
+        print(f"Error getting {label}: {e}")
+        return None, None
+    rows = data.get("users", []) if isinstance(data, dict) else (data if isinstance(data, list) else [])
+    total = data.get("total") if isinstance(data, dict) else None
+    return rows, (total if isinstance(total, int) else None)
+
+
+def _matches_filters(user: Union[Dict[str, Any], UserRecord], filters: Dict[str, Any]) -> bool:
+    """Client-side equivalent of simple equality query filters (used when counting without `total`)."""
+    get = user.get if isinstance(user, dict) else (lambda key: getattr(user, key, None))
+    return all(get(key) == value for key, value in filters.items())
+
+
+def _is_retryable_status(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+async def run_bulk_user_operation(
+    request,
+    method: str,
+    url_template: str,
+    usernames: Iterable[str],
+    *,
+    json: Optional[Dict[str, Any]] = None,
+    success_codes: Tuple[int, ...] = (200,),
+    concurrency: Optional[int] = None,
+    rate: Optional[float] = None,
+    max_retries: Optional[int] = None,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+    label: str = "update",
+) -> Dict[str, bool]:
+    """Apply the same per-user request to many users and return {username: success}.
+
+    Up to `concurrency` requests are in flight at once and new requests are
+    started no faster than `rate` per second (token bucket). Responses with
+    429 or 5xx and transport errors are retried up to `max_retries` times with
+    exponential backoff (honouring Retry-After); other failures are final.
+
+    Args:
+        request: Bound `_request` coroutine of an API object (handles auth/401 retry)
+        method: HTTP method (PUT, DELETE, POST, ...)
+        url_template: Endpoint URL containing a `{username}` placeholder
+        usernames: Users to operate on (duplicates and empty names are skipped)
+        json: Request body sent for every user
+        success_codes: Status codes counted as success
+        concurrency: Max in-flight requests (defaults to config.BULK_CONCURRENCY)
+        rate: Max requests started per second, 0 = unlimited (defaults to config.BULK_RATE_LIMIT)
+        max_retries: Retries for 429/5xx/transport errors (defaults to config.MAX_RETRIES)
+        on_progress: Optional coroutine called as on_progress(processed, succeeded) after each user
+        label: Name used in log messages
+    """
+    names = list(dict.fromkeys(u for u in usernames if u))
+    if not names:
+        return {}
+    workers = max(1, min(int(concurrency or config.BULK_CONCURRENCY), len(names)))
+    rate_value = config.BULK_RATE_LIMIT if rate is None else rate
+    bucket = TokenBucket(rate_value) if rate_value and rate_value > 0 else None
+    retries = max(0, int(config.MAX_RETRIES if max_retries is None else max_retries))
+
+    results: Dict[str, bool] = {}
+    succeeded = 0
+    queue: asyncio.Queue = asyncio.Queue()
+    for name in names:
+        queue.put_nowait(name)
+
+    async def apply(username: str) -> bool:
+        url = url_template.replace("{username}", username)
+        for attempt in range(retries + 1):
+            if bucket is not None:
+                await bucket.acquire()
+            delay = config.BULK_RETRY_BACKOFF * (2 ** attempt)
+            try:
+                response = await request(method, url, json=json)
+            except CircuitOpenError as e:
+                # Panel is unhealthy; retrying here would only queue behind the breaker
+                print(f"Bulk {label} skipped for {username}: {e}")
+                return False
+            except httpx.TransportError as e:
+                if attempt >= retries:
+                    print(f"Bulk {label} failed for {username}: {type(e).__name__}: {e}")
+                    return False
+            else:
+                if response.status_code in success_codes:
+                    return True
+                if not _is_retryable_status(response.status_code) or attempt >= retries:
+                    print(f"Bulk {label} failed for {username}: HTTP {response.status_code} - {response.text}")
+                    return False
+                try:
+                    delay = max(delay, float(response.headers.get("Retry-After", 0)))
+                except ValueError:
+                    pass
+            await asyncio.sleep(min(delay, 30.0) * random.uniform(0.8, 1.2))
+        return False
+
+    async def worker():
+        nonlocal succeeded
+        while True:
+            try:
+                username = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                ok = await apply(username)
+            except Exception as e:
+                print(f"Bulk {label} error for {username}: {e}")
+                ok = False
+            results[username] = ok
+            if ok:
+                succeeded += 1
+            if on_progress is not None:
+                try:
+                    await on_progress(len(results), succeeded)
+                except Exception as e:
+                    print(f"Bulk {label} progress callback failed: {e}")
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    print(f"Bulk {label}: {succeeded}/{len(names)} succeeded")
+    return {name: results.get(name, False) for name in names}
+
+
+def build_admin_stats(admin_users: Sequence[Union[MarzbanUserModel, UserRecord]]) -> AdminStatsModel:
+    """Aggregate an admin's user list into an AdminStatsModel (counts, breakdowns and traffic)."""
+    return compute_admin_stats(UserBatch(admin_users))
+
+
+def _jwt_expiry(token: str) -> Optional[float]:
+    """Return the `exp` claim of a JWT as a unix timestamp, or None if it can't be read."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload.encode())).get("exp")
+        return float(exp) if exp is not None else None
+    except Exception:
+        return None
+
+
+class TokenSession:
+    """Access token for one Marzban account, shared by every API object using those credentials.
+
+    The token is reused until shortly before its JWT `exp` (config.TOKEN_REFRESH_MARGIN),
+    and concurrent callers that need a fresh token wait on a single in-flight login
+    instead of each POSTing to /api/admin/token.
+    """
+
+    def __init__(self, base_url: str, username: str, password: str):
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.token: Optional[str] = None
+        self.expires_at: Optional[float] = None
+        self.logins = 0
+        self._login_task: Optional[asyncio.Task] = None
+
+    def is_fresh(self) -> bool:
+        if not self.token:
+            return False
+        return self.expires_at is None or time.time() < self.expires_at - config.TOKEN_REFRESH_MARGIN
+
+    def invalidate(self, token: Optional[str] = None):
+        """Drop the cached token (only if it is still `token`, when given)."""
+        if token is None or token == self.token:
+            self.token = None
+            self.expires_at = None
+
+    async def get_token(self, force: bool = False) -> Optional[str]:
+        """Return a valid token, logging in only when the cached one is missing or about to expire."""
+        if not force and self.is_fresh():
+            return self.token
+        if self._login_task is None or self._login_task.done():
+            self._login_task = asyncio.ensure_future(self._login())
+        return await asyncio.shield(self._login_task)
+
+    async def _login(self) -> Optional[str]:
+        try:
+            client = get_http_client()
+            response = await client.post(
+                f"{self.base_url}/api/admin/token",
+                data={
+                    "username": self.username,
+                    "password": self.password
+                }
+            )
+            self.logins += 1
+
+            if response.status_code == 200:
+                data = response.json()
+                token = data.get("access_token")
+                self.token = token
+                if token:
+                    self.expires_at = _jwt_expiry(token) or (time.time() + config.TOKEN_FALLBACK_TTL)
+                return token
+            else:
+                print(f"Failed to get token for {self.username}: {response.status_code} - {response.text}")
+                self.invalidate()
+                return None
+
+        except Exception as e:
+            print(f"Error getting token for {self.username}: {e}")
+            return None
+
+
+# Process-wide token sessions keyed by (panel URL, username, password hash)
+_token_sessions: Dict[Tuple[str, str, str], TokenSession] = {}
+
+
+def get_token_session(base_url: str, username: str, password: str) -> TokenSession:
+    """Return the shared TokenSession for these credentials, creating it on first use.
+
+    Sessions for the same account with an old password are dropped, so a
+    password change never keeps serving a token issued for the previous one.
+    """
+    password_hash = hashlib.sha256((password or "").encode()).hexdigest()
+    key = (base_url, username, password_hash)
+    session = _token_sessions.get(key)
+    if session is None:
+        for stale in [k for k in _token_sessions if k[0] == base_url and k[1] == username]:
+            del _token_sessions[stale]
+        session = TokenSession(base_url, username, password)
+        _token_sessions[key] = session
+    return session
+
+
 class MarzbanAdminAPI:
     """API class for individual admin authentication."""
     
@@ -37,114 +488,117 @@ class MarzbanAdminAPI:
         self.base_url = marzban_url.rstrip('/')
         self.username = admin_username
         self.password = admin_password
-        self.token = None
-        self.token_expires = None
+        self.session = get_token_session(self.base_url, admin_username, admin_password)
+
+    @property
+    def token(self) -> Optional[str]:
+        return self.session.token
 
     async def get_token(self) -> Optional[str]:
-        """Get authentication token from Marzban using admin credentials."""
-        try:
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.post(
-                    f"{self.base_url}/api/admin/token",
-                    data={
-                        "username": self.username,
-                        "password": self.password
-                    }
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    self.token = data.get("access_token")
-                    return self.token
-                else:
-                    print(f"Failed to get token for {self.username}: {response.status_code} - {response.text}")
-                    return None
-                    
-        except Exception as e:
-            print(f"Error getting token for {self.username}: {e}")
-            return None
+        """Log in with the admin credentials and return a fresh token."""
+        return await self.session.get_token(force=True)
 
     async def ensure_authenticated(self) -> bool:
-        """Ensure we have a valid token."""
-        if not self.token:
-            token = await self.get_token()
-            return token is not None
-        return True
+        """Ensure we have a valid token (cached until shortly before it expires)."""
+        return await self.session.get_token() is not None
 
     async def get_headers(self) -> Dict[str, str]:
         """Get headers with authentication token."""
-        if not await self.ensure_authenticated():
+        token = await self.session.get_token()
+        if not token:
             raise Exception(f"Failed to authenticate admin {self.username} with Marzban API")
         
         return {
-            "Authorization": f"Bearer {self.token}",
+            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
 
     async def _request(self, method: str, url: str, *, params: Optional[Dict[str, Any]] = None, json: Optional[Dict[str, Any]] = None, retry: bool = True) -> httpx.Response:
+        """Perform an HTTP request; identical concurrent GETs for this identity share one response."""
+        if method == "GET" and json is None:
+            key = (self.session.username, url, freeze(params))
+            return await _get_flight.do(key, lambda: self._send(method, url, params=params, retry=retry))
+        return await self._send(method, url, params=params, json=json, retry=retry)
+
+    async def _send(self, method: str, url: str, *, params: Optional[Dict[str, Any]] = None, json: Optional[Dict[str, Any]] = None, retry: bool = True) -> httpx.Response:
         """Perform an HTTP request with automatic token refresh on 401."""
         headers = await self.get_headers()
-        async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-            response = await client.request(method, url, headers=headers, params=params, json=json)
+        client = get_http_client()
+        response = await client.request(method, url, headers=headers, params=params, json=json)
         if response.status_code == 401 and retry:
             # Token might be expired/invalid; refresh and retry once
-            self.token = None
-            await self.ensure_authenticated()
+            self.session.invalidate(headers["Authorization"][len("Bearer "):])
             headers = await self.get_headers()
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.request(method, url, headers=headers, params=params, json=json)
+            response = await client.request(method, url, headers=headers, params=params, json=json)
         return response
 
-    async def get_users(self) -> List[MarzbanUserModel]:
-        """Get all users belonging to this admin (handles pagination and token refresh)."""
+    async def get_user_records(self, page_size: Optional[int] = None) -> List[UserRecord]:
+        """Get all users belonging to this admin as lightweight records (no model validation)."""
+        async def load() -> List[UserRecord]:
+            rows = await fetch_user_pages(
+                self._request,
+                f"{self.base_url}/api/users",
+                {"admin": self.username},
+                page_size=page_size,
+                label=f"users for {self.username}",
+            )
+            return parse_user_records(rows)
+
         try:
-            users: List[MarzbanUserModel] = []
-            limit = 200
-            offset = 0
-            while True:
-                params = {"admin": self.username, "limit": limit, "offset": offset}
-                response = await self._request("GET", f"{self.base_url}/api/users", params=params)
-                if response.status_code != 200:
-                    print(f"Failed to get users for {self.username}: {response.status_code} - {response.text}")
-                    break
-                data = response.json()
-                batch = data.get("users", data if isinstance(data, list) else [])
-                parsed_batch: List[MarzbanUserModel] = []
-                for user_data in batch:
-                    try:
-                        parsed_batch.append(MarzbanUserModel(
-                            username=safe_extract_username(user_data.get("username")) or "",
-                            status=user_data.get("status", ""),
-                            used_traffic=user_data.get("used_traffic", 0),
-                            lifetime_used_traffic=user_data.get("lifetime_used_traffic", 0),
-                            data_limit=user_data.get("data_limit"),
-                            expire=user_data.get("expire"),
-                            admin=safe_extract_username(user_data.get("admin"))
-                        ))
-                    except Exception as e:
-                        print(f"Error parsing user data: {e}")
-                        continue
-                users.extend(parsed_batch)
-                if len(parsed_batch) < limit:
-                    break
-                offset += limit
-            return users
+            key = ("records", self.base_url, self.session.username, self.username, page_size)
+            return list(await _listing_flight.do(key, load))
         except Exception as e:
             print(f"Error getting users for {self.username}: {e}")
             return []
 
-    async def get_users_expired_over_days(self, days: int = 10) -> List[MarzbanUserModel]:
+    async def count_users(self, fallback: bool = True, **filters) -> Optional[int]:
+        """Number of this admin's users matching `filters` (e.g. status="active"), without downloading them.
+
+        Reads the server's `total` from a one-row page. Returns None if that
+        request fails. Only when the server answers without a `total` is the
+        full listing counted (if `fallback` is set); a failed listing also
+        gives None, never 0.
+        """
+        rows, total = await fetch_first_page(
+            self._request, f"{self.base_url}/api/users", {**filters, "admin": self.username},
+            label=f"user count for {self.username}",
+        )
+        if rows is None or total is not None or not fallback:
+            return total
+        try:
+            rows = await fetch_user_pages(
+                self._request,
+                f"{self.base_url}/api/users",
+                {"admin": self.username},
+                label=f"users for {self.username}",
+            )
+        except Exception as e:
+            print(f"Error counting users for {self.username}: {e}")
+            return None
+        return len([row for row in rows if _matches_filters(row, filters)])
+
+    async def get_users_page(self, limit: int = 20) -> Tuple[List[MarzbanUserModel], Optional[int]]:
+        """First `limit` users of this admin plus their total count, in one request."""
+        rows, total = await fetch_first_page(
+            self._request, f"{self.base_url}/api/users", {"admin": self.username},
+            limit=limit, label=f"users for {self.username}",
+        )
+        if rows is None:
+            return [], None
+        return records_to_models(parse_user_records(rows[:limit])), total
+
+    async def get_users(self, page_size: Optional[int] = None) -> List[MarzbanUserModel]:
+        """Get all users belonging to this admin (handles pagination and token refresh)."""
+        return records_to_models(await self.get_user_records(page_size))
+
+    async def get_users_expired_over_days(self, days: int = 10) -> List[UserRecord]:
         """Return users whose expire time passed more than `days` days ago (using full paginated list)."""
         try:
-            users = await self.get_users()
+            users = await self.get_user_records()
             if not users:
                 return []
             cutoff = datetime.now().timestamp() - days * 24 * 3600
-            filtered: List[MarzbanUserModel] = []
-            for u in users:
-                if u.expire is not None and u.expire < cutoff:
-                    filtered.append(u)
-            return filtered
+            return select_expired_before(UserBatch(users), cutoff)
         except Exception as e:
             print(f"Error filtering users expired over {days} days for {self.username}: {e}")
             return []
@@ -153,59 +607,8 @@ class MarzbanAdminAPI:
         """Get statistics for this admin - count all users owned by this admin and provide breakdowns."""
         try:
             # Get all users belonging to this admin
-            admin_users = await self.get_users()
-            
-            # Count all users and breakdown by status
-            total_users = len(admin_users)
-            counts_by_status: Dict[str, int] = {}
-            active_users = 0
-            for user in admin_users:
-                status_key = (user.status or "unknown").lower()
-                counts_by_status[status_key] = counts_by_status.get(status_key, 0) + 1
-                if status_key == "active":
-                    active_users += 1
-            
-            # Extra counters and consumed users
-            now_ts = datetime.now().timestamp()
-            expired_count = 0
-            quota_full_count = 0
-            disabled_count = counts_by_status.get("disabled", 0)
-            consumed_users = 0
-            for user in admin_users:
-                status_key = (user.status or "unknown").lower()
-                is_expired = (user.expire is not None and user.expire <= now_ts)
-                is_quota_full = False
-                if user.data_limit is not None:
-                    used_now = user.used_traffic or 0
-                    lifetime_used = user.lifetime_used_traffic or 0
-                    is_quota_full = (used_now >= user.data_limit or lifetime_used >= user.data_limit)
-                if is_expired:
-                    expired_count += 1
-                if is_quota_full:
-                    quota_full_count += 1
-                if status_key == "active" and not is_expired and not is_quota_full:
-                    consumed_users += 1
-            
-            # Calculate total current period traffic used (use used_traffic only to avoid double counting)
-            total_traffic_used = sum((u.used_traffic or 0) for u in admin_users)
-            
-            # Time usage is not aggregated from users; returned as 0 here
-            total_time_used = 0
-            
-            return AdminStatsModel(
-                total_users=total_users,
-                active_users=active_users,
-                consumed_users=consumed_users,
-                total_traffic_used=total_traffic_used,
-                total_time_used=total_time_used,
-                counts_by_status=counts_by_status,
-                counts_extra={
-                    "expired": expired_count,
-                    "quota_full": quota_full_count,
-                    "disabled": disabled_count
-                }
-            )
-            
+            admin_users = await self.get_user_records()
+            return build_admin_stats(admin_users)
         except Exception as e:
             print(f"Error getting admin stats for {self.username}: {e}")
             return AdminStatsModel()
@@ -224,67 +627,66 @@ class MarzbanAPI:
         self.base_url = config.MARZBAN_URL.rstrip('/')
         self.username = config.MARZBAN_USERNAME
         self.password = config.MARZBAN_PASSWORD
-        self.token = None
-        self.token_expires = None
+        self.session = get_token_session(self.base_url, self.username, self.password)
+        self._admin_apis: Dict[Tuple[str, str], MarzbanAdminAPI] = {}
+
+    @property
+    def token(self) -> Optional[str]:
+        return self.session.token
 
     async def get_token(self) -> Optional[str]:
-        """Get authentication token from Marzban."""
-        try:
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.post(
-                    f"{self.base_url}/api/admin/token",
-                    data={
-                        "username": self.username,
-                        "password": self.password
-                    }
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    self.token = data.get("access_token")
-                    return self.token
-                else:
-                    print(f"Failed to get token: {response.status_code} - {response.text}")
-                    return None
-                    
-        except Exception as e:
-            print(f"Error getting token: {e}")
-            return None
+        """Log in with the main admin credentials and return a fresh token."""
+        return await self.session.get_token(force=True)
 
     async def ensure_authenticated(self) -> bool:
-        """Ensure we have a valid token."""
-        if not self.token:
-            token = await self.get_token()
-            return token is not None
-        return True
+        """Ensure we have a valid token (cached until shortly before it expires)."""
+        return await self.session.get_token() is not None
 
     async def get_headers(self) -> Dict[str, str]:
         """Get headers with authentication token."""
-        if not await self.ensure_authenticated():
+        token = await self.session.get_token()
+        if not token:
             raise Exception("Failed to authenticate with Marzban API")
         
         return {
-            "Authorization": f"Bearer {self.token}",
+            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
 
     async def _request(self, method: str, url: str, *, params: Optional[Dict[str, Any]] = None, json: Optional[Dict[str, Any]] = None, retry: bool = True) -> httpx.Response:
+        """Perform an HTTP request; identical concurrent GETs for this identity share one response."""
+        if method == "GET" and json is None:
+            key = (self.session.username, url, freeze(params))
+            return await _get_flight.do(key, lambda: self._send(method, url, params=params, retry=retry))
+        return await self._send(method, url, params=params, json=json, retry=retry)
+
+    async def _send(self, method: str, url: str, *, params: Optional[Dict[str, Any]] = None, json: Optional[Dict[str, Any]] = None, retry: bool = True) -> httpx.Response:
         """Perform an HTTP request with automatic token refresh on 401."""
         headers = await self.get_headers()
-        async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-            response = await client.request(method, url, headers=headers, params=params, json=json)
+        client = get_http_client()
+        response = await client.request(method, url, headers=headers, params=params, json=json)
         if response.status_code == 401 and retry:
             # Token might be expired/invalid; refresh and retry once
-            self.token = None
-            await self.ensure_authenticated()
+            self.session.invalidate(headers["Authorization"][len("Bearer "):])
             headers = await self.get_headers()
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.request(method, url, headers=headers, params=params, json=json)
+            response = await client.request(method, url, headers=headers, params=params, json=json)
         return response
 
     async def create_admin_api(self, marzban_username: str, marzban_password: str) -> MarzbanAdminAPI:
-        """Create a MarzbanAdminAPI instance for specific admin credentials."""
-        return MarzbanAdminAPI(self.base_url, marzban_username, marzban_password)
+        """Return the MarzbanAdminAPI for these admin credentials.
+
+        Instances are kept per (username, password hash) and share a TokenSession,
+        so repeated calls reuse the cached token instead of logging in again.
+        """
+        password_hash = hashlib.sha256((marzban_password or "").encode()).hexdigest()
+        key = (marzban_username, password_hash)
+        admin_api = self._admin_apis.get(key)
+        if admin_api is None:
+            for stale in [k for k in self._admin_apis if k[0] == marzban_username]:
+                del self._admin_apis[stale]
+            admin_api = MarzbanAdminAPI(self.base_url, marzban_username, marzban_password)
+            self._admin_apis[key] = admin_api
+        return admin_api
 
     async def get_admin_stats_with_credentials(self, marzban_username: str, marzban_password: str) -> AdminStatsModel:
         """Get admin stats using specific admin credentials for real-time data."""
@@ -295,108 +697,76 @@ class MarzbanAPI:
             print(f"Error getting stats with credentials for {marzban_username}: {e}")
             return AdminStatsModel()
 
-    async def get_token(self) -> Optional[str]:
-        """Get authentication token from Marzban."""
-        try:
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.post(
-                    f"{self.base_url}/api/admin/token",
-                    data={
-                        "username": self.username,
-                        "password": self.password
-                    }
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    self.token = data.get("access_token")
-                    return self.token
-                else:
-                    print(f"Failed to get token: {response.status_code} - {response.text}")
-                    return None
-                    
-        except Exception as e:
-            print(f"Error getting token: {e}")
-            return None
-
-    async def ensure_authenticated(self) -> bool:
-        """Ensure we have a valid token."""
-        if not self.token:
-            token = await self.get_token()
-            return token is not None
-        return True
+    async def get_user_rows(self, admin_username: Optional[str] = None, page_size: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get raw user dicts from /api/users (all users or one admin's), without model parsing."""
+        params: Dict[str, Any] = {}
+        if admin_username:
+            params["admin"] = admin_username
+        key = ("rows", self.base_url, self.session.username, admin_username, page_size)
+        rows = await _listing_flight.do(key, lambda: fetch_user_pages(
+            self._request,
+            f"{self.base_url}/api/users",
+            params,
+            page_size=page_size,
+        ))
+        return list(rows)
 
-    async def get_headers(self) -> Dict[str, str]:
-        """Get headers with authentication token."""
-        if not await self.ensure_authenticated():
-            raise Exception("Failed to authenticate with Marzban API")
-        
-        return {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
+    async def get_user_records(self, admin_username: Optional[str] = None, page_size: Optional[int] = None) -> List[UserRecord]:
+        """Get all users or one admin's users as lightweight records (no model validation)."""
+        async def load() -> List[UserRecord]:
+            return parse_user_records(await self.get_user_rows(admin_username, page_size))
 
-    async def get_users(self, admin_username: Optional[str] = None) -> List[MarzbanUserModel]:
-        """Get all users or users for specific admin (handles pagination and token refresh)."""
         try:
-            users: List[MarzbanUserModel] = []
-            limit = 200
-            offset = 0
-            while True:
-                params: Dict[str, Any] = {"limit": limit, "offset": offset}
-                if admin_username:
-                    params["admin"] = admin_username
-                response = await self._request("GET", f"{self.base_url}/api/users", params=params)
-                if response.status_code != 200:
-                    print(f"Failed to get users: {response.status_code} - {response.text}")
-                    break
-                data = response.json()
-                batch = data.get("users", data if isinstance(data, list) else [])
-                parsed_batch: List[MarzbanUserModel] = []
-                for user_data in batch:
-                    try:
-                        parsed_batch.append(MarzbanUserModel(
-                            username=safe_extract_username(user_data.get("username")) or "",
-                            status=user_data.get("status", ""),
-                            used_traffic=user_data.get("used_traffic", 0),
-                            lifetime_used_traffic=user_data.get("lifetime_used_traffic", 0),
-                            data_limit=user_data.get("data_limit"),
-                            expire=user_data.get("expire"),
-                            admin=safe_extract_username(user_data.get("admin"))
-                        ))
-                    except Exception as e:
-                        print(f"Error parsing user data: {e}")
-                        continue
-                users.extend(parsed_batch)
-                if len(parsed_batch) < limit:
-                    break
-                offset += limit
-            return users
+            key = ("records", self.base_url, self.session.username, admin_username, page_size)
+            return list(await _listing_flight.do(key, load))
         except Exception as e:
             print(f"Error getting users: {e}")
             return []
 
-    async def get_users_expired_over_days(self, admin_username: Optional[str] = None, days: int = 10) -> List[MarzbanUserModel]:
+    async def count_users(self, admin_username: Optional[str] = None, fallback: bool = True, **filters) -> Optional[int]:
+        """Number of users (all, or one admin's) matching `filters`, without downloading them.
+
+        Requests a single row (limit=1) and reads the server's `total`. Returns
+        None if that request fails. Only when the server answers without a
+        `total` is the full listing counted (if `fallback` is set); a failed
+        listing also gives None.
+        """
+        params: Dict[str, Any] = dict(filters)
+        if admin_username:
+            params["admin"] = admin_username
+        rows, total = await fetch_first_page(
+            self._request, f"{self.base_url}/api/users", params,
+            label=f"user count for {admin_username or 'ALL'}",
+        )
+        if rows is None or total is not None or not fallback:
+            return total
+        try:
+            return len([row for row in await self.get_user_rows(admin_username) if _matches_filters(row, filters)])
+        except Exception as e:
+            print(f"Error counting users for {admin_username or 'ALL'}: {e}")
+            return None
+
+    async def get_users(self, admin_username: Optional[str] = None, page_size: Optional[int] = None) -> List[MarzbanUserModel]:
+        """Get all users or users for specific admin (handles pagination and token refresh)."""
+        return records_to_models(await self.get_user_records(admin_username, page_size))
+
+    async def get_users_expired_over_days(self, admin_username: Optional[str] = None, days: int = 10) -> List[UserRecord]:
         """Return users whose expire time passed more than `days` days ago.
 
         If admin_username is provided, filters by that admin; otherwise returns across all users.
         """
         try:
-            # Use paginated get_users to ensure full list
-            users = await self.get_users(admin_username) if admin_username else await self.get_users()
+            # Use the paginated record listing to ensure full list
+            users = await self.get_user_records(admin_username)
             if not users:
                 return []
             cutoff = datetime.now().timestamp() - days * 24 * 3600
-            filtered: List[MarzbanUserModel] = []
-            for u in users:
-                if u.expire is not None and u.expire < cutoff:
-                    filtered.append(u)
-            return filtered
+            return select_expired_before(UserBatch(users), cutoff)
         except Exception as e:
             print(f"Error filtering users expired over {days} days for {admin_username or 'ALL'}: {e}")
             return []
 
-    async def get_small_quota_finished_users(self, max_quota_bytes: int = 1073741824, admin_username: Optional[str] = None) -> List[MarzbanUserModel]:
+    async def get_small_quota_finished_users(self, max_quota_bytes: int = 1073741824, admin_username: Optional[str] = None) -> List[UserRecord]:
         """Return users with small quota (<= max_quota_bytes) that are finished by data OR time.
 
         Criteria:
@@ -406,29 +776,11 @@ class MarzbanAPI:
         - OR expire is set and already past (time expired)
         """
         try:
-            # Use paginated get_users to ensure full list
-            users = await self.get_users(admin_username) if admin_username else await self.get_users()
+            # Use the paginated record listing to ensure full list
+            users = await self.get_user_records(admin_username)
             if not users:
                 return []
-            filtered: List[MarzbanUserModel] = []
-            now_ts = datetime.now().timestamp()
-            for u in users:
-                # time-expired should also qualify even if quota not small
-                time_expired = (u.expire is not None and u.expire <= now_ts)
-
-                small_quota_finished = False
-                if u.data_limit is not None and u.data_limit <= max_quota_bytes:
-                    used = u.used_traffic or 0
-                    lifetime_used = u.lifetime_used_traffic or 0
-                    small_quota_finished = (
-                        used >= u.data_limit or
-                        lifetime_used >= u.data_limit or
-                        (u.status or "").lower() in ["disabled", "limited"]
-                    )
-
-                if time_expired or small_quota_finished:
-                    filtered.append(u)
-            return filtered
+            return select_small_quota_finished(UserBatch(users), max_quota_bytes)
         except Exception as e:
             print(f"Error filtering small-quota finished users for {admin_username or 'ALL'}: {e}")
             return []
@@ -436,28 +788,22 @@ class MarzbanAPI:
     async def get_user(self, username: str) -> Optional[MarzbanUserModel]:
         """Get specific user information."""
         try:
-            headers = await self.get_headers()
+            response = await self._request("GET", f"{self.base_url}/api/user/{username}")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.get(
-                    f"{self.base_url}/api/user/{username}",
-                    headers=headers
+            if response.status_code == 200:
+                user_data = response.json()
+                return MarzbanUserModel(
+                    username=safe_extract_username(user_data.get("username")) or "",
+                    status=user_data.get("status", ""),
+                    used_traffic=user_data.get("used_traffic", 0),
+                    lifetime_used_traffic=user_data.get("lifetime_used_traffic", 0),
+                    data_limit=user_data.get("data_limit"),
+                    expire=user_data.get("expire"),
+                    admin=safe_extract_username(user_data.get("admin"))
                 )
-                
-                if response.status_code == 200:
-                    user_data = response.json()
-                    return MarzbanUserModel(
-                        username=safe_extract_username(user_data.get("username")) or "",
-                        status=user_data.get("status", ""),
-                        used_traffic=user_data.get("used_traffic", 0),
-                        lifetime_used_traffic=user_data.get("lifetime_used_traffic", 0),
-                        data_limit=user_data.get("data_limit"),
-                        expire=user_data.get("expire"),
-                        admin=safe_extract_username(user_data.get("admin"))
-                    )
-                else:
-                    print(f"Failed to get user {username}: {response.status_code}")
-                    return None
+            else:
+                print(f"Failed to get user {username}: {response.status_code}")
+                return None
                     
         except Exception as e:
             print(f"Error getting user {username}: {e}")
@@ -469,32 +815,25 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             logger.debug(f"Disabling user {username} in Marzban...")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.put(
-                    f"{self.base_url}/api/user/{username}",
-                    headers=headers,
-                    json={"status": "disabled"}
-                )
+            response = await self._request("PUT", f"{self.base_url}/api/user/{username}", json={"status": "disabled"})
+            
+            if response.status_code == 200:
+                logger.debug(f"User {username} disabled successfully")
+                return True
+            else:
+                # Log detailed error information
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                if response.status_code == 200:
-                    logger.debug(f"User {username} disabled successfully")
-                    return True
-                else:
-                    # Log detailed error information
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.warning(f"Failed to disable user {username}: {error_details}")
-                    return False
+                logger.warning(f"Failed to disable user {username}: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while disabling user {username}: {type(e).__name__}: {e}")
@@ -506,129 +845,103 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             logger.debug(f"Enabling user {username} in Marzban...")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.put(
-                    f"{self.base_url}/api/user/{username}",
-                    headers=headers,
-                    json={"status": "active"}
-                )
+            response = await self._request("PUT", f"{self.base_url}/api/user/{username}", json={"status": "active"})
+            
+            if response.status_code == 200:
+                logger.debug(f"User {username} enabled successfully")
+                return True
+            else:
+                # Log detailed error information
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                if response.status_code == 200:
-                    logger.debug(f"User {username} enabled successfully")
-                    return True
-                else:
-                    # Log detailed error information
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.warning(f"Failed to enable user {username}: {error_details}")
-                    return False
+                logger.warning(f"Failed to enable user {username}: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while enabling user {username}: {type(e).__name__}: {e}")
             return False
 
-    async def disable_users_batch(self, usernames: List[str]) -> Dict[str, bool]:
+    async def modify_users_batch(self, usernames: Iterable[str], user_data: Dict[str, Any], **options) -> Dict[str, bool]:
+        """Apply the same modification to many users via the bulk engine (see run_bulk_user_operation)."""
+        return await run_bulk_user_operation(
+            self._request, "PUT", f"{self.base_url}/api/user/{{username}}", usernames,
+            json=user_data, label="modify", **options
+        )
+
+    async def remove_users_batch(self, usernames: Iterable[str], **options) -> Dict[str, bool]:
+        """Delete many users via the bulk engine."""
+        return await run_bulk_user_operation(
+            self._request, "DELETE", f"{self.base_url}/api/user/{{username}}", usernames,
+            success_codes=(200, 204), label="remove", **options
+        )
+
+    async def reset_users_data_usage_batch(self, usernames: Iterable[str], **options) -> Dict[str, bool]:
+        """Reset data usage for many users via the bulk engine."""
+        return await run_bulk_user_operation(
+            self._request, "POST", f"{self.base_url}/api/user/{{username}}/reset", usernames,
+            label="reset", **options
+        )
+
+    async def disable_users_batch(self, usernames: Iterable[str], **options) -> Dict[str, bool]:
         """Disable multiple users."""
-        results = {}
-        for username in usernames:
-            results[username] = await self.disable_user(username)
-            await asyncio.sleep(0.1)  # Small delay to avoid overwhelming the API
-        return results
+        return await self.modify_users_batch(usernames, {"status": "disabled"}, **options)
 
-    async def enable_users_batch(self, usernames: List[str]) -> Dict[str, bool]:
+    async def enable_users_batch(self, usernames: Iterable[str], **options) -> Dict[str, bool]:
         """Enable multiple users."""
-        results = {}
-        for username in usernames:
-            results[username] = await self.enable_user(username)
-            await asyncio.sleep(0.1)  # Small delay to avoid overwhelming the API
-        return results
+        return await self.modify_users_batch(usernames, {"status": "active"}, **options)
 
     async def get_admin_stats(self, admin_username: str) -> AdminStatsModel:
         """Get statistics for a specific admin - count all users owned by this admin and provide breakdowns."""
         try:
             # Query only this admin's users directly from API
-            admin_users = await self.get_users(admin_username)
-            
-            # Count all users and breakdown by status
-            total_users = len(admin_users)
-            counts_by_status: Dict[str, int] = {}
-            active_users = 0
-            for user in admin_users:
-                status_key = (user.status or "unknown").lower()
-                counts_by_status[status_key] = counts_by_status.get(status_key, 0) + 1
-                if status_key == "active":
-                    active_users += 1
-            
-            # Extra counters and consumed users
-            now_ts = datetime.now().timestamp()
-            expired_count = 0
-            quota_full_count = 0
-            disabled_count = counts_by_status.get("disabled", 0)
-            consumed_users = 0
-            for user in admin_users:
-                status_key = (user.status or "unknown").lower()
-                is_expired = (user.expire is not None and user.expire <= now_ts)
-                is_quota_full = False
-                if user.data_limit is not None:
-                    used_now = user.used_traffic or 0
-                    lifetime_used = user.lifetime_used_traffic or 0
-                    is_quota_full = (used_now >= user.data_limit or lifetime_used >= user.data_limit)
-                if is_expired:
-                    expired_count += 1
-                if is_quota_full:
-                    quota_full_count += 1
-                if status_key == "active" and not is_expired and not is_quota_full:
-                    consumed_users += 1
-            
-            # Calculate total current period traffic used (use used_traffic only to avoid double counting)
-            total_traffic_used = sum((u.used_traffic or 0) for u in admin_users)
-            
-            # Time usage is not aggregated from users; returned as 0 here
-            total_time_used = 0
-            
-            return AdminStatsModel(
-                total_users=total_users,
-                active_users=active_users,
-                consumed_users=consumed_users,
-                total_traffic_used=total_traffic_used,
-                total_time_used=total_time_used,
-                counts_by_status=counts_by_status,
-                counts_extra={
-                    "expired": expired_count,
-                    "quota_full": quota_full_count,
-                    "disabled": disabled_count
-                }
-            )
-            
+            admin_users = await self.get_user_records(admin_username)
+            return build_admin_stats(admin_users)
         except Exception as e:
             print(f"Error getting admin stats for {admin_username}: {e}")
             return AdminStatsModel()
 
+    async def get_admin_stats_or_none(self, admin_username: str) -> Optional[AdminStatsModel]:
+        """Like get_admin_stats, but None when the listing failed.
+
+        get_admin_stats returns empty stats on error, which is indistinguishable
+        from a panel with no users; the monitor must not record that as usage.
+        """
+        try:
+            return build_admin_stats(parse_user_records(await self.get_user_rows(admin_username)))
+        except Exception as e:
+            print(f"Error getting admin stats for {admin_username}: {e}")
+            return None
+
+    async def get_admin_stats_snapshot(self) -> Optional[Dict[str, AdminStatsModel]]:
+        """Fetch all users in one sweep and return stats for every admin, keyed by admin username.
+
+        Returns None when the sweep failed, so callers can fall back to
+        per-admin queries; a panel with no users gives an empty dict.
+        """
+        try:
+            users = parse_user_records(await self.get_user_rows())
+            return compute_admin_stats_by_admin(UserBatch(users))
+        except Exception as e:
+            print(f"Error building admin stats snapshot: {e}")
+            return None
+
     async def get_system_stats(self) -> Dict[str, Any]:
         """Get system statistics."""
         try:
-            headers = await self.get_headers()
+            response = await self._request("GET", f"{self.base_url}/api/system")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.get(
-                    f"{self.base_url}/api/system",
-                    headers=headers
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    return {}
+            if response.status_code == 200:
+                return response.json()
+            else:
+                return {}
                     
         except Exception as e:
             print(f"Error getting system stats: {e}")
@@ -640,8 +953,6 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             # Use the new API format as specified in requirements
             admin_data = {
                 "password": new_password,
@@ -650,29 +961,24 @@ class MarzbanAPI:
             
             logger.info(f"Updating password for admin {admin_username} in Marzban panel...")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.put(
-                    f"{self.base_url}/api/admin/{admin_username}",
-                    headers=headers,
-                    json=admin_data
-                )
+            response = await self._request("PUT", f"{self.base_url}/api/admin/{admin_username}", json=admin_data)
+            
+            # Check for successful update - 200 is typical for PUT operations
+            if response.status_code == 200:
+                logger.info(f"Password updated successfully for admin {admin_username} (status: {response.status_code})")
+                return True
+            else:
+                # Log detailed error information
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                # Check for successful update - 200 is typical for PUT operations
-                if response.status_code == 200:
-                    logger.info(f"Password updated successfully for admin {admin_username} (status: {response.status_code})")
-                    return True
-                else:
-                    # Log detailed error information
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.error(f"Failed to update password for admin {admin_username}: {error_details}")
-                    return False
+                logger.error(f"Failed to update password for admin {admin_username}: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while updating password for admin {admin_username}: {type(e).__name__}: {e}")
@@ -688,8 +994,6 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             admin_data = {
                 "username": username,
                 "password": password,
@@ -699,29 +1003,24 @@ class MarzbanAPI:
             
             logger.info(f"Creating admin {username} in Marzban panel...")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.post(
-                    f"{self.base_url}/api/admin",
-                    headers=headers,
-                    json=admin_data
-                )
+            response = await self._request("POST", f"{self.base_url}/api/admin", json=admin_data)
+            
+            # Check for successful creation - both 200 and 201 are valid success codes
+            if response.status_code in [200, 201]:
+                logger.info(f"Admin {username} created successfully in Marzban (status: {response.status_code})")
+                return True
+            else:
+                # Log detailed error information
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                # Check for successful creation - both 200 and 201 are valid success codes
-                if response.status_code in [200, 201]:
-                    logger.info(f"Admin {username} created successfully in Marzban (status: {response.status_code})")
-                    return True
-                else:
-                    # Log detailed error information
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.error(f"Failed to create admin {username} in Marzban: {error_details}")
-                    return False
+                logger.error(f"Failed to create admin {username} in Marzban: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while creating admin {username}: {type(e).__name__}: {e}")
@@ -733,34 +1032,28 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             logger.debug(f"Checking if admin {username} exists in Marzban...")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.get(
-                    f"{self.base_url}/api/admin/{username}",
-                    headers=headers
-                )
+            response = await self._request("GET", f"{self.base_url}/api/admin/{username}")
+            
+            if response.status_code == 200:
+                logger.debug(f"Admin {username} exists in Marzban")
+                return True
+            elif response.status_code == 404:
+                logger.debug(f"Admin {username} does not exist in Marzban")
+                return False
+            else:
+                # Log unexpected status codes
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                if response.status_code == 200:
-                    logger.debug(f"Admin {username} exists in Marzban")
-                    return True
-                elif response.status_code == 404:
-                    logger.debug(f"Admin {username} does not exist in Marzban")
-                    return False
-                else:
-                    # Log unexpected status codes
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.warning(f"Unexpected response when checking admin {username} existence: {error_details}")
-                    return False
+                logger.warning(f"Unexpected response when checking admin {username} existence: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while checking admin {username} existence: {type(e).__name__}: {e}")
@@ -769,16 +1062,9 @@ class MarzbanAPI:
     async def set_user_owner(self, username: str, admin_username: str) -> bool:
         """Set the owner (admin) for a user."""
         try:
-            headers = await self.get_headers()
+            response = await self._request("PUT", f"{self.base_url}/api/user/{username}", json={"admin": admin_username})
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.put(
-                    f"{self.base_url}/api/user/{username}",
-                    headers=headers,
-                    json={"admin": admin_username}
-                )
-                
-                return response.status_code == 200
+            return response.status_code == 200
                 
         except Exception as e:
             print(f"Error setting user owner for {username}: {e}")
@@ -790,8 +1076,6 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             logger.debug(f"Modifying user {username} in Marzban...")
 
             # Soft-audit: warn if expire field is being changed, to trace unexpected extensions
@@ -801,28 +1085,23 @@ class MarzbanAPI:
             except Exception:
                 pass
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.put(
-                    f"{self.base_url}/api/user/{username}",
-                    headers=headers,
-                    json=user_data
-                )
+            response = await self._request("PUT", f"{self.base_url}/api/user/{username}", json=user_data)
+            
+            if response.status_code == 200:
+                logger.debug(f"User {username} modified successfully")
+                return True
+            else:
+                # Log detailed error information
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                if response.status_code == 200:
-                    logger.debug(f"User {username} modified successfully")
-                    return True
-                else:
-                    # Log detailed error information
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.warning(f"Failed to modify user {username}: {error_details}")
-                    return False
+                logger.warning(f"Failed to modify user {username}: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while modifying user {username}: {type(e).__name__}: {e}")
@@ -842,32 +1121,26 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             logger.debug(f"Removing user {username} from Marzban...")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.delete(
-                    f"{self.base_url}/api/user/{username}",
-                    headers=headers
-                )
+            response = await self._request("DELETE", f"{self.base_url}/api/user/{username}")
+            
+            # Check for successful deletion - 200, 204 are common success codes for DELETE
+            if response.status_code in [200, 204]:
+                logger.debug(f"User {username} removed successfully")
+                return True
+            else:
+                # Log detailed error information
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                # Check for successful deletion - 200, 204 are common success codes for DELETE
-                if response.status_code in [200, 204]:
-                    logger.debug(f"User {username} removed successfully")
-                    return True
-                else:
-                    # Log detailed error information
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.warning(f"Failed to remove user {username}: {error_details}")
-                    return False
+                logger.warning(f"Failed to remove user {username}: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while removing user {username}: {type(e).__name__}: {e}")
@@ -876,39 +1149,16 @@ class MarzbanAPI:
     async def get_expired_users(self, admin_username: Optional[str] = None) -> List[MarzbanUserModel]:
         """Get list of expired users."""
         try:
-            users: List[MarzbanUserModel] = []
-            limit = 200
-            offset = 0
-            while True:
-                params: Dict[str, Any] = {"expired": "true", "limit": limit, "offset": offset}
-                if admin_username:
-                    params["admin"] = admin_username
-                response = await self._request("GET", f"{self.base_url}/api/users", params=params)
-                if response.status_code != 200:
-                    print(f"Failed to get expired users: {response.status_code}")
-                    break
-                data = response.json()
-                batch = data.get("users", data if isinstance(data, list) else [])
-                parsed_batch: List[MarzbanUserModel] = []
-                for user_data in batch:
-                    try:
-                        parsed_batch.append(MarzbanUserModel(
-                            username=safe_extract_username(user_data.get("username")) or "",
-                            status=user_data.get("status", ""),
-                            used_traffic=user_data.get("used_traffic", 0),
-                            lifetime_used_traffic=user_data.get("lifetime_used_traffic", 0),
-                            data_limit=user_data.get("data_limit"),
-                            expire=user_data.get("expire"),
-                            admin=safe_extract_username(user_data.get("admin"))
-                        ))
-                    except Exception as e:
-                        print(f"Error parsing expired user data: {e}")
-                        continue
-                users.extend(parsed_batch)
-                if len(parsed_batch) < limit:
-                    break
-                offset += limit
-            return users
+            params: Dict[str, Any] = {"expired": "true"}
+            if admin_username:
+                params["admin"] = admin_username
+            rows = await fetch_user_pages(
+                self._request,
+                f"{self.base_url}/api/users",
+                params,
+                label="expired users",
+            )
+            return records_to_models(parse_user_records(rows))
         except Exception as e:
             print(f"Error getting expired users: {e}")
             return []
@@ -917,14 +1167,8 @@ class MarzbanAPI:
         """Delete all expired users."""
         try:
             expired_users = await self.get_expired_users(admin_username)
-            
-            results = []
-            for user in expired_users:
-                result = await self.remove_user(user.username)
-                results.append(result)
-                await asyncio.sleep(0.1)  # Small delay to avoid overwhelming the API
-            
-            return all(results)
+            results = await self.remove_users_batch(user.username for user in expired_users)
+            return all(results.values())
                 
         except Exception as e:
             print(f"Error deleting expired users: {e}")
@@ -933,15 +1177,9 @@ class MarzbanAPI:
     async def reset_user_data_usage(self, username: str) -> bool:
         """Reset data usage for a specific user."""
         try:
-            headers = await self.get_headers()
+            response = await self._request("POST", f"{self.base_url}/api/user/{username}/reset")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.post(
-                    f"{self.base_url}/api/user/{username}/reset",
-                    headers=headers
-                )
-                
-                return response.status_code == 200
+            return response.status_code == 200
                 
         except Exception as e:
             print(f"Error resetting data usage for user {username}: {e}")
@@ -950,14 +1188,8 @@ class MarzbanAPI:
     async def reset_users_data_usage(self, admin_username: Optional[str] = None) -> Dict[str, bool]:
         """Reset data usage for all users or users of specific admin."""
         try:
-            users = await self.get_users(admin_username)
-            
-            results = {}
-            for user in users:
-                results[user.username] = await self.reset_user_data_usage(user.username)
-                await asyncio.sleep(0.1)  # Small delay to avoid overwhelming the API
-            
-            return results
+            users = await self.get_user_records(admin_username)
+            return await self.reset_users_data_usage_batch(user.username for user in users)
                 
         except Exception as e:
             print(f"Error resetting users data usage: {e}")
@@ -966,19 +1198,13 @@ class MarzbanAPI:
     async def get_current_admin(self) -> Optional[Dict[str, Any]]:
         """Get current admin information."""
         try:
-            headers = await self.get_headers()
+            response = await self._request("GET", f"{self.base_url}/api/admin")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.get(
-                    f"{self.base_url}/api/admin",
-                    headers=headers
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    print(f"Failed to get current admin: {response.status_code}")
-                    return None
+            if response.status_code == 200:
+                return response.json()
+            else:
+                print(f"Failed to get current admin: {response.status_code}")
+                return None
                     
         except Exception as e:
             print(f"Error getting current admin: {e}")
@@ -987,19 +1213,13 @@ class MarzbanAPI:
     async def list_admins(self) -> List[Dict[str, Any]]:
         """Get list of all admins."""
         try:
-            headers = await self.get_headers()
+            response = await self._request("GET", f"{self.base_url}/api/admins")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.get(
-                    f"{self.base_url}/api/admins",
-                    headers=headers
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    print(f"Failed to get admins list: {response.status_code}")
-                    return []
+            if response.status_code == 200:
+                return response.json()
+            else:
+                print(f"Failed to get admins list: {response.status_code}")
+                return []
                     
         except Exception as e:
             print(f"Error getting admins list: {e}")
@@ -1011,32 +1231,26 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             logger.info(f"Deleting admin {admin_username} from Marzban panel...")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.delete(
-                    f"{self.base_url}/api/admin/{admin_username}",
-                    headers=headers
-                )
+            response = await self._request("DELETE", f"{self.base_url}/api/admin/{admin_username}")
+            
+            # Check for successful deletion - 200, 204 are common success codes for DELETE
+            if response.status_code in [200, 204]:
+                logger.info(f"Admin {admin_username} deleted successfully from Marzban (status: {response.status_code})")
+                return True
+            else:
+                # Log detailed error information
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                # Check for successful deletion - 200, 204 are common success codes for DELETE
-                if response.status_code in [200, 204]:
-                    logger.info(f"Admin {admin_username} deleted successfully from Marzban (status: {response.status_code})")
-                    return True
-                else:
-                    # Log detailed error information
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.error(f"Failed to delete admin {admin_username} from Marzban: {error_details}")
-                    return False
+                logger.error(f"Failed to delete admin {admin_username} from Marzban: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while deleting admin {admin_username}: {type(e).__name__}: {e}")
@@ -1051,29 +1265,17 @@ class MarzbanAPI:
             logger.info(f"Starting complete deletion of admin {admin_username} and all their users...")
             
             # First, get all users belonging to this admin
-            admin_users = await self.get_users(admin_username)
+            admin_users = await self.get_user_records(admin_username)
             user_count = len(admin_users)
             
             logger.info(f"Found {user_count} users belonging to admin {admin_username}")
             
             # Delete all users belonging to this admin
-            deleted_users_count = 0
-            failed_users = []
-            
-            for user in admin_users:
-                try:
-                    success = await self.remove_user(user.username)
-                    if success:
-                        deleted_users_count += 1
-                        logger.debug(f"User {user.username} deleted successfully")
-                    else:
-                        failed_users.append(user.username)
-                        logger.warning(f"Failed to delete user {user.username}")
-                    await asyncio.sleep(0.1)  # Rate limiting
-                except Exception as e:
-                    failed_users.append(user.username)
-                    logger.error(f"Exception while deleting user {user.username}: {type(e).__name__}: {e}")
-                    continue
+            results = await self.remove_users_batch(user.username for user in admin_users)
+            deleted_users_count = sum(1 for ok in results.values() if ok)
+            failed_users = [username for username, ok in results.items() if not ok]
+            if failed_users:
+                logger.warning(f"Failed to delete users of admin {admin_username}: {', '.join(failed_users[:20])}")
             
             logger.info(f"User deletion summary for admin {admin_username}: {deleted_users_count} deleted, {len(failed_users)} failed")
             
@@ -1097,33 +1299,26 @@ class MarzbanAPI:
         logger = logging.getLogger(__name__)
         
         try:
-            headers = await self.get_headers()
-            
             logger.info(f"Updating admin {admin_username} in Marzban panel...")
             
-            async with httpx.AsyncClient(timeout=config.API_TIMEOUT) as client:
-                response = await client.put(
-                    f"{self.base_url}/api/admin/{admin_username}",
-                    headers=headers,
-                    json=admin_data
-                )
+            response = await self._request("PUT", f"{self.base_url}/api/admin/{admin_username}", json=admin_data)
+            
+            # Check for successful update
+            if response.status_code == 200:
+                logger.info(f"Admin {admin_username} updated successfully (status: {response.status_code})")
+                return True
+            else:
+                # Log detailed error information
+                error_details = f"HTTP {response.status_code}"
+                try:
+                    response_text = response.text
+                    if response_text:
+                        error_details += f" - Response: {response_text}"
+                except Exception:
+                    error_details += " - Could not read response text"
                 
-                # Check for successful update
-                if response.status_code == 200:
-                    logger.info(f"Admin {admin_username} updated successfully (status: {response.status_code})")
-                    return True
-                else:
-                    # Log detailed error information
-                    error_details = f"HTTP {response.status_code}"
-                    try:
-                        response_text = response.text
-                        if response_text:
-                            error_details += f" - Response: {response_text}"
-                    except Exception:
-                        error_details += " - Could not read response text"
-                    
-                    logger.error(f"Failed to update admin {admin_username}: {error_details}")
-                    return False
+                logger.error(f"Failed to update admin {admin_username}: {error_details}")
+                return False
                     
         except Exception as e:
             logger.error(f"Exception while updating admin {admin_username}: {type(e).__name__}: {e}")
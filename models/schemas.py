@@ -35,6 +35,8 @@ class UsageReportModel(BaseModel):
     current_total_time: int = 0  # in seconds
     current_total_traffic: int = 0  # in bytes
     users_data: Optional[str] = None  # JSON string of users info
+    users_measured: bool = True  # False when current_users was carried forward from an earlier check
+    traffic_measured: bool = True  # False when current_total_traffic was carried forward
     
 
 class LogModel(BaseModel):
@@ -45,6 +47,17 @@ class LogModel(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.now)
 
 
+class AdminAuditModel(BaseModel):
+    id: Optional[int] = None
+    admin_id: int
+    admin_user_id: Optional[int] = None
+    field: str
+    old_value: Optional[str] = None
+    new_value: Optional[str] = None
+    caller: Optional[str] = None
+    changed_at: Optional[datetime] = None
+
+
 class MarzbanUserModel(BaseModel):
     username: str
     status: str
@@ -55,6 +68,39 @@ class MarzbanUserModel(BaseModel):
     admin: Optional[str] = None
 
 
+class UserRecord:
+    """Lightweight user row with the same fields as MarzbanUserModel, built without validation.
+
+    Used for bulk work over whole user lists (stats, filters, bulk operations);
+    call to_model() when a validated MarzbanUserModel is actually needed.
+    """
+    __slots__ = ("username", "status", "used_traffic", "lifetime_used_traffic", "data_limit", "expire", "admin")
+
+    def __init__(self, username: str, status: str, used_traffic: int = 0, lifetime_used_traffic: int = 0,
+                 data_limit: Optional[int] = None, expire: Optional[int] = None, admin: Optional[str] = None):
+        self.username = username
+        self.status = status
+        self.used_traffic = used_traffic
+        self.lifetime_used_traffic = lifetime_used_traffic
+        self.data_limit = data_limit
+        self.expire = expire
+        self.admin = admin
+
+    def to_model(self) -> MarzbanUserModel:
+        return MarzbanUserModel(
+            username=self.username,
+            status=self.status,
+            used_traffic=self.used_traffic,
+            lifetime_used_traffic=self.lifetime_used_traffic,
+            data_limit=self.data_limit,
+            expire=self.expire,
+            admin=self.admin,
+        )
+
+    def __repr__(self) -> str:
+        return f"UserRecord(username={self.username!r}, status={self.status!r}, admin={self.admin!r})"
+
+
 class AdminStatsModel(BaseModel):
     total_users: int = 0
     active_users: int = 0
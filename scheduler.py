@@ -1,16 +1,24 @@
 import asyncio
 import json
+import time
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
 
 import config
 from database import db
-from marzban_api import marzban_api
-from models.schemas import UsageReportModel, LogModel, LimitCheckResult
+from marzban_api import marzban_api, get_coalescing_stats
+from models.schemas import UsageReportModel, LogModel, LimitCheckResult, AdminStatsModel
 from utils.notify import notify_limit_warning, notify_limit_exceeded
+from utils.usage_tracker import UsageTracker
+from utils.api_health import api_health
+from utils.check_schedule import CheckSchedule
+from utils.usage_forecast import usage_forecast
+
+# Stored users peak (fraction of max_users) from which the count-only probe can decide a panel with a traffic limit
+COUNT_PROBE_PEAK_RATIO = 0.9
 
 
 class MonitoringScheduler:
@@ -19,6 +27,13 @@ class MonitoringScheduler:
         self.scheduler = AsyncIOScheduler()
         self.is_running = False
         self.backup_job_id = "bot_backup_job"
+        self.last_cycle_stats: Dict = {}
+        self.started_at: Optional[float] = None
+        self.first_sweep_done = False
+        self.usage_tracker = UsageTracker()
+        self.check_schedule = CheckSchedule()
+        # Last measured (users, traffic) per panel, carried into reports for checks that skip a measurement
+        self.last_usage: Dict[int, Tuple[int, int]] = {}
 
     async def check_admin_limits(self, admin_user_id: int) -> LimitCheckResult:
         admin = await db.get_admin(admin_user_id)
@@ -26,16 +41,50 @@ class MonitoringScheduler:
             return LimitCheckResult(admin_user_id=admin_user_id)
         return await self.check_admin_limits_by_id(admin.id)
 
-    async def check_admin_limits_by_id(self, admin_id: int) -> LimitCheckResult:
+    async def _record_usage(self, admin, check_time: datetime, elapsed_seconds: float,
+                            users: Optional[int] = None, traffic: Optional[int] = None):
+        """Write this check's usage report; values not measured this time carry the last known ones forward."""
+        last = self.last_usage.get(admin.id)
+        if last is None:
+            latest = await db.get_latest_usage_report(admin.user_id)
+            last = (latest.current_users, latest.current_total_traffic) if latest else (0, 0)
+        # Carried-forward values are flagged so the forecast seed can skip them
+        users_measured, traffic_measured = users is not None, traffic is not None
+        users = last[0] if users is None else int(users)
+        traffic = last[1] if traffic is None else int(traffic)
+        self.last_usage[admin.id] = (users, traffic)
+        await db.add_usage_report(UsageReportModel(
+            admin_user_id=admin.user_id,
+            check_time=check_time,
+            current_users=users,
+            current_total_time=int(elapsed_seconds),
+            current_total_traffic=traffic,
+            users_data=json.dumps([], ensure_ascii=False),
+            users_measured=users_measured,
+            traffic_measured=traffic_measured,
+        ))
+
+    async def check_admin_limits_by_id(self, admin_id: int, stats_snapshot: Optional[Dict[str, AdminStatsModel]] = None) -> LimitCheckResult:
+        """Evaluate one panel's limits, cheapest source first.
+
+        1. Local: time from created_at/max_total_time and the stored users peak
+           (no Marzban request; an expired panel is decided here).
+        2. Count-only probe (limit=1, read `total`) for the user count, only when
+           the panel has no traffic limit or its stored peak is already within
+           COUNT_PROBE_PEAK_RATIO of max_users; enough when it exceeds max_users
+           or traffic is not limited.
+        3. Full user listing, only when traffic has to be summed; it carries
+           the user count too, so a panel far from its user limit goes
+           straight here with no extra request.
+        In snapshot/incremental mode stages 2-3 read this cycle's stats instead;
+        a panel missing from them counts as empty only if a count probe
+        confirms 0 users, and is checked by stages 2-3 otherwise.
+        """
         try:
             admin = await db.get_admin_by_id(admin_id)
             if not admin or not admin.is_active:
                 return LimitCheckResult(admin_user_id=admin.user_id if admin else 0)
 
-            # Fetch current usage from Marzban (prefer panel username)
-            admin_username = admin.marzban_username or admin.username or str(admin.user_id)
-            admin_stats = await marzban_api.get_admin_stats(admin_username)
-
             # زمان سپری‌شده از ساخت ادمین
             created_at = admin.created_at
             now = datetime.utcnow()
@@ -43,16 +92,65 @@ class MonitoringScheduler:
 
             # نسبت استفاده‌ها به‌صورت 0..1 (یکسان‌سازی مقیاس)
             time_percentage = elapsed_seconds / admin.max_total_time if admin.max_total_time > 0 else 0
+            stored_peak = int(getattr(admin, 'users_historical_peak', 0) or 0)
+            limits_data = {
+                "user_percentage": (stored_peak / admin.max_users) if admin.max_users > 0 else 0,  # ratios 0..1
+                "time_percentage": time_percentage,
+                "current_users": stored_peak,
+                "max_users": admin.max_users,
+                "current_traffic": 0,
+                "max_traffic": admin.max_total_traffic,
+                "current_time": elapsed_seconds,
+                "max_time": admin.max_total_time
+            }
+
+            # Stage 1: already decided from SQLite alone
+            if time_percentage >= 1.0 or limits_data["user_percentage"] >= 1.0:
+                await self._record_usage(admin, now, elapsed_seconds)
+                return LimitCheckResult(admin_user_id=admin.user_id, admin_id=admin.id, exceeded=True, limits_data=limits_data)
+
+            # Fetch current usage from Marzban (prefer panel username); in snapshot
+            # mode the stats were already computed from this cycle's single sweep
+            admin_username = admin.marzban_username or admin.username or str(admin.user_id)
+            admin_stats: Optional[AdminStatsModel] = None
+            current_users = None
+            if stats_snapshot is not None:
+                admin_stats = stats_snapshot.get(admin_username)
+                if admin_stats is None:
+                    # No rows for this panel in the sweep: either it really has no users or
+                    # the sweep does not cover it (e.g. a username mismatch); ask the panel
+                    current_users = await marzban_api.count_users(admin_username)
+                    if current_users is None:
+                        return LimitCheckResult(admin_user_id=admin.user_id, admin_id=admin.id)
+                    if current_users == 0:
+                        admin_stats = AdminStatsModel()
+                else:
+                    current_users = admin_stats.total_users
+            if admin_stats is None:
+                near_user_limit = admin.max_users > 0 and stored_peak >= COUNT_PROBE_PEAK_RATIO * admin.max_users
+                if current_users is None and (admin.max_total_traffic <= 0 or near_user_limit):
+                    # Stage 2: count-only probe (None if it failed or the server reports no total)
+                    current_users = await marzban_api.count_users(admin_username, fallback=False)
+                users_exceeded = current_users is not None and admin.max_users > 0 and max(stored_peak, current_users) >= admin.max_users
+                if current_users is None or (admin.max_total_traffic > 0 and not users_exceeded):
+                    # Stage 3: traffic has to be summed over the full listing
+                    admin_stats = await marzban_api.get_admin_stats_or_none(admin_username)
+                    if admin_stats is None:
+                        # Listing failed: nothing was measured, so record nothing and retry next time
+                        return LimitCheckResult(admin_user_id=admin.user_id, admin_id=admin.id)
+                    current_users = admin_stats.total_users
+
             # Use historical peak users for limit checks
             try:
-                peak_users = max(int(getattr(admin, 'users_historical_peak', 0) or 0), int(admin_stats.total_users or 0))
-                if peak_users != (getattr(admin, 'users_historical_peak', 0) or 0):
+                peak_users = max(stored_peak, int(current_users or 0))
+                if peak_users != stored_peak:
                     await db.update_admin(admin.id, users_historical_peak=peak_users)
             except Exception:
-                peak_users = admin_stats.total_users
+                peak_users = current_users or 0
 
             user_percentage = (peak_users / admin.max_users) if admin.max_users > 0 else 0
-            traffic_percentage = (admin_stats.total_traffic_used / admin.max_total_traffic) if admin.max_total_traffic > 0 else 0
+            traffic_used = admin_stats.total_traffic_used if admin_stats is not None else 0
+            traffic_percentage = (traffic_used / admin.max_total_traffic) if admin.max_total_traffic > 0 else 0
 
             limits_exceeded = (
                 time_percentage >= 1.0 or
@@ -67,33 +165,24 @@ class MonitoringScheduler:
                 any(level <= traffic_percentage < 1.0 for level in warning_levels)
             ])
 
-            # گزارش واقعی استفاده
-            report = UsageReportModel(
-                admin_user_id=admin.user_id,
-                check_time=now,
-                current_users=admin_stats.total_users,
-                current_total_time=int(elapsed_seconds),
-                current_total_traffic=int(admin_stats.total_traffic_used),
-                users_data=json.dumps([], ensure_ascii=False)
-            )
-            await db.add_usage_report(report)
-
+            # Seed the forecast from stored history before this sample is added to it
+            await usage_forecast.ensure_loaded(admin)
+            # گزارش واقعی استفاده (traffic only when it was actually summed)
+            measured_traffic = admin_stats.total_traffic_used if admin_stats is not None else None
+            await self._record_usage(admin, now, elapsed_seconds, current_users, measured_traffic)
+            usage_forecast.observe(admin.id, current_users or 0, measured_traffic)
+
+            limits_data.update({
+                "user_percentage": user_percentage,
+                "traffic_percentage": traffic_percentage,
+                "current_users": current_users,
+            })
             return LimitCheckResult(
                 admin_user_id=admin.user_id,
                 admin_id=admin.id,
                 exceeded=limits_exceeded,
                 warning=warning_needed,
-                limits_data={
-                    "user_percentage": user_percentage,           # ratios 0..1
-                    "traffic_percentage": traffic_percentage,     # ratios 0..1
-                    "time_percentage": time_percentage,           # ratios 0..1
-                    "current_users": admin_stats.total_users,
-                    "max_users": admin.max_users,
-                    "current_traffic": 0,
-                    "max_traffic": admin.max_total_traffic,
-                    "current_time": elapsed_seconds,
-                    "max_time": admin.max_total_time
-                },
+                limits_data=limits_data,
                 affected_users=[]
             )
 
@@ -188,17 +277,10 @@ class MonitoringScheduler:
                     admin_username = admin.marzban_username or admin.username or str(admin.user_id)
                     expired_users = await marzban_api.get_expired_users(admin_username)
                     if expired_users:
-                        for user in expired_users:
-                            try:
-                                success = await marzban_api.remove_user(user.username)
-                                if success:
-                                    total_cleaned += 1
-                                    print(f"Removed expired user: {user.username} (admin: {admin_username})")
-                                await asyncio.sleep(0.1)
-                            except Exception as e:
-                                print(f"Error removing expired user {user.username}: {e}")
-                                continue
-                    await asyncio.sleep(0.5)
+                        results = await marzban_api.remove_users_batch(user.username for user in expired_users)
+                        removed = sum(1 for ok in results.values() if ok)
+                        total_cleaned += removed
+                        print(f"Removed {removed}/{len(results)} expired users (admin: {admin_username})")
                 except Exception as e:
                     print(f"Error cleaning expired users for admin {admin.user_id}: {e}")
                     continue
@@ -217,6 +299,121 @@ class MonitoringScheduler:
         except Exception as e:
             print(f"Error in cleanup_expired_users: {e}")
 
+    async def _monitor_admin(self, admin, stats: Dict[str, int], stats_snapshot: Optional[Dict[str, AdminStatsModel]] = None) -> Optional[LimitCheckResult]:
+        """Check one admin panel and act on the result (used by monitoring workers)."""
+        try:
+            result = await self.check_admin_limits_by_id(admin.id, stats_snapshot)
+            stats["checked"] += 1
+            if result.exceeded:
+                stats["exceeded"] += 1
+                await self.handle_limit_exceeded(result)
+            elif result.warning:
+                stats["warning"] += 1
+                await self.handle_limit_warning(result)
+            return result
+        except Exception as e:
+            stats["errors"] += 1
+            print(f"Error monitoring admin panel {admin.id} (user {admin.user_id}): {e}")
+            return None
+
+    async def _load_stats_snapshot(self) -> Optional[Dict[str, AdminStatsModel]]:
+        """One-sweep stats for every panel in snapshot/incremental mode (None = query per panel)."""
+        stats_snapshot = None
+        if config.MONITORING_INCREMENTAL_MODE:
+            stats_snapshot = await self.usage_tracker.refresh()
+            if stats_snapshot is None:
+                print("Usage tracker refresh failed; falling back to per-admin queries for this cycle")
+        elif config.MONITORING_SNAPSHOT_MODE:
+            stats_snapshot = await marzban_api.get_admin_stats_snapshot()
+            if stats_snapshot is None:
+                print("User snapshot unavailable; falling back to per-admin queries for this cycle")
+        return stats_snapshot
+
+    async def _run_checks(self, admins, stats: Dict[str, int], stats_snapshot: Optional[Dict[str, AdminStatsModel]]) -> Dict[int, Optional[LimitCheckResult]]:
+        """Check the given panels with MONITORING_CONCURRENCY workers; returns results by admin id."""
+        workers = max(1, min(config.MONITORING_CONCURRENCY, len(admins)))
+        results: Dict[int, Optional[LimitCheckResult]] = {}
+        queue: asyncio.Queue = asyncio.Queue()
+        for admin in admins:
+            queue.put_nowait(admin)
+
+        async def worker():
+            while True:
+                try:
+                    admin = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    # Request rate is bounded globally by API_RATE_LIMIT in the HTTP transport
+                    results[admin.id] = await self._monitor_admin(admin, stats, stats_snapshot)
+                finally:
+                    queue.task_done()
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        return results
+
+    async def monitor_due_admins(self):
+        """Adaptive mode tick: check only the panels whose next check time has come.
+
+        Each panel's next check is derived from its distance to the nearest
+        limit and its growth since the previous check (see CheckSchedule), so
+        panels near a limit are checked about every MONITORING_MIN_INTERVAL
+        and idle ones about every MONITORING_MAX_INTERVAL.
+        """
+        try:
+            admins = await db.get_all_admins()
+            active_admins = {admin.id: admin for admin in admins if admin.is_active}
+            self.check_schedule.sync(active_admins)
+            due = [active_admins[admin_id] for admin_id in self.check_schedule.pop_due() if admin_id in active_admins]
+            if not due:
+                return
+
+            started = time.monotonic()
+            stats = {"checked": 0, "exceeded": 0, "warning": 0, "errors": 0}
+            # A full sweep only pays off when a good share of the panels is due at once
+            stats_snapshot = None
+            if len(due) * 4 >= len(active_admins):
+                stats_snapshot = await self._load_stats_snapshot()
+            results = await self._run_checks(due, stats, stats_snapshot)
+
+            now = time.time()
+            for admin in due:
+                result = results.get(admin.id)
+                if result is not None and result.exceeded:
+                    current = await db.get_admin_by_id(admin.id)
+                    if current is None or not current.is_active:
+                        self.check_schedule.forget(admin.id)
+                        usage_forecast.forget(admin.id)
+                    else:
+                        # Deactivation did not go through: try again after the minimum interval
+                        self.check_schedule.reschedule(admin.id, {}, now)
+                    continue
+                self.check_schedule.reschedule(admin.id, result.limits_data if result else {}, now,
+                                               extra_rates=usage_forecast.rates(admin))
+
+            duration = time.monotonic() - started
+            self.last_cycle_stats = {
+                **stats,
+                "mode": "adaptive",
+                "admins": len(active_admins),
+                "due": len(due),
+                "snapshot": stats_snapshot is not None,
+                "incremental": dict(self.usage_tracker.last_refresh) if config.MONITORING_INCREMENTAL_MODE and stats_snapshot is not None else None,
+                "schedule": self.check_schedule.snapshot(),
+                "duration_seconds": round(duration, 2),
+                "finished_at": datetime.now().isoformat(timespec="seconds"),
+            }
+            print(
+                f"Adaptive monitoring checked {len(due)}/{len(active_admins)} panels in {duration:.1f}s "
+                f"(exceeded={stats['exceeded']}, warnings={stats['warning']}, errors={stats['errors']}); "
+                f"next check in {self.last_cycle_stats['schedule']['next_due_in']}s"
+            )
+            if not self.first_sweep_done and self.started_at is not None:
+                self.first_sweep_done = True
+                print(f"Startup: first monitoring sweep finished {time.monotonic() - self.started_at:.1f}s after scheduler start")
+        except Exception as e:
+            print(f"Error in monitor_due_admins: {e}")
+
     async def monitor_all_admins(self):
         try:
             print(f"Starting monitoring check at {datetime.now()}")
@@ -230,21 +427,39 @@ class MonitoringScheduler:
                 print("No active admins to monitor")
                 return
 
-            print(f"Monitoring {len(active_admins)} active admins")
-
-            for admin in active_admins:
-                try:
-                    result = await self.check_admin_limits_by_id(admin.id)
-                    if result.exceeded:
-                        await self.handle_limit_exceeded(result)
-                    elif result.warning:
-                        await self.handle_limit_warning(result)
-                    await asyncio.sleep(1)
-                except Exception as e:
-                    print(f"Error monitoring admin panel {admin.id} (user {admin.user_id}): {e}")
-                    continue
-
-            print(f"Monitoring check completed at {datetime.now()}")
+            workers = max(1, min(config.MONITORING_CONCURRENCY, len(active_admins)))
+            print(f"Monitoring {len(active_admins)} active admins with {workers} workers")
+
+            started = time.monotonic()
+            stats = {"checked": 0, "exceeded": 0, "warning": 0, "errors": 0}
+
+            stats_snapshot = await self._load_stats_snapshot()
+            await self._run_checks(active_admins, stats, stats_snapshot)
+
+            duration = time.monotonic() - started
+            self.last_cycle_stats = {
+                **stats,
+                "admins": len(active_admins),
+                "workers": workers,
+                "snapshot": stats_snapshot is not None,
+                "incremental": dict(self.usage_tracker.last_refresh) if config.MONITORING_INCREMENTAL_MODE else None,
+                "duration_seconds": round(duration, 2),
+                "interval_fraction": round(duration / config.MONITORING_INTERVAL, 3) if config.MONITORING_INTERVAL > 0 else None,
+                "finished_at": datetime.now().isoformat(timespec="seconds"),
+            }
+            print(
+                f"Monitoring check completed at {datetime.now()} in {duration:.1f}s "
+                f"(checked={stats['checked']}, exceeded={stats['exceeded']}, "
+                f"warnings={stats['warning']}, errors={stats['errors']})"
+            )
+            if not self.first_sweep_done and self.started_at is not None:
+                self.first_sweep_done = True
+                print(f"Startup: first monitoring sweep finished {time.monotonic() - self.started_at:.1f}s after scheduler start")
+            if config.MONITORING_INTERVAL > 0 and duration > config.MONITORING_INTERVAL * 0.5:
+                print(
+                    f"Warning: monitoring cycle took {duration:.1f}s, more than half of the "
+                    f"{config.MONITORING_INTERVAL}s interval; consider raising MONITORING_CONCURRENCY"
+                )
 
         except Exception as e:
             print(f"Error in monitor_all_admins: {e}")
@@ -255,12 +470,47 @@ class MonitoringScheduler:
             return
 
         print("Starting monitoring scheduler...")
+        self.started_at = time.monotonic()
+
+        # First sweep runs right away but as a scheduler job, so start() returns
+        # immediately (polling isn't held up) and max_instances keeps it from
+        # overlapping the next interval run
+        if config.MONITORING_ADAPTIVE_MODE:
+            # Short tick that only checks panels whose adaptive interval has elapsed
+            self.scheduler.add_job(
+                self.monitor_due_admins,
+                trigger=IntervalTrigger(seconds=config.MONITORING_TICK),
+                id="admin_monitor",
+                name="Admin Limit Monitor (adaptive)",
+                replace_existing=True,
+                max_instances=1,
+                next_run_time=datetime.now()
+            )
+            if config.AUTO_DELETE_EXPIRED_USERS:
+                self.scheduler.add_job(
+                    self.cleanup_expired_users,
+                    trigger=IntervalTrigger(seconds=config.MONITORING_INTERVAL),
+                    id="expired_cleanup",
+                    name="Expired Users Cleanup",
+                    replace_existing=True,
+                    max_instances=1
+                )
+        else:
+            self.scheduler.add_job(
+                self.monitor_all_admins,
+                trigger=IntervalTrigger(seconds=config.MONITORING_INTERVAL),
+                id="admin_monitor",
+                name="Admin Limit Monitor",
+                replace_existing=True,
+                max_instances=1,
+                next_run_time=datetime.now()
+            )
 
         self.scheduler.add_job(
-            self.monitor_all_admins,
-            trigger=IntervalTrigger(seconds=config.MONITORING_INTERVAL),
-            id="admin_monitor",
-            name="Admin Limit Monitor",
+            self.compact_usage_reports,
+            trigger=IntervalTrigger(seconds=config.USAGE_COMPACTION_INTERVAL),
+            id="usage_compaction",
+            name="Usage Reports Compaction",
             replace_existing=True,
             max_instances=1
         )
@@ -268,9 +518,25 @@ class MonitoringScheduler:
         self.scheduler.start()
         self.is_running = True
 
-        print(f"Monitoring scheduler started. Will check every {config.MONITORING_INTERVAL} seconds.")
+        if config.MONITORING_ADAPTIVE_MODE:
+            print(
+                f"Monitoring scheduler started in adaptive mode: panels checked every "
+                f"{config.MONITORING_MIN_INTERVAL}-{config.MONITORING_MAX_INTERVAL} seconds; first sweep running in background."
+            )
+        else:
+            print(f"Monitoring scheduler started. Will check every {config.MONITORING_INTERVAL} seconds; first sweep running in background.")
 
-        await self.monitor_all_admins()
+    async def compact_usage_reports(self):
+        try:
+            started = time.monotonic()
+            result = await db.compact_usage_reports()
+            print(
+                f"Usage compaction done in {time.monotonic() - started:.1f}s: "
+                f"{result['hourly_buckets']} hourly / {result['daily_buckets']} daily buckets updated, "
+                f"{result['raw_deleted']} raw, {result['hourly_deleted']} hourly and {result['daily_deleted']} daily rows removed"
+            )
+        except Exception as e:
+            print(f"Error in compact_usage_reports: {e}")
 
     async def send_backup(self):
         try:
@@ -328,11 +594,25 @@ class MonitoringScheduler:
         self.is_running = False
         print("Monitoring scheduler stopped.")
 
+    def pause(self):
+        """Hold all jobs (e.g. while the database file is being replaced)."""
+        if self.is_running:
+            self.scheduler.pause()
+
+    def resume(self):
+        if self.is_running:
+            self.scheduler.resume()
+
     def get_status(self) -> Dict:
         return {
             "running": self.is_running,
             "jobs": len(self.scheduler.get_jobs()) if self.is_running else 0,
-            "next_run": str(self.scheduler.get_job("admin_monitor").next_run_time) if self.is_running else None
+            "next_run": str(self.scheduler.get_job("admin_monitor").next_run_time) if self.is_running else None,
+            "last_cycle": self.last_cycle_stats,
+            "adaptive": config.MONITORING_ADAPTIVE_MODE,
+            "api_health": api_health.snapshot(),
+            "coalesced": get_coalescing_stats(),
+            "config_cache": db.get_cache_stats(),
         }
 
 
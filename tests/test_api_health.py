@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from utils import api_health
+from utils.api_health import ApiHealthController, CircuitOpenError
+
+
+class FakeTransport(httpx.AsyncBaseTransport):
+    """Answers with `status`, optionally holding each request until `gate` is set."""
+
+    def __init__(self, status=200, gate=None):
+        self.status = status
+        self.gate = gate
+        self.calls = 0
+
+    async def handle_async_request(self, request):
+        self.calls += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        return httpx.Response(self.status)
+
+
+def make_controller(**kwargs):
+    params = dict(max_limit=1, min_limit=1, latency_target=10.0, failure_threshold=1, reset_timeout=0.0)
+    params.update(kwargs)
+    return ApiHealthController(**params)
+
+
+def post():
+    # Non-idempotent, so send() never retries
+    return httpx.Request("POST", "http://marzban/api/user")
+
+
+def test_failures_open_the_circuit_and_a_good_probe_closes_it():
+    async def run():
+        controller = make_controller(reset_timeout=60.0)
+        response = await controller.send(FakeTransport(status=503), post())
+        assert response.status_code == 503
+        assert controller.state == api_health.OPEN
+
+        with pytest.raises(CircuitOpenError):
+            await controller.send(FakeTransport(), post())
+
+        controller.opened_at -= 60.0
+        response = await controller.send(FakeTransport(), post())
+        assert response.status_code == 200
+        assert controller.state == api_health.CLOSED
+        assert controller.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_probe_cancelled_while_waiting_for_a_slot_does_not_wedge_the_circuit():
+    async def run():
+        controller = make_controller()
+        gate = asyncio.Event()
+        slow = FakeTransport(gate=gate)
+
+        # One slow request holds the only concurrency slot
+        holder = asyncio.create_task(controller.send(slow, post()))
+        await asyncio.sleep(0)
+        assert controller.in_flight == 1
+
+        # Trip the circuit; with reset_timeout=0 the next request is the half-open probe
+        controller._set_state(api_health.OPEN, "test")
+        probe = asyncio.create_task(controller.send(FakeTransport(), post()))
+        await asyncio.sleep(0)
+        assert controller.state == api_health.HALF_OPEN
+        assert controller._probe_in_flight
+
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert not controller._probe_in_flight
+        assert controller.in_flight == 1
+
+        gate.set()
+        await holder
+        assert controller.in_flight == 0
+
+        # The next request becomes the probe and recovers the circuit
+        response = await controller.send(FakeTransport(), post())
+        assert response.status_code == 200
+        assert controller.state == api_health.CLOSED
+
+    asyncio.run(run())
+
+
+def test_rate_budget_spaces_requests_beyond_the_burst():
+    async def run():
+        controller = make_controller(max_limit=8, rate=20.0)
+        transport = FakeTransport()
+        started = time.monotonic()
+        await asyncio.gather(*(controller.send(transport, post()) for _ in range(24)))
+        return transport.calls, time.monotonic() - started
+
+    calls, elapsed = asyncio.run(run())
+    # A burst of 20, then the remaining 4 at 20 per second
+    assert calls == 24
+    assert elapsed >= 0.15
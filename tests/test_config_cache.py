@@ -0,0 +1,34 @@
+import asyncio
+
+from database import Database
+from models.schemas import PlanModel
+
+
+class RacingDatabase(Database):
+    """Invalidates the plans cache during a load's await, as a concurrent add_plan would."""
+
+    race = False
+
+    async def _get_conn(self):
+        conn = await super()._get_conn()
+        if self.race:
+            self.race = False
+            self.invalidate_config_cache("plans")
+        return conn
+
+
+def test_load_racing_with_a_write_is_not_cached(tmp_path):
+    async def run():
+        db = RacingDatabase(str(tmp_path / "bot.db"))
+        try:
+            await db.init_db()
+            await db.add_plan(PlanModel(name="basic", price=10))
+            db.race = True
+            assert [plan.name for plan in await db.get_plans()] == ["basic"]
+            assert db._plans_cache is None
+            assert [plan.name for plan in await db.get_plans()] == ["basic"]
+            assert db._plans_cache is not None
+        finally:
+            await db.close()
+
+    asyncio.run(run())
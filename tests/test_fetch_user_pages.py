@@ -0,0 +1,80 @@
+import asyncio
+
+import httpx
+import pytest
+
+import marzban_api
+from marzban_api import UserListingError, fetch_user_pages
+
+TOTAL_USERS = 1050
+
+
+def make_request(failing_offset=None):
+    """Fake `_request` serving a paginated /api/users listing; one offset may return HTTP 500."""
+    async def request(method, url, params=None):
+        offset, limit = params["offset"], params["limit"]
+        if offset == failing_offset:
+            return httpx.Response(500, text="boom")
+        users = [{"username": f"u{i}", "status": "active"} for i in range(offset, min(offset + limit, TOTAL_USERS))]
+        return httpx.Response(200, json={"users": users, "total": TOTAL_USERS})
+    return request
+
+
+def test_all_pages_are_stitched_in_order():
+    rows = asyncio.run(fetch_user_pages(make_request(), "http://panel/api/users", page_size=100))
+    assert [row["username"] for row in rows] == [f"u{i}" for i in range(TOTAL_USERS)]
+
+
+@pytest.mark.parametrize("failing_offset", [0, 400, 1000])
+def test_failed_page_fails_the_whole_listing(failing_offset):
+    with pytest.raises(UserListingError):
+        asyncio.run(fetch_user_pages(make_request(failing_offset), "http://panel/api/users", page_size=100))
+
+
+def test_failed_page_is_not_reported_as_a_short_list(monkeypatch):
+    api = marzban_api.MarzbanAPI()
+
+    async def fake_request(method, url, *, params=None, json=None, retry=True):
+        return await make_request(400)(method, url, params=params)
+
+    monkeypatch.setattr(api, "_request", fake_request)
+    assert asyncio.run(api.get_user_records(page_size=100)) == []
+    assert asyncio.run(api.get_admin_stats_snapshot()) is None
+
+
+def make_count_request(probe_status=200, listing_status=200, report_total=True):
+    """Fake `_request` for count_users: the limit=1 probe and the fallback listing can fail separately."""
+    calls = []
+
+    async def request(method, url, *, params=None, json=None, retry=True):
+        calls.append(params["limit"])
+        status = probe_status if params["limit"] == 1 else listing_status
+        if status != 200:
+            return httpx.Response(status, text="boom")
+        users = [{"username": f"u{i}", "status": "active" if i % 2 else "disabled"} for i in range(5)]
+        body = {"users": users[:params["limit"]]}
+        if report_total:
+            body["total"] = len(users)
+        return httpx.Response(200, json=body)
+    return request, calls
+
+
+@pytest.mark.parametrize("make_api", [
+    lambda: marzban_api.MarzbanAPI(),
+    lambda: marzban_api.MarzbanAdminAPI("http://panel", "admin1", "secret"),
+])
+def test_count_users_tells_failures_from_missing_totals(monkeypatch, make_api):
+    api = make_api()
+
+    request, calls = make_count_request(probe_status=503)
+    monkeypatch.setattr(api, "_request", request)
+    assert asyncio.run(api.count_users()) is None
+    assert calls == [1]  # a failed probe does not start a full listing
+
+    request, calls = make_count_request(report_total=False)
+    monkeypatch.setattr(api, "_request", request)
+    assert asyncio.run(api.count_users(status="active")) == 2
+
+    request, calls = make_count_request(listing_status=500, report_total=False)
+    monkeypatch.setattr(api, "_request", request)
+    assert asyncio.run(api.count_users()) is None
@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import scheduler
+from models.schemas import AdminModel, AdminStatsModel
+
+
+class FakeDatabase:
+    def __init__(self, admin):
+        self.admin = admin
+        self.reports = []
+
+    async def get_admin_by_id(self, admin_id):
+        return self.admin
+
+    async def update_admin(self, admin_id, **fields):
+        for key, value in fields.items():
+            setattr(self.admin, key, value)
+        return True
+
+    async def get_latest_usage_report(self, admin_user_id):
+        return None
+
+    async def add_usage_report(self, report):
+        self.reports.append(report)
+
+
+class FakeMarzban:
+    """Counts the requests each stage makes; `count` / `stats` of None mean the request failed."""
+
+    def __init__(self, count=3, stats=None):
+        self.count = count
+        self.stats = stats if stats is not None else AdminStatsModel(total_users=3, total_traffic_used=10)
+        self.calls = []
+
+    async def count_users(self, admin_username=None, fallback=True, **filters):
+        self.calls.append("count")
+        return self.count
+
+    async def get_admin_stats_or_none(self, admin_username):
+        self.calls.append("listing")
+        return self.stats
+
+
+class FakeForecast:
+    def __init__(self):
+        self.observed = []
+
+    async def ensure_loaded(self, admin):
+        pass
+
+    def observe(self, admin_id, users, traffic):
+        self.observed.append((users, traffic))
+
+
+def make_admin(**fields):
+    params = dict(id=1, user_id=100, marzban_username="panel1", max_users=10,
+                  max_total_time=30 * 86400, max_total_traffic=10 ** 12,
+                  created_at=datetime.utcnow() - timedelta(days=1))
+    params.update(fields)
+    return AdminModel(**params)
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    def build(admin, api):
+        database = FakeDatabase(admin)
+        forecast = FakeForecast()
+        monkeypatch.setattr(scheduler, "db", database)
+        monkeypatch.setattr(scheduler, "marzban_api", api)
+        monkeypatch.setattr(scheduler, "usage_forecast", forecast)
+        return scheduler.MonitoringScheduler(bot=None), database, forecast
+    return build
+
+
+def test_traffic_limited_panel_far_from_user_limit_skips_the_count_probe(monitor):
+    api = FakeMarzban()
+    sched, _, _ = monitor(make_admin(users_historical_peak=2), api)
+    result = asyncio.run(sched.check_admin_limits_by_id(1))
+    assert api.calls == ["listing"]
+    assert result.limits_data["current_users"] == 3
+
+
+def test_probe_decides_a_panel_near_its_user_limit(monitor):
+    api = FakeMarzban(count=10)
+    sched, _, _ = monitor(make_admin(users_historical_peak=9), api)
+    result = asyncio.run(sched.check_admin_limits_by_id(1))
+    assert api.calls == ["count"]
+    assert result.exceeded
+
+
+def test_panel_without_traffic_limit_needs_only_the_probe(monitor):
+    api = FakeMarzban(count=4)
+    sched, _, _ = monitor(make_admin(max_total_traffic=0), api)
+    result = asyncio.run(sched.check_admin_limits_by_id(1))
+    assert api.calls == ["count"]
+    assert not result.exceeded
+
+
+@pytest.mark.parametrize("count, expected_calls, measured", [
+    (0, ["count"], True),  # really no users: a measured 0
+    (None, ["count"], False),  # panel did not answer: nothing recorded
+    (3, ["count", "listing"], True),  # sweep did not cover the panel: checked on its own
+])
+def test_panel_missing_from_the_snapshot_is_not_assumed_empty(monitor, count, expected_calls, measured):
+    api = FakeMarzban(count=count)
+    sched, database, forecast = monitor(make_admin(), api)
+    snapshot = {"other_panel": AdminStatsModel(total_users=5, total_traffic_used=50)}
+    result = asyncio.run(sched.check_admin_limits_by_id(1, stats_snapshot=snapshot))
+    assert api.calls == expected_calls
+    assert bool(database.reports) == measured
+    if measured:
+        assert database.reports[0].current_users == count
+    else:
+        assert result.limits_data == {}
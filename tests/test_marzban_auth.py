@@ -0,0 +1,54 @@
+import asyncio
+
+import httpx
+import pytest
+
+import marzban_api
+
+
+class FakeSession:
+    """TokenSession stand-in: hands out token-1 until invalidated, then token-2."""
+
+    username = "sudo"
+
+    def __init__(self):
+        self.token = "token-1"
+
+    async def get_token(self, force=False):
+        if self.token is None:
+            self.token = "token-2"
+        return self.token
+
+    def invalidate(self, token=None):
+        if token is None or token == self.token:
+            self.token = None
+
+
+class FakeClient:
+    """Answers 401 to the expired token and 200 to the fresh one."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def request(self, method, url, headers=None, params=None, json=None):
+        self.calls.append((method, headers["Authorization"]))
+        if headers["Authorization"] == "Bearer token-1":
+            return httpx.Response(401)
+        return httpx.Response(200, json={"username": "u1", "status": "active"})
+
+
+@pytest.mark.parametrize("call", [
+    lambda api: api.get_user("u1"),
+    lambda api: api.modify_user("u1", {"note": "x"}),
+    lambda api: api.remove_user("u1"),
+    lambda api: api.reset_user_data_usage("u1"),
+    lambda api: api.update_admin("a1", {"is_sudo": False}),
+])
+def test_single_calls_retry_once_after_401(monkeypatch, call):
+    client = FakeClient()
+    monkeypatch.setattr(marzban_api, "get_http_client", lambda: client)
+    api = marzban_api.MarzbanAPI()
+    api.session = FakeSession()
+
+    assert asyncio.run(call(api))
+    assert [auth for _, auth in client.calls] == ["Bearer token-1", "Bearer token-2"]
@@ -0,0 +1,38 @@
+import asyncio
+import sqlite3
+
+from database import INDEXES, Database
+
+
+def test_hot_queries_use_their_indexes(tmp_path):
+    async def run():
+        db = Database(str(tmp_path / "bot.db"))
+        try:
+            await db.init_db()
+            return await db.check_query_plans()
+        finally:
+            await db.close()
+
+    assert asyncio.run(run()) == {}
+
+
+def test_init_db_creates_only_the_declared_indexes(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def run():
+        db = Database(path)
+        try:
+            await db.init_db()
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+    conn = sqlite3.connect(path)
+    try:
+        names = {
+            row[0]
+            for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'")
+        }
+    finally:
+        conn.close()
+    assert names == set(INDEXES) | {"idx_admin_audit_admin"}
@@ -0,0 +1,81 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+from database import Database
+from models.schemas import UsageReportModel
+
+
+class StuckFlushDatabase(Database):
+    """Keeps buffered rows pending while `stuck`, as a failed flush would."""
+
+    stuck = False
+
+    async def flush_writes(self) -> int:
+        if self.stuck:
+            return 0
+        return await super().flush_writes()
+
+
+def test_report_buffered_during_compaction_is_still_rolled_up(tmp_path):
+    path = str(tmp_path / "bot.db")
+    check_time = datetime.utcnow().replace(minute=30, second=0, microsecond=0) - timedelta(hours=3)
+
+    async def run():
+        db = StuckFlushDatabase(path)
+        try:
+            await db.init_db()
+            db.stuck = True
+            await db.add_usage_report(UsageReportModel(
+                admin_user_id=7, check_time=check_time, current_users=4,
+                current_total_time=0, current_total_traffic=100, users_data="[]",
+            ))
+            await db.compact_usage_reports()
+            db.stuck = False
+            await db.flush_writes()
+            await db.compact_usage_reports()
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT admin_user_id, users_last, traffic_last FROM usage_rollup_hourly").fetchall()
+    finally:
+        conn.close()
+    assert rows == [(7, 4, 100)]
+
+
+def test_forecast_seed_skips_carried_forward_traffic(tmp_path, monkeypatch):
+    from utils import usage_forecast as forecast_module
+    from models.schemas import AdminModel
+
+    now = datetime.utcnow().replace(microsecond=0)
+
+    async def run():
+        db = Database(str(tmp_path / "bot.db"))
+        try:
+            await db.init_db()
+            await db.add_admin(AdminModel(user_id=7, marzban_username="panel7"))
+            # Traffic measured every 30 minutes at 1000 bytes/s, with carried-forward
+            # copies of the last measurement written in between
+            for minutes in range(0, 120, 15):
+                measured = minutes % 30 == 0
+                traffic = (minutes // 30) * 30 * 60 * 1000
+                await db.add_usage_report(UsageReportModel(
+                    admin_user_id=7, check_time=now - timedelta(minutes=120 - minutes),
+                    current_users=1, current_total_traffic=traffic, users_data="[]",
+                    traffic_measured=measured,
+                ))
+            series = await db.get_usage_series(7, int((now - timedelta(hours=3)).timestamp()) - 86400)
+            admin = (await db.get_admins_for_user(7))[0]
+            monkeypatch.setattr(forecast_module, "db", db)
+            forecaster = forecast_module.UsageForecaster()
+            await forecaster.ensure_loaded(admin)
+            return series, forecaster._trends[admin.id]["traffic"].slope()
+        finally:
+            await db.close()
+
+    series, slope = asyncio.run(run())
+    assert [traffic for _, _, traffic in series].count(None) == 4
+    assert abs(slope - 1000) < 1e-6
@@ -0,0 +1,232 @@
+import asyncio
+import random
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+import config
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Safe to resend automatically (no body, no side effects)
+_IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+# Gateway/availability errors worth retrying; other 5xx are usually deterministic
+_RETRYABLE_STATUSES = (502, 503, 504)
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of sending a request while the Marzban circuit is open."""
+
+
+class TokenBucket:
+    """Asyncio token bucket: refills `rate` tokens per second, bursting up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and consume it (no-op when rate <= 0)."""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ApiHealthController:
+    """Client-side guard for Marzban calls: rate budget, AIMD concurrency limit and circuit breaker.
+
+    Every attempt (retries included) first takes a token from a bucket
+    refilled at `rate` per second, so the total request rate sent to Marzban
+    stays bounded however many checks, page fetches or bulk jobs run at once.
+    In-flight requests are capped by `limit`, which grows by about one per
+    window of healthy responses (additive increase) and halves on a timeout,
+    transport error, 5xx/429 or a response slower than `latency_target`
+    (multiplicative decrease, at most once per window). After
+    `failure_threshold` consecutive failures the circuit opens and requests
+    fail immediately with CircuitOpenError; after `reset_timeout` seconds a
+    single probe is let through (half-open) and its outcome closes or re-opens
+    the circuit.
+    """
+
+    def __init__(
+        self,
+        max_limit: Optional[int] = None,
+        min_limit: Optional[int] = None,
+        latency_target: Optional[float] = None,
+        failure_threshold: Optional[int] = None,
+        reset_timeout: Optional[float] = None,
+        rate: Optional[float] = None,
+    ):
+        self.max_limit = max(1, int(config.API_MAX_CONCURRENCY if max_limit is None else max_limit))
+        self.min_limit = max(1, min(self.max_limit, int(config.API_MIN_CONCURRENCY if min_limit is None else min_limit)))
+        self.latency_target = config.API_LATENCY_TARGET if latency_target is None else latency_target
+        self.failure_threshold = max(1, int(config.CIRCUIT_FAILURE_THRESHOLD if failure_threshold is None else failure_threshold))
+        self.reset_timeout = config.CIRCUIT_RESET_TIMEOUT if reset_timeout is None else reset_timeout
+        rate_value = config.API_RATE_LIMIT if rate is None else rate
+        self._bucket = TokenBucket(rate_value) if rate_value and rate_value > 0 else None
+
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.latency_ewma: Optional[float] = None
+        self._probe_in_flight = False
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+        self.stats = {"requests": 0, "failures": 0, "rejected": 0, "retries": 0, "opened": 0}
+
+    # ----- circuit breaker -----
+    def _set_state(self, state: str, reason: str = ""):
+        if state == self.state:
+            return
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+            print(f"Marzban API circuit OPEN ({reason}); failing fast for {self.reset_timeout:.0f}s")
+        elif state == HALF_OPEN:
+            print("Marzban API circuit HALF-OPEN; probing recovery")
+        else:
+            print(f"Marzban API circuit CLOSED ({reason})")
+
+    def _admit(self) -> bool:
+        """Return True if this request is the half-open probe; raise if the circuit rejects it."""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+        if self.state == OPEN or (self.state == HALF_OPEN and self._probe_in_flight):
+            self.stats["rejected"] += 1
+            raise CircuitOpenError("Marzban API circuit is open; request not sent")
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    # ----- AIMD limit -----
+    async def _acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def _release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        window = max(1.0, self.latency_ewma or 0.0)
+        if now - self._last_decrease < window:
+            return
+        self._last_decrease = now
+        new_limit = max(float(self.min_limit), self.limit / 2)
+        if int(new_limit) != int(self.limit):
+            print(f"Marzban API concurrency limit {int(self.limit)} -> {int(new_limit)} ({reason})")
+        self.limit = new_limit
+
+    def _record(self, ok: bool, latency: float, reason: str, probe: bool):
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        if probe:
+            self._probe_in_flight = False
+        if ok:
+            self.consecutive_failures = 0
+            if probe:
+                self.limit = float(self.min_limit)
+                self._set_state(CLOSED, "probe succeeded")
+            if latency > self.latency_target:
+                self._decrease(f"slow response {latency:.1f}s")
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / max(1.0, self.limit))
+            return
+        self.stats["failures"] += 1
+        self.consecutive_failures += 1
+        self._decrease(reason)
+        if probe:
+            self._set_state(OPEN, f"probe failed: {reason}")
+        elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._set_state(OPEN, f"{self.consecutive_failures} consecutive failures, last: {reason}")
+
+    async def send(self, transport: httpx.AsyncBaseTransport, request: httpx.Request) -> httpx.Response:
+        """Send one request through the breaker and limiter, retrying idempotent ones up to MAX_RETRIES."""
+        retries = max(0, int(config.MAX_RETRIES)) if request.method in _IDEMPOTENT_METHODS else 0
+        attempt = 0
+        while True:
+            if self._bucket is not None:
+                await self._bucket.acquire()
+            probe = self._admit()
+            acquired = False
+            try:
+                await self._acquire()
+                acquired = True
+                self.stats["requests"] += 1
+                started = time.monotonic()
+                response = await transport.handle_async_request(request)
+            except httpx.TransportError as e:
+                self._record(False, time.monotonic() - started, type(e).__name__, probe)
+                if attempt >= retries or self.state != CLOSED:
+                    raise
+            else:
+                status = response.status_code
+                failed = status >= 500 or status == 429
+                self._record(not failed, time.monotonic() - started, f"HTTP {status}", probe)
+                if status not in _RETRYABLE_STATUSES or attempt >= retries or self.state != CLOSED:
+                    return response
+                await response.aclose()
+            finally:
+                if probe:
+                    # Also covers cancellation, even while waiting for a slot:
+                    # the next request becomes the probe
+                    self._probe_in_flight = False
+                if acquired:
+                    await self._release()
+            attempt += 1
+            self.stats["retries"] += 1
+            await asyncio.sleep(min(config.BULK_RETRY_BACKOFF * (2 ** (attempt - 1)), 10.0) * random.uniform(0.8, 1.2))
+
+    def snapshot(self) -> Dict[str, Any]:
+        retry_in = 0.0
+        if self.state == OPEN:
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+        return {
+            "state": self.state,
+            "limit": int(self.limit),
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ms": int((self.latency_ewma or 0.0) * 1000),
+            "retry_in": int(retry_in),
+            **self.stats,
+        }
+
+
+class GuardedTransport(httpx.AsyncBaseTransport):
+    """httpx transport that routes every request through an ApiHealthController."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, controller: ApiHealthController):
+        self._transport = transport
+        self._controller = controller
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._controller.send(self._transport, request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+# Global controller shared by all Marzban API calls
+api_health = ApiHealthController()
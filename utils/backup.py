@@ -37,6 +37,10 @@ async def create_backup_zip() -> Path:
     - bot.log (if exists in CWD)
     - logs directory (./logs or /app/logs if exists)
     """
+    # Flush the WAL into the main file so the copied database is complete
+    from database import db
+    await db.checkpoint()
+
     db_path = Path(config.DATABASE_PATH).resolve()
     base_dir = db_path.parent if db_path.exists() else Path.cwd()
 
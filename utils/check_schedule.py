@@ -0,0 +1,127 @@
+import heapq
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import config
+
+
+# Limit ratios tracked per panel (0..1 of the limit), keyed like LimitCheckResult.limits_data
+RATIO_KEYS = {"traffic": "traffic_percentage", "users": "user_percentage", "time": "time_percentage"}
+
+
+def compute_check_interval(
+    ratios: Dict[str, float],
+    rates: Dict[str, float],
+    min_interval: Optional[float] = None,
+    max_interval: Optional[float] = None,
+    safety: Optional[float] = None,
+) -> float:
+    """Seconds until a panel should be checked again.
+
+    Starts from max_interval scaled by the squared headroom to the nearest
+    limit (idle panels ~max_interval, panels near a limit ~min_interval),
+    then shortens it to `safety` times the projected time to any limit at the
+    current growth rate (ratio per second).
+    """
+    min_interval = config.MONITORING_MIN_INTERVAL if min_interval is None else min_interval
+    max_interval = config.MONITORING_MAX_INTERVAL if max_interval is None else max_interval
+    safety = config.MONITORING_SAFETY_FACTOR if safety is None else safety
+
+    headroom = max(0.0, 1.0 - max(ratios.values(), default=0.0))
+    interval = max_interval * headroom * headroom
+    for name, ratio in ratios.items():
+        rate = rates.get(name, 0.0)
+        if rate > 0:
+            interval = min(interval, max(0.0, 1.0 - ratio) / rate * safety)
+    return max(min_interval, min(max_interval, interval))
+
+
+class CheckSchedule:
+    """Priority queue of per-panel next check times (min-heap on due time).
+
+    Entries are (due, admin_id); rescheduling pushes a new entry and stale
+    ones are skipped lazily when popped. Growth rates come from the previous
+    sample of each panel.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int]] = []
+        self._due: Dict[int, float] = {}
+        self._samples: Dict[int, Tuple[float, Dict[str, float]]] = {}
+        self.intervals: Dict[int, float] = {}
+
+    def sync(self, admin_ids: Iterable[int], now: Optional[float] = None):
+        """Schedule new panels immediately and forget ones that are no longer active."""
+        now = time.time() if now is None else now
+        active = set(admin_ids)
+        for admin_id in active:
+            if admin_id not in self._due:
+                self._push(admin_id, now)
+        for admin_id in [a for a in self._due if a not in active]:
+            self.forget(admin_id)
+
+    def _push(self, admin_id: int, due: float):
+        self._due[admin_id] = due
+        heapq.heappush(self._heap, (due, admin_id))
+
+    def forget(self, admin_id: int):
+        self._due.pop(admin_id, None)
+        self._samples.pop(admin_id, None)
+        self.intervals.pop(admin_id, None)
+
+    def pop_due(self, now: Optional[float] = None) -> List[int]:
+        """Remove and return every panel whose check is due."""
+        now = time.time() if now is None else now
+        due: List[int] = []
+        while self._heap and self._heap[0][0] <= now:
+            ts, admin_id = heapq.heappop(self._heap)
+            if self._due.get(admin_id) != ts:
+                continue  # stale entry
+            del self._due[admin_id]
+            due.append(admin_id)
+        return due
+
+    def reschedule(self, admin_id: int, limits_data: Dict[str, Any], now: Optional[float] = None,
+                   extra_rates: Optional[Dict[str, float]] = None) -> float:
+        """Schedule the next check from this check's limit ratios and return the interval.
+
+        `extra_rates` (ratio per second, e.g. from the usage forecast) are used
+        where they are faster than the growth seen since the previous check.
+        """
+        now = time.time() if now is None else now
+        ratios = {name: float(limits_data[key]) for name, key in RATIO_KEYS.items() if limits_data.get(key) is not None}
+        if not ratios:
+            # Check failed or returned nothing usable: retry soon
+            interval = config.MONITORING_MIN_INTERVAL
+        else:
+            rates: Dict[str, float] = {}
+            previous = self._samples.get(admin_id)
+            if previous is not None and now > previous[0]:
+                elapsed = now - previous[0]
+                for name, ratio in ratios.items():
+                    if name in previous[1] and ratio > previous[1][name]:
+                        rates[name] = (ratio - previous[1][name]) / elapsed
+            max_time = limits_data.get("max_time") or 0
+            if max_time > 0:
+                rates["time"] = 1.0 / max_time
+            for name, rate in (extra_rates or {}).items():
+                rates[name] = max(rates.get(name, 0.0), rate)
+            self._samples[admin_id] = (now, ratios)
+            interval = compute_check_interval(ratios, rates)
+        self.intervals[admin_id] = interval
+        self._push(admin_id, now + interval)
+        return interval
+
+    def next_due_in(self, now: Optional[float] = None) -> Optional[float]:
+        now = time.time() if now is None else now
+        return max(0.0, min(self._due.values()) - now) if self._due else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        intervals = sorted(self.intervals.values())
+        return {
+            "scheduled": len(self._due),
+            "next_due_in": round(self.next_due_in() or 0.0, 1),
+            "min_interval": round(intervals[0]) if intervals else None,
+            "median_interval": round(intervals[len(intervals) // 2]) if intervals else None,
+            "max_interval": round(intervals[-1]) if intervals else None,
+        }
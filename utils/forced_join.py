@@ -0,0 +1,138 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from aiogram import Bot
+
+import config
+from database import db
+
+
+JOINED_STATUSES = ("member", "administrator", "creator")
+
+ChatKey = Union[int, str]
+
+
+def normalize_chat_id(raw_chat_id: Any) -> ChatKey:
+    """Chat id as stored for a forced channel -> value usable with the Bot API."""
+    chat_id = raw_chat_id
+    if isinstance(raw_chat_id, str) and raw_chat_id.isdigit() and not raw_chat_id.startswith('-100'):
+        chat_id = f"-100{raw_chat_id}"
+    if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+        return int(chat_id)
+    return chat_id
+
+
+def _cache_key(chat_id: ChatKey) -> ChatKey:
+    # Usernames are case-insensitive in Telegram
+    return chat_id.lower() if isinstance(chat_id, str) else chat_id
+
+
+def status_name(member: Any) -> str:
+    status = getattr(member, 'status', None)
+    if hasattr(status, 'value'):
+        return str(status.value).lower()
+    if hasattr(status, 'name'):
+        return status.name.lower()
+    return str(status).lower()
+
+
+class ForcedJoinChecker:
+    """Forced-join membership checks with a per-(user, channel) TTL cache.
+
+    Positive results are kept for `ttl` seconds and negative ones (not a
+    member, or the check failed) for the shorter `negative_ttl`, so a user who
+    just joined is not blocked for long. Cache misses are checked with
+    concurrent get_chat_member calls. chat_member updates (received when the
+    bot is an admin of the channel) overwrite entries as soon as they arrive.
+    """
+
+    def __init__(self, ttl: Optional[float] = None, negative_ttl: Optional[float] = None):
+        self.ttl = config.FORCED_JOIN_CACHE_TTL if ttl is None else ttl
+        self.negative_ttl = config.FORCED_JOIN_NEGATIVE_TTL if negative_ttl is None else negative_ttl
+        self._entries: Dict[Tuple[int, ChatKey], Tuple[bool, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, user_id: int, chat_id: ChatKey, joined: bool):
+        ttl = self.ttl if joined else self.negative_ttl
+        key = (user_id, _cache_key(chat_id))
+        if ttl > 0:
+            self._entries[key] = (joined, time.monotonic() + ttl)
+        else:
+            self._entries.pop(key, None)
+
+    def _cached(self, user_id: int, chat_id: ChatKey) -> Optional[bool]:
+        key = (user_id, _cache_key(chat_id))
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry[0]
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+
+    async def _check(self, bot: Bot, user_id: int, chat_id: ChatKey) -> bool:
+        try:
+            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+            joined = status_name(member) in JOINED_STATUSES
+        except Exception:
+            joined = False
+        self._store(user_id, chat_id, joined)
+        return joined
+
+    async def get_missing_channels(self, bot: Bot, user_id: int, force: bool = False) -> List[Dict[str, Any]]:
+        """Active forced channels the user has not joined; `force` bypasses the cache."""
+        channels = await db.get_forced_channels()
+        if not channels:
+            return []
+        if len(self._entries) > config.FORCED_JOIN_CACHE_MAX_ENTRIES:
+            self._prune()
+
+        missing: List[Dict[str, Any]] = []
+        pending: List[Tuple[Dict[str, Any], ChatKey]] = []
+        for ch in channels:
+            chat_id = normalize_chat_id(ch.get('chat_id'))
+            joined = None if force else self._cached(user_id, chat_id)
+            if joined is None:
+                self.misses += 1
+                pending.append((ch, chat_id))
+            else:
+                self.hits += 1
+                if not joined:
+                    missing.append(ch)
+
+        if pending:
+            results = await asyncio.gather(*(self._check(bot, user_id, chat_id) for _, chat_id in pending))
+            missing.extend(ch for (ch, _), joined in zip(pending, results) if not joined)
+        # Keep the configured channel order in the join prompt
+        order = {id(ch): index for index, ch in enumerate(channels)}
+        missing.sort(key=lambda ch: order[id(ch)])
+        return missing
+
+    def on_chat_member(self, chat_id: int, username: Optional[str], user_id: int, status: str):
+        """Apply a chat_member update to every cache key the channel may be stored under."""
+        joined = status in JOINED_STATUSES
+        self._store(user_id, chat_id, joined)
+        if username:
+            self._store(user_id, f"@{username}", joined)
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Forget cached results for one user, or for everyone."""
+        if user_id is None:
+            self._entries.clear()
+        else:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# Global checker instance shared by the middleware and handlers
+forced_join = ForcedJoinChecker()
@@ -0,0 +1,48 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+def freeze(value: Any) -> Hashable:
+    """Hashable, order-independent form of query params (dicts/lists nested)."""
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one in-flight call.
+
+    The first caller for a key starts `fn()`; callers arriving while it runs
+    await the same result (or exception) instead of issuing their own. The
+    shared call is shielded, so one waiter being cancelled does not cancel it
+    for the others. Nothing is cached once the call finishes.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.saved = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future: Optional[asyncio.Future] = self._inflight.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+
+            def _forget(done: asyncio.Future, key: Hashable = key):
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+                if not done.cancelled():
+                    done.exception()  # mark retrieved even if every waiter was cancelled
+
+            future.add_done_callback(_forget)
+        else:
+            self.saved += 1
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, int]:
+        return {"calls": self.calls, "saved": self.saved, "in_flight": len(self._inflight)}
@@ -0,0 +1,153 @@
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import config
+from database import db
+from models.schemas import AdminModel
+
+
+# Persian limit names used in the forecast line
+LIMIT_LABELS = {"traffic": "ترافیک", "users": "کاربران", "time": "زمان"}
+
+
+class _Trend:
+    """Least-squares line over a sliding time window, updated in O(1) per sample.
+
+    Running sums of t, t², y and t·y are adjusted as samples enter and leave
+    the window, so the slope never needs a rescan of the history. Times are
+    kept relative to the first sample to avoid float cancellation. A
+    monotonic series (traffic) restarts when its value drops, i.e. the usage
+    counter was reset.
+    """
+
+    def __init__(self, monotonic: bool = False):
+        self.monotonic = monotonic
+        self.samples: Deque[Tuple[float, float]] = deque()
+        self.origin: Optional[float] = None
+        self.n = 0
+        self.st = self.stt = self.sy = self.sty = 0.0
+
+    def _apply(self, t: float, y: float, sign: int):
+        self.n += sign
+        self.st += sign * t
+        self.stt += sign * t * t
+        self.sy += sign * y
+        self.sty += sign * t * y
+
+    def reset(self):
+        self.__init__(self.monotonic)
+
+    def add(self, ts: float, y: float, window: float):
+        if self.origin is None:
+            self.origin = ts
+        t = ts - self.origin
+        if self.samples and t <= self.samples[-1][0]:
+            return  # duplicate or out-of-order sample
+        if self.monotonic and self.samples and y < self.samples[-1][1]:
+            # Usage counter was reset (panel reset/renewed); old points no longer describe the trend
+            self.reset()
+            self.origin = ts
+            t = 0.0
+        self.samples.append((t, y))
+        self._apply(t, y, 1)
+        while self.samples and self.samples[0][0] < t - window:
+            self._apply(*self.samples.popleft(), -1)
+
+    def slope(self) -> Optional[float]:
+        """Growth per second, or None without enough spread in the window."""
+        if self.n < config.FORECAST_MIN_SAMPLES or self.samples[-1][0] - self.samples[0][0] < config.FORECAST_MIN_SPAN:
+            return None
+        denominator = self.n * self.stt - self.st * self.st
+        if denominator <= 0:
+            return None
+        return (self.n * self.sty - self.st * self.sy) / denominator
+
+
+class UsageForecaster:
+    """Per-panel growth trends for traffic and user count, projected to each limit.
+
+    Each monitoring check adds one sample per measured series (traffic is
+    only sampled when the check actually summed it); the first time a panel is seen its
+    window is seeded once from stored history (raw usage_reports plus hourly
+    rollups), skipping values that were carried forward rather than measured. usage_reports are keyed by Telegram user, so history is only
+    used for users with a single panel; the others build their window from
+    live checks. Time needs no model: it runs at exactly one second per second.
+    """
+
+    def __init__(self):
+        self._trends: Dict[int, Dict[str, _Trend]] = {}
+
+    def _trend(self, admin_id: int) -> Dict[str, _Trend]:
+        trend = self._trends.get(admin_id)
+        if trend is None:
+            trend = self._trends[admin_id] = {"users": _Trend(), "traffic": _Trend(monotonic=True)}
+        return trend
+
+    async def ensure_loaded(self, admin: AdminModel):
+        """Seed a panel's window from stored history the first time it is seen."""
+        if admin.id is None or admin.id in self._trends:
+            return
+        trend = self._trend(admin.id)
+        try:
+            if len(await db.get_admins_for_user(admin.user_id)) != 1:
+                return
+            since = int(time.time() - config.FORECAST_WINDOW)
+            for ts, users, traffic in await db.get_usage_series(admin.user_id, since):
+                # Values carried forward from an earlier check would flatten the fitted slope
+                if users is not None:
+                    trend["users"].add(ts, users, config.FORECAST_WINDOW)
+                if traffic is not None:
+                    trend["traffic"].add(ts, traffic, config.FORECAST_WINDOW)
+        except Exception as e:
+            print(f"Error loading usage history for panel {admin.id}: {e}")
+
+    def observe(self, admin_id: int, users: int, traffic: Optional[int] = None, ts: Optional[float] = None):
+        """Add one check's sample; pass traffic=None when the check did not sum traffic."""
+        ts = time.time() if ts is None else ts
+        trend = self._trend(admin_id)
+        trend["users"].add(ts, users, config.FORECAST_WINDOW)
+        if traffic is not None:
+            trend["traffic"].add(ts, traffic, config.FORECAST_WINDOW)
+
+    def forget(self, admin_id: int):
+        self._trends.pop(admin_id, None)
+
+    def rates(self, admin: AdminModel) -> Dict[str, float]:
+        """Fitted growth as a share of each limit per second (for the check schedule)."""
+        trend = self._trends.get(admin.id)
+        if trend is None:
+            return {}
+        result: Dict[str, float] = {}
+        for name, limit in (("traffic", admin.max_total_traffic), ("users", admin.max_users)):
+            slope = trend[name].slope()
+            if slope and slope > 0 and limit > 0:
+                result[name] = slope / limit
+        return result
+
+    def forecast(self, admin: AdminModel, peak_users: int, traffic_used: int, elapsed_seconds: float) -> Dict[str, float]:
+        """Seconds until each limit is reached at the current trend (limits not growing are omitted)."""
+        result: Dict[str, float] = {}
+        if admin.max_total_time > 0:
+            result["time"] = max(0.0, admin.max_total_time - elapsed_seconds)
+        trend = self._trends.get(admin.id)
+        if trend is not None:
+            for name, used, limit in (("traffic", traffic_used, admin.max_total_traffic), ("users", peak_users, admin.max_users)):
+                slope = trend[name].slope()
+                if slope and slope > 0 and limit > 0:
+                    result[name] = max(0.0, (limit - used) / slope)
+        return result
+
+    def forecast_text(self, forecast: Dict[str, Any]) -> str:
+        """Persian line for the soonest limit within FORECAST_HORIZON hours, or '' if none."""
+        if not forecast:
+            return ""
+        name, seconds = min(forecast.items(), key=lambda item: item[1])
+        hours = seconds / 3600
+        if hours > config.FORECAST_HORIZON:
+            return ""
+        return f"⏳ پیش‌بینی: رسیدن به محدودیت {LIMIT_LABELS[name]} در حدود {hours:.1f} ساعت دیگر"
+
+
+# Global forecaster fed by the monitor and read by the status screens
+usage_forecast = UsageForecaster()
@@ -0,0 +1,221 @@
+import heapq
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+from marzban_api import marzban_api, safe_extract_username, build_admin_stats
+from models.schemas import UserRecord, AdminStatsModel
+
+
+# Fields that affect admin stats, in the order they are stored per user
+# (admin, status, used_traffic, lifetime_used_traffic, data_limit, expire)
+TrackedRecord = Tuple[Optional[str], str, int, int, Optional[int], Optional[int]]
+# What one user adds to its admin's totals
+# (status_key, active, expired, quota_full, consumed, traffic)
+Contribution = Tuple[str, int, int, int, int, int]
+
+
+def _record_from_row(row: Dict[str, Any]) -> TrackedRecord:
+    return (
+        safe_extract_username(row.get("admin")),
+        row.get("status") or "",
+        row.get("used_traffic") or 0,
+        row.get("lifetime_used_traffic") or 0,
+        row.get("data_limit"),
+        row.get("expire"),
+    )
+
+
+def _contribution(record: TrackedRecord, now_ts: float) -> Contribution:
+    """Same rules as build_admin_stats, for a single user."""
+    _, status, used, lifetime, data_limit, expire = record
+    status_key = (status or "unknown").lower()
+    is_expired = expire is not None and expire <= now_ts
+    is_quota_full = data_limit is not None and (used >= data_limit or lifetime >= data_limit)
+    is_active = status_key == "active"
+    consumed = is_active and not is_expired and not is_quota_full
+    return (status_key, int(is_active), int(is_expired), int(is_quota_full), int(consumed), used)
+
+
+class _AdminTotals:
+    __slots__ = ("total_users", "active_users", "consumed_users", "total_traffic", "expired", "quota_full", "counts_by_status")
+
+    def __init__(self):
+        self.total_users = 0
+        self.active_users = 0
+        self.consumed_users = 0
+        self.total_traffic = 0
+        self.expired = 0
+        self.quota_full = 0
+        self.counts_by_status: Dict[str, int] = {}
+
+    def apply(self, contribution: Contribution, sign: int):
+        status_key, active, expired, quota_full, consumed, traffic = contribution
+        self.total_users += sign
+        self.active_users += sign * active
+        self.consumed_users += sign * consumed
+        self.expired += sign * expired
+        self.quota_full += sign * quota_full
+        self.total_traffic += sign * traffic
+        count = self.counts_by_status.get(status_key, 0) + sign
+        if count:
+            self.counts_by_status[status_key] = count
+        else:
+            self.counts_by_status.pop(status_key, None)
+
+    def to_stats(self) -> AdminStatsModel:
+        return AdminStatsModel(
+            total_users=self.total_users,
+            active_users=self.active_users,
+            consumed_users=self.consumed_users,
+            total_traffic_used=self.total_traffic,
+            total_time_used=0,
+            counts_by_status=dict(self.counts_by_status),
+            counts_extra={
+                "expired": self.expired,
+                "quota_full": self.quota_full,
+                "disabled": self.counts_by_status.get("disabled", 0),
+            },
+        )
+
+
+class UsageTracker:
+    """Keep per-admin usage totals up to date from per-user deltas.
+
+    Every refresh still sweeps /api/users once, but rows whose stats-relevant
+    fields are unchanged since the last sweep are skipped: only changed, new
+    and removed users adjust their admin's totals, and no pydantic models are
+    built for them. Users whose `expire` passes between sweeps are re-evaluated
+    from a heap. Every `reconcile_every` refreshes the totals are rebuilt from
+    scratch with build_admin_stats, which also corrects any drift.
+    """
+
+    def __init__(self, reconcile_every: Optional[int] = None):
+        self.reconcile_every = max(1, reconcile_every or config.USAGE_RECONCILE_EVERY)
+        self._users: Dict[str, Tuple[TrackedRecord, Contribution]] = {}
+        self._totals: Dict[str, _AdminTotals] = {}
+        self._expiry_heap: List[Tuple[int, str]] = []
+        self.cycles = 0
+        self.last_refresh: Dict[str, Any] = {}
+
+    def reset(self):
+        """Forget all tracked users; the next refresh does a full reconciliation."""
+        self._users.clear()
+        self._totals.clear()
+        self._expiry_heap.clear()
+        self.cycles = 0
+
+    def _add(self, username: str, record: TrackedRecord, now_ts: float):
+        contribution = _contribution(record, now_ts)
+        self._users[username] = (record, contribution)
+        admin = record[0]
+        if admin:
+            self._totals.setdefault(admin, _AdminTotals()).apply(contribution, 1)
+        expire = record[5]
+        if expire is not None and expire > now_ts:
+            heapq.heappush(self._expiry_heap, (expire, username))
+
+    def _remove(self, username: str):
+        record, contribution = self._users.pop(username)
+        admin = record[0]
+        if admin and admin in self._totals:
+            totals = self._totals[admin]
+            totals.apply(contribution, -1)
+            if totals.total_users <= 0:
+                del self._totals[admin]
+
+    def _process_expirations(self, now_ts: float) -> int:
+        """Re-evaluate users whose expire time has passed since they were last counted."""
+        expired = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now_ts:
+            expire, username = heapq.heappop(heap)
+            entry = self._users.get(username)
+            # Skip stale heap entries (user removed or expire changed since push)
+            if entry is None or entry[0][5] != expire:
+                continue
+            record = entry[0]
+            self._remove(username)
+            self._add(username, record, now_ts)
+            expired += 1
+        return expired
+
+    def _reconcile(self, rows: List[Dict[str, Any]], now_ts: float) -> Dict[str, AdminStatsModel]:
+        """Rebuild tracker state from a full sweep and return authoritative stats."""
+        previous = {admin: totals.to_stats() for admin, totals in self._totals.items()}
+        self._users.clear()
+        self._totals.clear()
+        self._expiry_heap.clear()
+
+        grouped: Dict[str, List[UserRecord]] = {}
+        for row in rows:
+            username = safe_extract_username(row.get("username"))
+            if not username:
+                continue
+            record = _record_from_row(row)
+            self._add(username, record, now_ts)
+            if record[0]:
+                grouped.setdefault(record[0], []).append(UserRecord(username, *record[1:], admin=record[0]))
+        stats = {admin: build_admin_stats(users) for admin, users in grouped.items()}
+
+        if previous:
+            drifted = [
+                admin for admin, admin_stats in stats.items()
+                if admin in previous and (
+                    previous[admin].total_users != admin_stats.total_users
+                    or previous[admin].total_traffic_used != admin_stats.total_traffic_used
+                )
+            ]
+            if drifted:
+                print(f"Usage tracker reconciliation corrected totals for {len(drifted)} admins")
+        return stats
+
+    async def refresh(self) -> Optional[Dict[str, AdminStatsModel]]:
+        """Sweep users once and return per-admin stats keyed by admin username.
+
+        Returns None if the sweep failed, so callers can fall back to
+        per-admin queries (same contract as get_admin_stats_snapshot).
+        """
+        try:
+            rows = await marzban_api.get_user_rows()
+            now_ts = datetime.now().timestamp()
+            reconcile = not self._users or self.cycles % self.reconcile_every == 0
+            self.cycles += 1
+
+            if reconcile:
+                stats = self._reconcile(rows, now_ts)
+                self.last_refresh = {"reconciled": True, "users": len(self._users), "changed": len(self._users), "removed": 0}
+                return stats
+
+            seen = set()
+            changed = 0
+            for row in rows:
+                username = safe_extract_username(row.get("username"))
+                if not username:
+                    continue
+                seen.add(username)
+                record = _record_from_row(row)
+                entry = self._users.get(username)
+                if entry is not None and entry[0] == record:
+                    continue
+                if entry is not None:
+                    self._remove(username)
+                self._add(username, record, now_ts)
+                changed += 1
+
+            removed_users = [username for username in self._users if username not in seen]
+            for username in removed_users:
+                self._remove(username)
+            expired = self._process_expirations(now_ts)
+
+            self.last_refresh = {
+                "reconciled": False,
+                "users": len(self._users),
+                "changed": changed,
+                "removed": len(removed_users),
+                "expired": expired,
+            }
+            return {admin: totals.to_stats() for admin, totals in self._totals.items()}
+        except Exception as e:
+            print(f"Error refreshing usage tracker: {e}")
+            return None
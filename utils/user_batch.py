@@ -0,0 +1,227 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+from models.schemas import AdminStatsModel
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; the pure-Python path gives the same results
+    np = None
+
+
+# Below this many users the pure-Python loop is faster than building arrays
+NUMPY_MIN_ROWS = 1024
+# Sentinel for missing data_limit / expire in the integer columns
+MISSING = -1
+
+
+class UserBatch:
+    """Columnar view of a user list: one column per stats-relevant field.
+
+    Statuses are stored as small integer codes (see `status_names`), and
+    missing data_limit/expire values as MISSING, so every counter and filter
+    can be computed in a single pass (vectorized when NumPy is installed).
+    `users` keeps the source objects so filters can return them unchanged.
+    """
+    __slots__ = ("users", "admins", "status_names", "status", "used", "lifetime", "data_limit", "expire")
+
+    def __init__(self, users: Sequence[Any]):
+        self.users = users
+        self.admins: List[Optional[str]] = []
+        self.status_names: List[str] = []
+        self.status: List[int] = []
+        self.used: List[int] = []
+        self.lifetime: List[int] = []
+        self.data_limit: List[int] = []
+        self.expire: List[int] = []
+
+        status_codes: Dict[str, int] = {}
+        for user in users:
+            status_key = (user.status or "unknown").lower()
+            code = status_codes.get(status_key)
+            if code is None:
+                code = status_codes[status_key] = len(self.status_names)
+                self.status_names.append(status_key)
+            self.status.append(code)
+            self.admins.append(user.admin)
+            self.used.append(user.used_traffic or 0)
+            self.lifetime.append(user.lifetime_used_traffic or 0)
+            self.data_limit.append(MISSING if user.data_limit is None else user.data_limit)
+            self.expire.append(MISSING if user.expire is None else user.expire)
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def status_code(self, name: str) -> int:
+        """Code of a status in this batch, or MISSING if no user has it."""
+        try:
+            return self.status_names.index(name)
+        except ValueError:
+            return MISSING
+
+
+def _use_numpy(batch: UserBatch) -> bool:
+    return np is not None and len(batch) >= NUMPY_MIN_ROWS
+
+
+def _group_codes(batch: UserBatch):
+    """Map admins to dense group codes; users without an admin get MISSING."""
+    names: List[str] = []
+    index: Dict[str, int] = {}
+    codes: List[int] = []
+    for admin in batch.admins:
+        if not admin:
+            codes.append(MISSING)
+            continue
+        code = index.get(admin)
+        if code is None:
+            code = index[admin] = len(names)
+            names.append(admin)
+        codes.append(code)
+    return names, codes
+
+
+def _counters(batch: UserBatch, groups: List[int], n_groups: int, now_ts: float) -> List[Dict[str, Any]]:
+    """Per-group totals: users, active, consumed, expired, quota_full, traffic and status counts."""
+    n_status = len(batch.status_names)
+    active_code = batch.status_code("active")
+
+    if _use_numpy(batch):
+        group = np.asarray(groups, dtype=np.int64)
+        status = np.asarray(batch.status, dtype=np.int64)
+        used = np.asarray(batch.used, dtype=np.int64)
+        lifetime = np.asarray(batch.lifetime, dtype=np.int64)
+        data_limit = np.asarray(batch.data_limit, dtype=np.int64)
+        expire = np.asarray(batch.expire, dtype=np.int64)
+
+        keep = group >= 0
+        group, status, used, lifetime, data_limit, expire = (
+            group[keep], status[keep], used[keep], lifetime[keep], data_limit[keep], expire[keep]
+        )
+        expired = (expire != MISSING) & (expire <= now_ts)
+        has_limit = data_limit != MISSING
+        quota_full = has_limit & ((used >= data_limit) | (lifetime >= data_limit))
+        active = status == active_code
+        consumed = active & ~expired & ~quota_full
+
+        def count(mask):
+            return np.bincount(group[mask], minlength=n_groups)
+
+        totals = np.bincount(group, minlength=n_groups)
+        active_counts = count(active)
+        consumed_counts = count(consumed)
+        expired_counts = count(expired)
+        quota_counts = count(quota_full)
+        traffic = np.bincount(group, weights=used, minlength=n_groups)
+        by_status = np.bincount(group * n_status + status, minlength=n_groups * n_status).reshape(n_groups, n_status)
+        return [
+            {
+                "total": int(totals[g]),
+                "active": int(active_counts[g]),
+                "consumed": int(consumed_counts[g]),
+                "expired": int(expired_counts[g]),
+                "quota_full": int(quota_counts[g]),
+                # bincount weights are float64; sum exactly in Python when that could lose precision
+                "traffic": int(traffic[g]) if traffic[g] < 2 ** 53 else sum(int(u) for u in used[group == g]),
+                "by_status": by_status[g].tolist(),
+            }
+            for g in range(n_groups)
+        ]
+
+    result = [
+        {"total": 0, "active": 0, "consumed": 0, "expired": 0, "quota_full": 0, "traffic": 0, "by_status": [0] * n_status}
+        for _ in range(n_groups)
+    ]
+    status, used, lifetime, data_limit, expire = batch.status, batch.used, batch.lifetime, batch.data_limit, batch.expire
+    for i, g in enumerate(groups):
+        if g < 0:
+            continue
+        acc = result[g]
+        code = status[i]
+        is_expired = expire[i] != MISSING and expire[i] <= now_ts
+        limit = data_limit[i]
+        is_quota_full = limit != MISSING and (used[i] >= limit or lifetime[i] >= limit)
+        acc["total"] += 1
+        acc["traffic"] += used[i]
+        acc["by_status"][code] += 1
+        if is_expired:
+            acc["expired"] += 1
+        if is_quota_full:
+            acc["quota_full"] += 1
+        if code == active_code:
+            acc["active"] += 1
+            if not is_expired and not is_quota_full:
+                acc["consumed"] += 1
+    return result
+
+
+def _to_stats(batch: UserBatch, acc: Dict[str, Any]) -> AdminStatsModel:
+    counts_by_status = {name: count for name, count in zip(batch.status_names, acc["by_status"]) if count}
+    return AdminStatsModel(
+        total_users=acc["total"],
+        active_users=acc["active"],
+        consumed_users=acc["consumed"],
+        total_traffic_used=acc["traffic"],
+        total_time_used=0,
+        counts_by_status=counts_by_status,
+        counts_extra={
+            "expired": acc["expired"],
+            "quota_full": acc["quota_full"],
+            "disabled": counts_by_status.get("disabled", 0),
+        },
+    )
+
+
+def compute_admin_stats(batch: UserBatch, now_ts: Optional[float] = None) -> AdminStatsModel:
+    """Aggregate every user of the batch into one AdminStatsModel."""
+    now_ts = datetime.now().timestamp() if now_ts is None else now_ts
+    acc = _counters(batch, [0] * len(batch), 1, now_ts)[0]
+    return _to_stats(batch, acc)
+
+
+def compute_admin_stats_by_admin(batch: UserBatch, now_ts: Optional[float] = None) -> Dict[str, AdminStatsModel]:
+    """Aggregate the batch per admin in one pass; users without an admin are ignored."""
+    now_ts = datetime.now().timestamp() if now_ts is None else now_ts
+    names, groups = _group_codes(batch)
+    if not names:
+        return {}
+    counters = _counters(batch, groups, len(names), now_ts)
+    return {name: _to_stats(batch, acc) for name, acc in zip(names, counters)}
+
+
+def select_expired_before(batch: UserBatch, cutoff: float) -> List[Any]:
+    """Users whose expire is set and earlier than `cutoff`."""
+    if _use_numpy(batch):
+        expire = np.asarray(batch.expire, dtype=np.int64)
+        indices = np.flatnonzero((expire != MISSING) & (expire < cutoff)).tolist()
+    else:
+        indices = [i for i, e in enumerate(batch.expire) if e != MISSING and e < cutoff]
+    return [batch.users[i] for i in indices]
+
+
+def select_small_quota_finished(batch: UserBatch, max_quota_bytes: int, now_ts: Optional[float] = None) -> List[Any]:
+    """Users that are time-expired, or have a quota <= max_quota_bytes that is used up or disabled/limited."""
+    now_ts = datetime.now().timestamp() if now_ts is None else now_ts
+    stopped = {code for code, name in enumerate(batch.status_names) if name in ("disabled", "limited")}
+    if _use_numpy(batch):
+        status = np.asarray(batch.status, dtype=np.int64)
+        used = np.asarray(batch.used, dtype=np.int64)
+        lifetime = np.asarray(batch.lifetime, dtype=np.int64)
+        data_limit = np.asarray(batch.data_limit, dtype=np.int64)
+        expire = np.asarray(batch.expire, dtype=np.int64)
+        time_expired = (expire != MISSING) & (expire <= now_ts)
+        small = (data_limit != MISSING) & (data_limit <= max_quota_bytes)
+        finished = (used >= data_limit) | (lifetime >= data_limit) | np.isin(status, list(stopped))
+        indices = np.flatnonzero(time_expired | (small & finished)).tolist()
+    else:
+        indices = []
+        for i in range(len(batch)):
+            expire = batch.expire[i]
+            limit = batch.data_limit[i]
+            time_expired = expire != MISSING and expire <= now_ts
+            small_finished = limit != MISSING and limit <= max_quota_bytes and (
+                batch.used[i] >= limit or batch.lifetime[i] >= limit or batch.status[i] in stopped
+            )
+            if time_expired or small_finished:
+                indices.append(i)
+    return [batch.users[i] for i in indices]